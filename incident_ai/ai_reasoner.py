@@ -1,25 +1,20 @@
-from dotenv import load_dotenv
-from elasticsearch import Elasticsearch
-import os
+import asyncio
 import json
+import time
+from datetime import datetime, timezone
 
-load_dotenv()
+from batch_inference import BatchRunner
+from es_client import open_async_client
+from inference_client import INFERENCE_ID, extract_completion, inference_client
+from llm_cache import cache_enabled, cached_completion, cached_completion_async, llm_cache
 
-ELASTIC_CLOUD_ID = os.getenv("ELASTIC_CLOUD_ID")
-USERNAME = os.getenv("ELASTIC_USERNAME")
-PASSWORD = os.getenv("ELASTIC_PASSWORD")
 
-es = Elasticsearch(
-    cloud_id=ELASTIC_CLOUD_ID,
-    basic_auth=(USERNAME, PASSWORD)
-)
+# ========================
+# PROMPTS
+# ========================
 
-# We will use Elastic's built-in Gemini model endpoint
-INFERENCE_ID = ".google-gemini-2.5-flash-completion"
-
-def generate_ai_analysis(threat):
-
-    prompt = f"""
+def build_analysis_prompt(threat):
+    return f"""
 You are an expert SOC (Security Operations Center) AI analyst.
 
 Threat Type: {threat.get("type")}
@@ -40,42 +35,34 @@ Respond strictly in valid JSON format:
 }}
 """
 
-    try:
-        response = es.perform_request(
-            "POST",
-            f"/_inference/{INFERENCE_ID}",
-            headers={
-                "Content-Type": "application/vnd.elasticsearch+json; compatible-with=9",
-                "Accept": "application/vnd.elasticsearch+json; compatible-with=9"
-            },
-            body={
-                "input": prompt
-            }
-        )
-
-        response = response.body
 
-        # Extract model output safely (Elastic completion format)
-        if "completion" in response and len(response["completion"]) > 0:
-            result_text = response["completion"][0].get("result", "")
+def describe_attack_chain(chain, max_steps=20):
+    """Plain-text outline of the incident's attack chain for the LLM."""
+    if not chain or chain.get("incident_count", 1) < 2:
+        return "No other incidents share this incident's source IP, user or resource."
 
-            # Remove ```json markdown formatting if present
-            cleaned = result_text.strip()
-            if cleaned.startswith("```"):
-                cleaned = cleaned.replace("```json", "").replace("```", "").strip()
+    lines = [
+        f"{chain['incident_count']} linked incidents from {chain['first_seen']} to {chain['last_seen']}",
+        f"Source IPs: {', '.join(chain.get('source_ips', [])) or 'None'}",
+        f"Users: {', '.join(chain.get('users', [])) or 'None'}",
+        f"Resources: {', '.join(chain.get('resources', [])) or 'None'}",
+        f"Tactics in order: {' -> '.join(chain.get('tactics', [])) or 'Unknown'}",
+        "Steps:"
+    ]
 
-            return cleaned
+    steps = chain.get("steps", [])
+    for position, step in enumerate(steps[-max_steps:], start=max(1, len(steps) - max_steps + 1)):
+        linked = f" (linked by {', '.join(step['linked_by'])})" if step.get("linked_by") else ""
+        lines.append(
+            f"  {position}. {step['timestamp']} {step.get('threat_type')} "
+            f"[{step.get('tactic') or 'Unknown tactic'}] risk {step.get('risk_score')}{linked}"
+        )
 
-        return json.dumps({
-            "error": "No completion returned from inference endpoint",
-            "raw_response": response
-        })
+    return "\n".join(lines)
 
-    except Exception as e:
-        return json.dumps({"error": str(e)})
 
-def generate_deep_investigation(incident):
-    prompt = f"""
+def build_deep_investigation_prompt(incident):
+    return f"""
 You are a Level 2 SOC (Security Operations Center) AI analyst.
 Perform a Deep AI Re-Investigation for this incident:
 
@@ -86,9 +73,12 @@ Repeat Offender: {incident.get("repeat_offender", False)}
 Occurrence Count: {incident.get("occurrence_count", 1)}
 MITRE Tactics/Techniques: {str(incident.get("mitre", "None"))}
 
+Correlated Attack Chain:
+{describe_attack_chain(incident.get("attack_chain"))}
+
 Provide:
 1. Expanded technical analysis
-2. Potential attack chain progression
+2. Attack chain progression (use the correlated chain above)
 3. Recommended containment strategy
 4. Risk if ignored
 
@@ -100,40 +90,40 @@ Respond strictly in valid JSON format:
   "risk_if_ignored": "..."
 }}
 """
-    try:
-        response = es.perform_request(
-            "POST",
-            f"/_inference/{INFERENCE_ID}",
-            headers={
-                "Content-Type": "application/vnd.elasticsearch+json; compatible-with=9",
-                "Accept": "application/vnd.elasticsearch+json; compatible-with=9"
-            },
-            body={"input": prompt}
-        )
-        response = response.body
-        if "completion" in response and len(response["completion"]) > 0:
-            result_text = response["completion"][0].get("result", "")
-            cleaned = result_text.strip()
-            if cleaned.startswith("```"):
-                cleaned = cleaned.replace("```json", "").replace("```", "").strip()
-            return dict(json.loads(cleaned))
-            
-        return {
-            "summary": "Deep investigation failed: No completion returned.",
-            "attack_path_analysis": "N/A",
-            "containment_strategy": "N/A",
-            "risk_if_ignored": "N/A"
-        }
-    except Exception as e:
-        return {
-            "summary": f"Deep investigation failed due to error: {str(e)}",
-            "attack_path_analysis": "N/A",
-            "containment_strategy": "N/A",
-            "risk_if_ignored": "N/A"
-        }
 
-def generate_closure_report(incident):
-    prompt = f"""
+
+def build_packed_analysis_prompt(threats):
+    """Several small analysis prompts in one request, answered as a JSON array."""
+    listing = "\n".join(
+        f"{position}. Threat Type: {threat.get('type')}, Risk Score: {threat.get('risk_score')}"
+        for position, threat in enumerate(threats, start=1)
+    )
+    return f"""
+You are an expert SOC (Security Operations Center) AI analyst.
+
+Analyze each of these {len(threats)} threats independently:
+{listing}
+
+For each threat provide:
+1. Threat summary
+2. Business/Security impact
+3. Recommended remediation steps
+4. Severity level (Low/Medium/High/Critical)
+
+Respond strictly with a valid JSON array of exactly {len(threats)} objects, in the same order as the threats:
+[
+  {{
+    "summary": "...",
+    "impact": "...",
+    "remediation": ["step1", "step2"],
+    "severity": "High"
+  }}
+]
+"""
+
+
+def build_closure_prompt(incident):
+    return f"""
 You are a Level 3 SOC (Security Operations Center) Lead closing an incident.
 Provide a final executive closure report for this incident:
 
@@ -156,39 +146,324 @@ Respond strictly in valid JSON format:
   "lessons_learned": "..."
 }}
 """
-    from datetime import datetime, timezone
+
+
+# ========================
+# INFERENCE CALLS
+# ========================
+
+def complete(prompt, kind="analysis"):
+    """Completion for `prompt`, served from the LLM cache when possible."""
+    return cached_completion(INFERENCE_ID, prompt, lambda: inference_client.request(prompt, kind))
+
+
+async def complete_async(async_es, prompt, kind="analysis"):
+    return await cached_completion_async(
+        INFERENCE_ID, prompt, lambda: inference_client.request_async(async_es, prompt, kind)
+    )
+
+
+# ========================
+# RESULT PARSING & FALLBACKS
+# ========================
+
+def parse_analysis(response):
+    cleaned = extract_completion(response)
+    if cleaned is not None:
+        return cleaned
+
+    return json.dumps({
+        "error": "No completion returned from inference endpoint",
+        "raw_response": response
+    })
+
+
+def deep_investigation_fallback(reason):
+    return {
+        "summary": reason,
+        "attack_path_analysis": "N/A",
+        "containment_strategy": "N/A",
+        "risk_if_ignored": "N/A"
+    }
+
+
+def parse_deep_investigation(response):
+    cleaned = extract_completion(response)
+    if cleaned is not None:
+        return dict(json.loads(cleaned))
+
+    return deep_investigation_fallback("Deep investigation failed: No completion returned.")
+
+
+def closure_report_fallback(reason):
+    return {
+        "executive_summary": reason,
+        "response_actions_taken": "N/A",
+        "residual_risk": "N/A",
+        "lessons_learned": "N/A",
+        "generated_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+def parse_closure_report(response):
+    cleaned = extract_completion(response)
+    if cleaned is not None:
+        parsed_result = dict(json.loads(cleaned))
+        parsed_result["generated_at"] = datetime.now(timezone.utc).isoformat()
+        return parsed_result
+
+    return closure_report_fallback("Closure report generation failed: No completion returned.")
+
+
+# ========================
+# GENERATORS
+# ========================
+
+def generate_ai_analysis(threat):
     try:
-        response = es.perform_request(
-            "POST",
-            f"/_inference/{INFERENCE_ID}",
-            headers={
-                "Content-Type": "application/vnd.elasticsearch+json; compatible-with=9",
-                "Accept": "application/vnd.elasticsearch+json; compatible-with=9"
-            },
-            body={"input": prompt}
-        )
-        response = response.body
-        if "completion" in response and len(response["completion"]) > 0:
-            result_text = response["completion"][0].get("result", "")
-            cleaned = result_text.strip()
-            if cleaned.startswith("```"):
-                cleaned = cleaned.replace("```json", "").replace("```", "").strip()
-            parsed_result = dict(json.loads(cleaned))
-            parsed_result["generated_at"] = datetime.now(timezone.utc).isoformat()
-            return parsed_result
-            
-        return {
-            "executive_summary": "Closure report generation failed: No completion returned.",
-            "response_actions_taken": "N/A",
-            "residual_risk": "N/A",
-            "lessons_learned": "N/A",
-            "generated_at": datetime.now(timezone.utc).isoformat()
-        }
+        return parse_analysis(complete(build_analysis_prompt(threat)))
     except Exception as e:
-        return {
-            "executive_summary": f"Closure report generated failed due to error: {str(e)}",
-            "response_actions_taken": "N/A",
-            "residual_risk": "N/A",
-            "lessons_learned": "N/A",
-            "generated_at": datetime.now(timezone.utc).isoformat()
-        }
\ No newline at end of file
+        return json.dumps({"error": str(e)})
+
+
+def generate_deep_investigation(incident):
+    try:
+        response = complete(build_deep_investigation_prompt(incident), "deep_investigation")
+        return parse_deep_investigation(response)
+    except Exception as e:
+        return deep_investigation_fallback(f"Deep investigation failed due to error: {str(e)}")
+
+
+def generate_closure_report(incident):
+    try:
+        response = complete(build_closure_prompt(incident), "closure_report")
+        return parse_closure_report(response)
+    except Exception as e:
+        return closure_report_fallback(f"Closure report generated failed due to error: {str(e)}")
+
+
+# Async variants for the FastAPI backend: same prompts and fallbacks, but
+# the inference call awaits on an AsyncElasticsearch client instead of
+# blocking a worker thread for the whole generation.
+
+async def generate_ai_analysis_async(async_es, threat):
+    try:
+        return parse_analysis(await complete_async(async_es, build_analysis_prompt(threat)))
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+async def generate_deep_investigation_async(async_es, incident):
+    try:
+        response = await complete_async(async_es, build_deep_investigation_prompt(incident), "deep_investigation")
+        return parse_deep_investigation(response)
+    except Exception as e:
+        return deep_investigation_fallback(f"Deep investigation failed due to error: {str(e)}")
+
+
+async def generate_closure_report_async(async_es, incident):
+    try:
+        response = await complete_async(async_es, build_closure_prompt(incident), "closure_report")
+        return parse_closure_report(response)
+    except Exception as e:
+        return closure_report_fallback(f"Closure report generated failed due to error: {str(e)}")
+
+
+# ========================
+# STREAMING GENERATORS
+# ========================
+#
+# Output is handed to `on_delta(text)` as the model produces it. Cached
+# prompts, and streams that fail before their first piece (no streaming
+# support on the endpoint, a dropped connection), are answered by a
+# regular completion replayed in STREAM_CHUNK_CHARS pieces, so consumers
+# see the same shape either way.
+
+STREAM_CHUNK_CHARS = 64
+
+
+async def stream_completion_async(async_es, prompt, kind, on_delta):
+    """Full completion text for `prompt`; pieces go to on_delta on the way."""
+    response = await llm_cache.get_async(INFERENCE_ID, prompt) if cache_enabled() else None
+
+    if response is None:
+        received = []
+        started = time.perf_counter()
+        try:
+            async for text in inference_client.stream_async(prompt, kind):
+                received.append(text)
+                on_delta(text)
+        except Exception as e:
+            if received:
+                raise
+            print(f"⚠️ Streaming completion unavailable, using a full completion: {e}")
+            response = await complete_async(async_es, prompt, kind)
+        else:
+            text = "".join(received)
+            if cache_enabled():
+                await llm_cache.put_async(
+                    INFERENCE_ID, prompt, {"completion": [{"result": text}]},
+                    (time.perf_counter() - started) * 1000
+                )
+            return text
+
+    text = (response.get("completion") or [{}])[0].get("result", "")
+    for i in range(0, len(text), STREAM_CHUNK_CHARS):
+        on_delta(text[i:i + STREAM_CHUNK_CHARS])
+    return text
+
+
+# ========================
+# REPORT JOB GENERATORS
+# ========================
+#
+# Background report jobs must know when generation failed: unlike the
+# generators above, these raise instead of returning fallback payloads,
+# so the job is marked failed (and can be retried) rather than saving a
+# placeholder as the report. A completion that is not a JSON object is
+# dropped from the LLM cache so a retry asks the model again.
+
+async def load_report_async(prompt, response):
+    """The JSON object in a completion; raises ValueError if there is none."""
+    cleaned = extract_completion(response)
+    if not cleaned:
+        raise ValueError("No completion returned from inference endpoint")
+
+    try:
+        report = json.loads(cleaned)
+        if not isinstance(report, dict):
+            raise ValueError("Completion is not a JSON object")
+    except ValueError:
+        await llm_cache.discard_async(INFERENCE_ID, prompt)
+        raise
+    return report
+
+
+async def deep_investigation_report_async(async_es, incident, on_delta):
+    """Deep investigation through the streaming API; raises on failure."""
+    prompt = build_deep_investigation_prompt(incident)
+    text = await stream_completion_async(async_es, prompt, "deep_investigation", on_delta)
+    return await load_report_async(prompt, {"completion": [{"result": text}]})
+
+
+async def closure_report_async(async_es, incident):
+    """Closure report; raises on failure."""
+    prompt = build_closure_prompt(incident)
+    report = await load_report_async(prompt, await complete_async(async_es, prompt, "closure_report"))
+    report["generated_at"] = datetime.now(timezone.utc).isoformat()
+    return report
+
+
+# ========================
+# BATCH GENERATORS
+# ========================
+#
+# Many threats at once: cached prompts are answered from the LLM cache,
+# identical prompts are sent once, small analysis prompts are packed
+# PACK_SIZE to a request, and the rest fan out through a BatchRunner
+# (concurrency limit, token bucket, deadlines, jittered retries).
+# Results are returned in input order.
+
+PACK_SIZE = 8
+
+
+def unpack_analyses(response, count):
+    """The `count` analyses of a packed response as JSON strings, or None."""
+    cleaned = extract_completion(response)
+    if cleaned is None:
+        return None
+    try:
+        items = json.loads(cleaned)
+    except ValueError:
+        return None
+    if not isinstance(items, list) or len(items) != count or not all(isinstance(i, dict) for i in items):
+        return None
+    return [json.dumps(item) for item in items]
+
+
+def inference_runner(async_es, kind, packed=(), **options):
+    # Single attempts: the runner retries, with backoff and the shared budget
+    def call(prompt):
+        call_kind = "packed_analysis" if prompt in packed else kind
+        return inference_client.request_async(async_es, prompt, call_kind, max_attempts=1)
+
+    return BatchRunner(call, **options)
+
+
+async def split_cached(prompts):
+    """({prompt: cached response}, [unique prompts still to request])"""
+    found, missing = {}, []
+    for prompt in dict.fromkeys(prompts):
+        cached = await llm_cache.get_async(INFERENCE_ID, prompt) if cache_enabled() else None
+        if cached is None:
+            missing.append(prompt)
+        else:
+            found[prompt] = cached
+    return found, missing
+
+
+async def request_each(runner, prompts, responses):
+    for prompt, outcome in zip(prompts, await runner.complete_all(prompts)):
+        responses[prompt] = outcome
+        if not isinstance(outcome, Exception) and cache_enabled():
+            await llm_cache.put_async(INFERENCE_ID, prompt, outcome, runner.latency_ms.get(prompt, 0))
+
+
+async def generate_ai_analysis_batch_async(async_es, threats, pack_size=PACK_SIZE, **options):
+    prompts = [build_analysis_prompt(threat) for threat in threats]
+    threat_for = dict(zip(prompts, threats))
+    responses, missing = await split_cached(prompts)
+    cached = len(responses)
+
+    packs = [missing[i:i + pack_size] for i in range(0, len(missing), pack_size)] if pack_size > 1 else []
+    packs = [pack for pack in packs if len(pack) > 1]
+    packed_prompts = [build_packed_analysis_prompt([threat_for[p] for p in pack]) for pack in packs]
+    runner = inference_runner(async_es, "analysis", set(packed_prompts), **options)
+
+    if packs:
+        unpacked = set()
+
+        for pack, packed_prompt, outcome in zip(packs, packed_prompts, await runner.complete_all(packed_prompts)):
+            items = None if isinstance(outcome, Exception) else unpack_analyses(outcome, len(pack))
+            if items is None:
+                continue
+
+            share_ms = runner.latency_ms.get(packed_prompt, 0) / len(pack)
+            for prompt, item in zip(pack, items):
+                responses[prompt] = {"completion": [{"result": item}]}
+                unpacked.add(prompt)
+                if cache_enabled():
+                    await llm_cache.put_async(INFERENCE_ID, prompt, responses[prompt], share_ms)
+
+        # Packs that failed or came back malformed are retried one by one
+        missing = [prompt for prompt in missing if prompt not in unpacked]
+
+    await request_each(runner, missing, responses)
+
+    print(
+        f"🤖 {len(threats)} AI analyses: {cached} cached, {len(packs)} packed requests, "
+        f"{len(missing)} single requests, {runner.stats()}"
+    )
+
+    results = []
+    for prompt in prompts:
+        outcome = responses[prompt]
+        if isinstance(outcome, Exception):
+            results.append(json.dumps({"error": str(outcome)}))
+        else:
+            results.append(parse_analysis(outcome))
+    return results
+
+
+def _run_batch(generator, items, **options):
+    """Run a batch generator from blocking code on its own event loop and client."""
+    async def run():
+        async with open_async_client("inference") as async_es:
+            return await generator(async_es, items, **options)
+
+    return asyncio.run(run())
+
+
+def generate_ai_analysis_batch(threats, **options):
+    return _run_batch(generate_ai_analysis_batch_async, threats, **options) if threats else []
+
@@ -9,21 +9,15 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from incident_commander import run_incident_commander
-from elasticsearch import Elasticsearch
-import os
+from backend.incident_service import get_metrics
+from es_client import get_client
 
 # ==============================
 # CONFIG (Uses Environment Variables)
 # ==============================
 
-ELASTIC_CLOUD_ID = os.getenv("ELASTIC_CLOUD_ID")
-USERNAME = os.getenv("ELASTIC_USERNAME", "elastic")
-PASSWORD = os.getenv("ELASTIC_PASSWORD")
-
-es = Elasticsearch(
-    cloud_id=ELASTIC_CLOUD_ID,
-    basic_auth=(USERNAME, PASSWORD)
-)
+# Shared client: survives Streamlit reruns instead of reconnecting each time
+es = get_client()
 
 # ==============================
 # PAGE CONFIG
@@ -42,25 +36,12 @@ st.markdown("## 📊 SOC Overview")
 
 col_a, col_b, col_c = st.columns(3)
 
-total_incidents = es.count(index="incidents")["count"]
-
-high_risk_query = {
-    "query": {
-        "term": {"severity": "HIGH"}
-    }
-}
-high_risk_count = es.count(index="incidents", body=high_risk_query)["count"]
-
-critical_risk_query = {
-    "query": {
-        "term": {"severity": "CRITICAL"}
-    }
-}
-critical_count = es.count(index="incidents", body=critical_risk_query)["count"]
-
-col_a.metric("Total Incidents", total_incidents)
-col_b.metric("High Severity", high_risk_count)
-col_c.metric("Critical Severity", critical_count)
+# Shared with the API's /metrics: one aggregation, cached for a few seconds
+metrics = get_metrics(es)
+
+col_a.metric("Total Incidents", metrics["total_incidents"])
+col_b.metric("High Severity", metrics["high_severity"])
+col_c.metric("Critical Severity", metrics["critical_severity"])
 
 st.markdown("---")
 
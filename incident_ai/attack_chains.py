@@ -0,0 +1,451 @@
+import argparse
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+
+from elasticsearch import NotFoundError
+
+from es_client import get_client
+
+# ========================
+# ATTACK-CHAIN CORRELATION
+# ========================
+#
+# Incidents that share a source_ip, user or resource (a service, for
+# service health incidents) within CHAIN_WINDOW_SECONDS of each other are
+# linked into one attack chain. Links are transitive, so the chains are the
+# connected components of the incident/entity graph, kept by an incremental
+# union-find: each saved incident looks up the chains its entities were last
+# seen in, merges them (the oldest chain keeps its id) and joins the result.
+# Incidents carry their events' first_seen/last_seen, so events reach a
+# chain through the incidents that summarise them.
+#
+# Every chain is one document in `attack-chains` listing its incidents,
+# entities and ordered steps, so "which chain is this incident in?" is a
+# single term lookup. Merged-away chains are deleted in the same `_bulk`.
+# The in-memory index covers recently active chains, is warmed from ES on
+# first use and re-read every RESYNC_SECONDS to pick up other writers.
+
+CHAINS_INDEX = "attack-chains"
+INCIDENTS_INDEX = "incidents"
+
+CHAIN_WINDOW_SECONDS = 2 * 60 * 60
+
+# Entities seen in more incidents than this (a shared NAT address, a
+# service account) would fold unrelated activity into one chain, so they
+# stop linking once a chain reaches this size
+MAX_CHAIN_INCIDENTS = 500
+
+# Entity fields that link incidents, and the chain field listing them
+LINK_FIELDS = {
+    "source_ip": "source_ips",
+    "user": "users",
+    "resource": "resources",
+    "service": "resources"
+}
+
+IGNORED_VALUES = {"", "unknown", "n/a", "none"}
+
+RESYNC_SECONDS = 5 * 60
+WARM_LIMIT = 5000
+REBUILD_PAGE_SIZE = 1000
+
+SEVERITY_ORDER = ["LOW", "MEDIUM", "HIGH", "CRITICAL"]
+
+
+def to_epoch(timestamp):
+    if not timestamp:
+        return time.time()
+    parsed = datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def incident_span(incident):
+    """Epoch (start, end) of the activity behind an incident."""
+    start = incident.get("first_seen") or incident.get("@timestamp") or incident.get("created_at")
+    end = incident.get("last_seen") or start
+    return to_epoch(start), to_epoch(end)
+
+
+def entity_keys(incident):
+    keys = []
+    for field in LINK_FIELDS:
+        value = incident.get(field)
+        if value is not None and str(value).strip().lower() not in IGNORED_VALUES:
+            keys.append((field, str(value)))
+    return keys
+
+
+def higher_severity(a, b):
+    rank = {severity: i for i, severity in enumerate(SEVERITY_ORDER)}
+    return a if rank.get(a, -1) >= rank.get(b, -1) else b
+
+
+def new_step(incident, start, links):
+    mitre = incident.get("mitre") or {}
+    step = {
+        "incident_id": incident["incident_id"],
+        "timestamp": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+        "threat_type": incident.get("threat_type"),
+        "severity": incident.get("severity"),
+        "risk_score": incident.get("risk_score"),
+        "tactic": mitre.get("tactic"),
+        "technique": mitre.get("technique"),
+        "linked_by": [f"{field}={value}" for field, value in links]
+    }
+    for field in LINK_FIELDS:
+        if incident.get(field) is not None:
+            step[field] = incident[field]
+    return step
+
+
+class ChainIndex:
+    """
+    Union-find over chain ids. `_parent` maps every chain id ever merged to
+    its parent (roots map to themselves), `_chains` holds the document of
+    each root, and `_entities` maps (field, value) -> (chain id, epoch the
+    entity was last seen).
+    """
+
+    def __init__(self, window_seconds=CHAIN_WINDOW_SECONDS, max_incidents=MAX_CHAIN_INCIDENTS):
+        self.window_seconds = window_seconds
+        self.max_incidents = max_incidents
+        self._parent = {}
+        self._chains = {}
+        self._entities = {}
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self.latest = 0
+        self.warmed_at = None
+        self.merges = 0
+        self.hub_links_skipped = 0
+        self.adds_since_sweep = 0
+
+    # ---------- union-find ----------
+
+    def _find(self, chain_id):
+        root = chain_id
+        while self._parent[root] != root:
+            root = self._parent[root]
+        # Path compression
+        while self._parent[chain_id] != root:
+            self._parent[chain_id], chain_id = root, self._parent[chain_id]
+        return root
+
+    def _merge(self, survivor, absorbed):
+        chain = self._chains[survivor]
+        other = self._chains.pop(absorbed)
+        self._parent[absorbed] = survivor
+
+        chain["incident_ids"].extend(other["incident_ids"])
+        chain["steps"] = sorted(chain["steps"] + other["steps"], key=lambda step: step["timestamp"])
+        for field in set(LINK_FIELDS.values()):
+            chain[field] = sorted(set(chain[field]) | set(other[field]))
+        chain["first_seen"] = min(chain["first_seen"], other["first_seen"])
+        chain["last_seen"] = max(chain["last_seen"], other["last_seen"])
+        chain["max_risk_score"] = max(chain["max_risk_score"], other["max_risk_score"])
+        chain["severity"] = higher_severity(chain["severity"], other["severity"])
+        self.merges += 1
+
+    # ---------- updates ----------
+
+    def add(self, incident):
+        """
+        Link one saved incident (with `incident_id`) into its chain.
+        Returns (chain id, ids of chains merged into it).
+        """
+        start, end = incident_span(incident)
+        keys = entity_keys(incident)
+
+        with self._lock:
+            if incident["incident_id"] in self._parent:
+                # Already linked (a retried write)
+                return self._find(incident["incident_id"]), []
+
+            self.latest = max(self.latest, end)
+
+            links = []
+            candidates = {}
+            for key in keys:
+                seen = self._entities.get(key)
+                if seen is None or seen[1] < start - self.window_seconds:
+                    continue
+                root = self._find(seen[0])
+                if len(self._chains[root]["incident_ids"]) >= self.max_incidents:
+                    self.hub_links_skipped += 1
+                    continue
+                candidates[root] = self._chains[root]
+                links.append(key)
+
+            chain_id = incident["incident_id"]
+            self._parent[chain_id] = chain_id
+            self._chains[chain_id] = {
+                "chain_id": chain_id,
+                "incident_ids": [chain_id],
+                "steps": [new_step(incident, start, links)],
+                "source_ips": [],
+                "users": [],
+                "resources": [],
+                "first_seen": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                "last_seen": datetime.fromtimestamp(end, timezone.utc).isoformat(),
+                "max_risk_score": incident.get("risk_score") or 0,
+                "severity": incident.get("severity")
+            }
+            for field, value in keys:
+                self._chains[chain_id][LINK_FIELDS[field]].append(value)
+
+            absorbed = []
+            if candidates:
+                # The oldest chain keeps its id, so existing links stay valid
+                survivor = min(candidates, key=lambda root: (candidates[root]["first_seen"], root))
+                for root in list(candidates) + [chain_id]:
+                    if root != survivor:
+                        self._merge(survivor, root)
+                        if root != chain_id:
+                            absorbed.append(root)
+                chain_id = survivor
+
+            for key in keys:
+                seen = self._entities.get(key)
+                self._entities[key] = (chain_id, max(end, seen[1]) if seen else end)
+
+            chain = self._chains[chain_id]
+            chain["incident_count"] = len(chain["incident_ids"])
+            chain["threat_types"] = sorted({step["threat_type"] for step in chain["steps"] if step["threat_type"]})
+            chain["tactics"] = list(dict.fromkeys(step["tactic"] for step in chain["steps"] if step["tactic"]))
+
+            self.adds_since_sweep += 1
+            if self.adds_since_sweep >= 1000:
+                self._sweep()
+
+            return chain_id, absorbed
+
+    def _sweep(self):
+        """Forget chains and entities idle for longer than the window."""
+        cutoff = self.latest - self.window_seconds
+        self._entities = {key: seen for key, seen in self._entities.items() if seen[1] >= cutoff}
+
+        live = {self._find(chain_id) for chain_id, _ in self._entities.values()}
+        self._parent = {
+            chain_id: self._find(chain_id)
+            for chain_id in self._parent
+            if self._find(chain_id) in live
+        }
+        self._chains = {root: chain for root, chain in self._chains.items() if root in live}
+        self.adds_since_sweep = 0
+
+    def chain(self, chain_id):
+        with self._lock:
+            if chain_id not in self._parent:
+                return None
+            return self._chains.get(self._find(chain_id))
+
+    # ---------- ES synchronisation ----------
+
+    def flush(self, es, chain_ids, absorbed):
+        """Write the given chains and delete merged-away ones in one `_bulk`."""
+        now = datetime.now(timezone.utc).isoformat()
+        operations = []
+
+        with self._lock:
+            for chain_id in dict.fromkeys(chain_ids):
+                document = dict(self._chains[self._find(chain_id)], updated_at=now)
+                operations.append({"index": {"_index": CHAINS_INDEX, "_id": document["chain_id"]}})
+                operations.append(document)
+
+        for chain_id in dict.fromkeys(absorbed):
+            operations.append({"delete": {"_index": CHAINS_INDEX, "_id": chain_id}})
+
+        if operations:
+            # Wait for the refresh so lookups and other writers' resyncs see it
+            es.bulk(operations=operations, refresh="wait_for")
+
+    def warm(self, es):
+        since = (datetime.now(timezone.utc) - timedelta(seconds=self.window_seconds)).isoformat()
+        try:
+            response = es.search(
+                index=CHAINS_INDEX,
+                query={"range": {"last_seen": {"gte": since}}},
+                sort=[{"last_seen": {"order": "desc"}}],
+                size=WARM_LIMIT
+            )
+            hits = response["hits"]["hits"]
+        except NotFoundError:
+            hits = []
+
+        parent, chains, entities = {}, {}, {}
+        latest = 0
+        for hit in reversed(hits):
+            chain = hit["_source"]
+            chain_id = chain["chain_id"]
+            chains[chain_id] = chain
+            for incident_id in chain["incident_ids"]:
+                parent[incident_id] = chain_id
+            parent[chain_id] = chain_id
+
+            for step in chain["steps"]:
+                step_time = to_epoch(step["timestamp"])
+                latest = max(latest, step_time)
+                for key in entity_keys(step):
+                    seen = entities.get(key)
+                    if seen is None or seen[1] <= step_time:
+                        entities[key] = (chain_id, step_time)
+            latest = max(latest, to_epoch(chain["last_seen"]))
+
+        with self._lock:
+            self._parent, self._chains, self._entities = parent, chains, entities
+            self.latest = max(self.latest, latest)
+            self.warmed_at = time.time()
+
+        print(f"🔗 Attack-chain index warmed with {len(chains)} active chains")
+
+    def ensure_warm(self, es):
+        if self.warmed_at is not None and time.time() - self.warmed_at < RESYNC_SECONDS:
+            return
+
+        with self._warm_lock:
+            if self.warmed_at is None or time.time() - self.warmed_at >= RESYNC_SECONDS:
+                self.warm(es)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active_chains": len(self._chains),
+                "tracked_entities": len(self._entities),
+                "merges": self.merges,
+                "hub_links_skipped": self.hub_links_skipped,
+                "warmed_at": self.warmed_at
+            }
+
+
+chain_index = ChainIndex()
+
+
+def record_incidents(es, incidents):
+    """
+    Link freshly saved incidents into chains and persist the touched chains.
+    Correlation is best effort: a failure here never fails the incident write.
+    """
+    incidents = [incident for incident in incidents if incident.get("incident_id")]
+    if not incidents:
+        return
+
+    try:
+        chain_index.ensure_warm(es)
+        touched, absorbed = [], []
+        for incident in incidents:
+            chain_id, merged = chain_index.add(incident)
+            touched.append(chain_id)
+            absorbed.extend(merged)
+        chain_index.flush(es, touched, absorbed)
+    except Exception as e:
+        print(f"⚠️ Attack-chain correlation failed: {e}")
+
+
+# ========================
+# LOOKUPS
+# ========================
+
+def chain_query(incident_id):
+    return {"term": {"incident_ids": incident_id}}
+
+
+def get_chain(es, incident_id):
+    try:
+        hits = es.search(index=CHAINS_INDEX, query=chain_query(incident_id), size=1)["hits"]["hits"]
+    except NotFoundError:
+        return None
+    return hits[0]["_source"] if hits else None
+
+
+async def get_chain_async(es, incident_id):
+    try:
+        response = await es.search(index=CHAINS_INDEX, query=chain_query(incident_id), size=1)
+    except NotFoundError:
+        return None
+    hits = response["hits"]["hits"]
+    return hits[0]["_source"] if hits else None
+
+
+# ========================
+# REBUILD
+# ========================
+
+def rebuild(es, hours=24):
+    """Recompute every chain from the incidents of the last `hours`."""
+    since = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
+    started = time.perf_counter()
+
+    try:
+        es.delete_by_query(index=CHAINS_INDEX, query={"match_all": {}}, refresh=True)
+    except NotFoundError:
+        pass
+
+    index = ChainIndex()
+    index.warmed_at = time.time()
+
+    pit = es.open_point_in_time(index=INCIDENTS_INDEX, keep_alive="2m")["id"]
+    search_after = None
+    incidents = 0
+
+    try:
+        while True:
+            response = es.search(
+                pit={"id": pit, "keep_alive": "2m"},
+                query={"range": {"@timestamp": {"gte": since}}},
+                sort=[{"@timestamp": "asc"}, {"_shard_doc": "asc"}],
+                size=REBUILD_PAGE_SIZE,
+                search_after=search_after
+            )
+            pit = response.get("pit_id", pit)
+            hits = response["hits"]["hits"]
+            if not hits:
+                break
+
+            for hit in hits:
+                index.add(dict(hit["_source"], incident_id=hit["_id"]))
+            incidents += len(hits)
+            search_after = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit)
+
+    roots = list(index._chains)
+    for i in range(0, len(roots), REBUILD_PAGE_SIZE):
+        index.flush(es, roots[i:i + REBUILD_PAGE_SIZE], [])
+
+    chain_index.warmed_at = None
+    elapsed = time.perf_counter() - started
+    print(f"✅ {incidents} incidents → {len(roots)} attack chains in {elapsed:.2f}s ({index.merges} merges)")
+    return {"incidents": incidents, "chains": len(roots), "merges": index.merges}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rebuild or inspect attack chains")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute chains from recent incidents")
+    parser.add_argument("--hours", type=int, default=24, help="Incidents to include in a rebuild")
+    parser.add_argument("--incident", help="Print the chain of this incident")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    es = get_client("detection")
+
+    if args.rebuild:
+        rebuild(es, args.hours)
+
+    if args.incident:
+        chain = get_chain(es, args.incident)
+        if chain is None:
+            print(f"ℹ️ Incident {args.incident} is not part of any chain")
+        else:
+            print(f"🔗 Chain {chain['chain_id']}: {chain['incident_count']} incidents, "
+                  f"{chain['first_seen']} → {chain['last_seen']}")
+            for step in chain["steps"]:
+                print(f"   {step['timestamp']} {step['threat_type']} ({', '.join(step['linked_by']) or 'first'})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,280 @@
+import base64
+import json
+
 from elasticsearch import NotFoundError
 
-def get_all_incidents(es):
+from query_cache import incidents_cache, metrics_cache
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Point-in-time kept open between page requests of one listing
+PIT_KEEP_ALIVE = "1m"
+
+# `fields=summary` projection for list views: skips the large AI payloads
+SUMMARY_FIELDS = [
+    "@timestamp",
+    "created_at",
+    "updated_at",
+    "status",
+    "incident_stage",
+    "threat_type",
+    "source_ip",
+    "user",
+    "risk_score",
+    "severity",
+    "repeat_offender",
+    "occurrence_count",
+    "mitre"
+]
+
+FILTER_FIELDS = {
+    "severity": "severity",
+    "stage": "incident_stage",
+    "threat_type": "threat_type",
+    "source_ip": "source_ip"
+}
+
+CURSOR_KEYS = {"pit_id", "search_after", "params", "size", "fields"}
+
+# Listing parameters a cursor may carry (see build_incident_filters)
+CURSOR_PARAMS = set(FILTER_FIELDS) | {"start", "end"}
+
+class InvalidCursor(ValueError):
+    pass
+
+class CursorExpired(Exception):
+    pass
+
+def encode_cursor(state):
+    raw = json.dumps(state, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise InvalidCursor("Malformed cursor.")
+
+    if not isinstance(state, dict) or not CURSOR_KEYS <= state.keys():
+        raise InvalidCursor("Malformed cursor.")
+
+    # Cursors come back from clients: check every field before it reaches
+    # a query, and never let one raise the page size past MAX_PAGE_SIZE
+    params, size, fields = state["params"], state["size"], state["fields"]
+
+    if not isinstance(state["pit_id"], str) or not isinstance(state["search_after"], (list, type(None))):
+        raise InvalidCursor("Malformed cursor.")
+    if not isinstance(params, dict) or not params.keys() <= CURSOR_PARAMS \
+            or not all(isinstance(value, str) for value in params.values()):
+        raise InvalidCursor("Malformed cursor.")
+    if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+        raise InvalidCursor("Malformed cursor.")
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+        raise InvalidCursor("Malformed cursor.")
+
+    state["size"] = min(size, MAX_PAGE_SIZE)
+    return state
+
+def parse_fields(fields):
+    if not fields:
+        return None
+    if fields == "summary":
+        return SUMMARY_FIELDS
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+def build_incident_filters(params):
+    """
+    Translate listing parameters (severity, stage, threat_type, source_ip,
+    start, end) into filter clauses. Cursors store the parameters, not the
+    clauses, so clients can never inject arbitrary queries.
+    """
+    filters = []
+
+    for param, field in FILTER_FIELDS.items():
+        if params.get(param):
+            filters.append({"term": {field: params[param]}})
+
+    if params.get("start") or params.get("end"):
+        time_range = {}
+        if params.get("start"):
+            time_range["gte"] = params["start"]
+        if params.get("end"):
+            time_range["lte"] = params["end"]
+        filters.append({"range": {"@timestamp": time_range}})
+
+    return filters
+
+async def _close_pit(es, pit_id):
+    try:
+        await es.close_point_in_time(id=pit_id)
+    except Exception as e:
+        # Best effort: an unclosed PIT still expires after PIT_KEEP_ALIVE
+        print(f"⚠️ Could not close point-in-time: {e}")
+
+async def _query_incidents(es, params, size, fields, cursor):
+    """
+    One page of incidents, newest first, using search_after on a
+    point-in-time so deep pages cost the same as the first one. The cursor
+    carries the PIT, the sort position and the original filters/projection.
+    """
+    if cursor:
+        state = decode_cursor(cursor)
+        params, size, fields = state["params"], state["size"], state["fields"]
+    else:
+        try:
+            pit = await es.open_point_in_time(index="incidents", keep_alive=PIT_KEEP_ALIVE)
+        except NotFoundError:
+            # If index doesn't exist yet, return empty list instead of crashing
+            return {"incidents": [], "next_cursor": None}
+        state = {"pit_id": pit["id"], "search_after": None}
+
+    request = {
+        "pit": {"id": state["pit_id"], "keep_alive": PIT_KEEP_ALIVE},
+        "query": {"bool": {"filter": build_incident_filters(params)}},
+        "sort": [{"@timestamp": {"order": "desc"}}],
+        "size": size,
+        "track_total_hits": False
+    }
+    if state["search_after"]:
+        request["search_after"] = state["search_after"]
+    if fields:
+        request["source"] = fields
+
     try:
-        response = es.search(
-            index="incidents",
-            size=20,
-            sort="@timestamp:desc"
-        )
-        hits = response["hits"]["hits"]
-
-        incidents = []
-        for hit in hits:
-            incident = hit["_source"]
-            incident["_id"] = hit["_id"]  # Attach Elasticsearch document ID
-            incidents.append(incident)
-
-        return incidents
+        response = await es.search(**request)
     except NotFoundError:
-        # If index doesn't exist yet, return empty list instead of crashing
-        return []
+        if not cursor:
+            await _close_pit(es, state["pit_id"])
+        raise CursorExpired("Cursor expired, restart the listing.")
+    except Exception:
+        if not cursor:
+            await _close_pit(es, state["pit_id"])
+        raise
 
-def get_metrics(es):
+    hits = response["hits"]["hits"]
+
+    incidents = []
+    for hit in hits:
+        incident = hit["_source"]
+        incident["_id"] = hit["_id"]  # Attach Elasticsearch document ID
+        incidents.append(incident)
+
+    pit_id = response.get("pit_id", state["pit_id"])
+    next_cursor = None
+    if len(hits) == size:
+        next_cursor = encode_cursor({
+            "pit_id": pit_id,
+            "search_after": hits[-1]["sort"],
+            "params": params,
+            "size": size,
+            "fields": fields
+        })
+    elif not cursor:
+        # Single-page listing: the PIT never left this request, so free it
+        # now. Once a cursor was handed out the PIT may be shared (pages
+        # are cached for every client), so it expires after keep-alive.
+        await _close_pit(es, pit_id)
+
+    return {"incidents": incidents, "next_cursor": next_cursor}
+
+async def get_all_incidents(es, params=None, size=DEFAULT_PAGE_SIZE, fields=None, cursor=None):
+    params = {key: value for key, value in (params or {}).items() if value}
+    size = max(1, min(size, MAX_PAGE_SIZE))
+    key = ("list", json.dumps(params, sort_keys=True), size, tuple(fields or ()), cursor)
+
+    return await incidents_cache.get_or_load_async(
+        key, lambda: _query_incidents(es, params, size, fields, cursor)
+    )
+
+async def _query_incident_detail(es, incident_id):
+    try:
+        hit = await get_incident(es, incident_id)
+    except NotFoundError:
+        return None
+
+    if hit is None:
+        return None
+
+    incident = hit["_source"]
+    incident["_id"] = hit["_id"]
+    return incident
+
+async def get_incident_detail(es, incident_id):
+    """Cached read of one incident for display. Writers must use get_incident."""
+    return await incidents_cache.get_or_load_async(
+        ("detail", incident_id), lambda: _query_incident_detail(es, incident_id)
+    )
+
+async def get_incident(es, incident_id):
+    """
+    Fetch one incident by ID. `incidents` is a data stream, which does not
+    support GET by ID, so search for it and keep the backing index and
+    sequence numbers needed to update it safely.
+    Returns None if the incident does not exist.
+    """
+    response = await es.search(
+        index="incidents",
+        query={"ids": {"values": [incident_id]}},
+        size=1,
+        seq_no_primary_term=True
+    )
+    hits = response["hits"]["hits"]
+
+    return hits[0] if hits else None
+
+# One request returns every counter the dashboards show
+METRICS_QUERY = {
+    "size": 0,
+    "track_total_hits": True,
+    "aggs": {
+        "by_severity": {"terms": {"field": "severity", "size": 10}},
+        "by_stage": {"terms": {"field": "incident_stage", "size": 10}},
+        "by_threat_type": {"terms": {"field": "threat_type", "size": 50}}
+    }
+}
+
+def _bucket_counts(aggregation):
+    return {bucket["key"]: bucket["doc_count"] for bucket in aggregation["buckets"]}
+
+EMPTY_METRICS = {
+    "total_incidents": 0,
+    "high_severity": 0,
+    "critical_severity": 0,
+    "by_severity": {},
+    "by_stage": {},
+    "by_threat_type": {}
+}
+
+def _parse_metrics(response):
+    aggs = response["aggregations"]
+    by_severity = _bucket_counts(aggs["by_severity"])
+
+    return {
+        "total_incidents": response["hits"]["total"]["value"],
+        "high_severity": by_severity.get("HIGH", 0),
+        "critical_severity": by_severity.get("CRITICAL", 0),
+        "by_severity": by_severity,
+        "by_stage": _bucket_counts(aggs["by_stage"]),
+        "by_threat_type": _bucket_counts(aggs["by_threat_type"])
+    }
+
+def _query_metrics(es):
     try:
-        total = es.count(index="incidents")["count"]
-
-        high_query = {
-            "query": {"match": {"severity": "HIGH"}}
-        }
-        high = es.count(index="incidents", body=high_query)["count"]
-
-        critical_query = {
-            "query": {"match": {"severity": "CRITICAL"}}
-        }
-        critical = es.count(index="incidents", body=critical_query)["count"]
-
-        return {
-            "total_incidents": total,
-            "high_severity": high,
-            "critical_severity": critical
-        }
+        return _parse_metrics(es.search(index="incidents", body=METRICS_QUERY))
     except NotFoundError:
         # If index doesn't exist yet, return zeroed metrics
-        return {
-            "total_incidents": 0,
-            "high_severity": 0,
-            "critical_severity": 0
-        }
\ No newline at end of file
+        return dict(EMPTY_METRICS)
+
+async def _query_metrics_async(es):
+    try:
+        return _parse_metrics(await es.search(index="incidents", body=METRICS_QUERY))
+    except NotFoundError:
+        return dict(EMPTY_METRICS)
+
+def get_metrics(es):
+    """Blocking variant for the Streamlit dashboard."""
+    return metrics_cache.get_or_load("metrics", lambda: _query_metrics(es))
+
+async def get_metrics_async(es):
+    return await metrics_cache.get_or_load_async("metrics", lambda: _query_metrics_async(es))
@@ -1,18 +1,63 @@
-from fastapi import FastAPI
-from dotenv import load_dotenv
-import os
-from elasticsearch import Elasticsearch
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from incident_service import get_all_incidents, get_metrics
-from elasticsearch import NotFoundError
+from fastapi import FastAPI, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from incident_service import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    CursorExpired,
+    InvalidCursor,
+    get_all_incidents,
+    get_incident,
+    get_incident_detail,
+    get_metrics_async,
+    parse_fields
+)
+from elasticsearch import BadRequestError, ConflictError, NotFoundError
 from fastapi import HTTPException
-from incident_commander import run_incident_commander
 from fastapi.middleware.cors import CORSMiddleware
-from ai_reasoner import generate_deep_investigation, generate_closure_report
+from query_cache import incidents_cache, invalidate_incident_views
+from es_client import close_async_clients, close_clients, get_async_client, get_client
+from correlation_store import occurrence_store
+from attack_chains import chain_index, get_chain_async
+from llm_cache import llm_cache
+from inference_client import inference_client
+from detection_service import detection_service, scheduler_enabled
+from rule_engine import RuleError, describe_plans, rule_detectors
+from report_jobs import JOB_KINDS, job_for_transition, pending_job, report_jobs
+
+# Routes await ES and inference calls on shared async clients, so one
+# worker keeps serving /incidents and /metrics while LLM generations run.
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warm dedup/occurrence state once; detection retries lazily on failure
+    try:
+        await run_in_threadpool(occurrence_store.warm, get_client("detection"))
+    except Exception as e:
+        print(f"⚠️ Correlation store warm-up failed: {e}")
+
+    if scheduler_enabled():
+        detection_service.start()
+
+    await report_jobs.start()
+
+    yield
 
-load_dotenv()
+    # Let in-progress detector runs finish before closing their clients;
+    # unfinished report jobs stay pending on their incidents
+    await report_jobs.stop()
+    await run_in_threadpool(detection_service.stop)
+    await inference_client.aclose()
+    await close_async_clients()
+    close_clients()
 
-app = FastAPI(title="Incident AI Backend")
+app = FastAPI(title="Incident AI Backend", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -21,36 +66,247 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-ELASTIC_CLOUD_ID = os.getenv("ELASTIC_CLOUD_ID")
-ELASTIC_USERNAME = os.getenv("ELASTIC_USERNAME", "elastic")
-ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD")
-
-es = Elasticsearch(
-    cloud_id=ELASTIC_CLOUD_ID,
-    basic_auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD)
-)
-
 @app.get("/")
-def root():
+async def root():
     return {"status": "Backend Running"}
 
 @app.get("/incidents")
-def fetch_incidents():
-    return get_all_incidents(es)
+async def fetch_incidents(
+    severity: Optional[str] = None,
+    stage: Optional[str] = None,
+    threat_type: Optional[str] = None,
+    source_ip: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None, description="Comma-separated fields, or 'summary'"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
+):
+    params = {
+        "severity": severity,
+        "stage": stage,
+        "threat_type": threat_type,
+        "source_ip": source_ip,
+        "start": start,
+        "end": end
+    }
+
+    es = get_async_client("api")
+
+    try:
+        return await get_all_incidents(es, params, size, parse_fields(fields), cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except CursorExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except BadRequestError as e:
+        # e.g. a source_ip that is not an IP, or an unparseable start/end
+        raise HTTPException(status_code=400, detail=f"Invalid incident filter: {e}")
+
+@app.get("/incidents/{incident_id}")
+async def fetch_incident(incident_id: str):
+    incident = await get_incident_detail(get_async_client("api"), incident_id)
+    if incident is None:
+        raise HTTPException(status_code=404, detail="Incident not found.")
+    return incident
+
+@app.get("/incidents/{incident_id}/chain")
+async def fetch_incident_chain(incident_id: str):
+    chain = await incidents_cache.get_or_load_async(
+        ("chain", incident_id), lambda: get_chain_async(get_async_client("api"), incident_id)
+    )
+    if chain is None:
+        raise HTTPException(status_code=404, detail="Incident is not part of an attack chain.")
+    return chain
+
+@app.get("/incidents/{incident_id}/jobs")
+async def fetch_incident_jobs(incident_id: str):
+    # Uncached: clients poll this while a report is generating
+    try:
+        hit = await get_incident(get_async_client("api"), incident_id)
+    except NotFoundError:
+        hit = None
+    if hit is None:
+        raise HTTPException(status_code=404, detail="Incident not found.")
+    return {"incident_id": incident_id, "jobs": hit["_source"].get("report_jobs", {})}
+
+# Seconds between SSE comments that keep idle proxies from closing the stream
+SSE_KEEPALIVE_SECONDS = 15
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _report_events(incident_id, kind, subscriber):
+    # Sent before the model is involved, so clients get a first byte at once
+    yield sse_event("start", {"incident_id": incident_id, "kind": kind})
+    try:
+        while True:
+            try:
+                event, data = await asyncio.wait_for(subscriber.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+
+            yield sse_event(event, {"text": data} if event == "delta" else data)
+            if event != "delta":
+                return
+    finally:
+        report_jobs.unsubscribe(incident_id, kind, subscriber)
+
+@app.get("/incidents/{incident_id}/deep-investigation/stream")
+async def stream_deep_investigation(incident_id: str):
+    """
+    Server-sent events for an incident's deep investigation: `start`, then
+    `delta` events with the model output as it is generated, then `result`
+    with the parsed report (already saved on the incident) or `failed`.
+    Joins the job queued by the stage change, or queues one.
+    """
+    kind = "deep_investigation"
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    es = get_async_client("api")
+    try:
+        hit = await get_incident(es, incident_id)
+    except NotFoundError:
+        hit = None
+    if hit is None:
+        raise HTTPException(status_code=404, detail="Incident not found.")
+    incident = hit["_source"]
+
+    if kind in incident:
+        async def saved():
+            yield sse_event("result", incident[kind])
+        return StreamingResponse(saved(), media_type="text/event-stream", headers=headers)
+
+    if incident.get("incident_stage") != "INVESTIGATING":
+        raise HTTPException(status_code=409, detail="Deep investigations start when an incident moves to INVESTIGATING.")
+
+    subscriber = report_jobs.subscribe(incident_id, kind)
+    if subscriber is None:
+        # No job here (another API process, or it failed): queue one the
+        # way a stage change does
+        await es.update(
+            index=hit["_index"],
+            id=incident_id,
+            doc={"report_jobs": {kind: pending_job()}},
+            retry_on_conflict=3,
+            refresh="wait_for"
+        )
+        invalidate_incident_views()
+        try:
+            report_jobs.enqueue(incident_id, kind)
+        except Exception as e:
+            # Still pending on the incident; recovered on the next start
+            print(f"⚠️ Report job {kind} for {incident_id} not queued: {e}")
+        subscriber = report_jobs.subscribe(incident_id, kind)
+
+    if subscriber is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Report queue unavailable; the deep investigation stays pending and will be generated later."
+        )
+
+    return StreamingResponse(
+        _report_events(incident_id, kind, subscriber), media_type="text/event-stream", headers=headers
+    )
+
+@app.post("/incidents/{incident_id}/jobs/{kind}/retry", status_code=202)
+async def retry_incident_job(incident_id: str, kind: str):
+    if kind not in JOB_KINDS:
+        raise HTTPException(status_code=404, detail=f"Unknown report job '{kind}'.")
+
+    es = get_async_client("api")
+    try:
+        hit = await get_incident(es, incident_id)
+    except NotFoundError:
+        hit = None
+    if hit is None:
+        raise HTTPException(status_code=404, detail="Incident not found.")
+
+    job = hit["_source"].get("report_jobs", {}).get(kind)
+    if job is None or job.get("status") != "failed":
+        raise HTTPException(status_code=409, detail="Only failed jobs can be retried.")
+
+    job.update(status="pending", error=None)
+    try:
+        await es.update(
+            index=hit["_index"],
+            id=incident_id,
+            doc={"report_jobs": {kind: job}},
+            if_seq_no=hit["_seq_no"],
+            if_primary_term=hit["_primary_term"],
+            refresh="wait_for"
+        )
+    except ConflictError:
+        raise HTTPException(status_code=409, detail="Incident was modified concurrently, please retry.")
+    invalidate_incident_views()
+
+    try:
+        report_jobs.enqueue(incident_id, kind)
+    except Exception as e:
+        # Still pending on the incident; recovered on the next start
+        print(f"⚠️ Report job {kind} for {incident_id} not queued: {e}")
+    return {"incident_id": incident_id, "job": {"kind": kind, "status": "pending"}}
+
+@app.get("/report-jobs")
+async def report_jobs_status():
+    return report_jobs.stats()
 
 @app.get("/metrics")
-def fetch_metrics():
-    return get_metrics(es)
+async def fetch_metrics():
+    return await get_metrics_async(get_async_client("api"))
 
-@app.post("/run-detection")
-def trigger_detection():
-    result = run_incident_commander()
-    return result
+@app.post("/run-detection", status_code=202)
+async def trigger_detection(detector: Optional[str] = None):
+    # Wake the scheduler and return at once; results show up in /incidents
+    # and /detection/status
+    try:
+        detectors = detection_service.trigger(detector)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown detector '{detector}'.")
+
+    return {
+        "status": "TRIGGERED",
+        "detectors": detectors,
+        "message": "Detection triggered. New incidents will appear shortly."
+    }
+
+@app.get("/detection/status")
+async def detection_status():
+    return await run_in_threadpool(detection_service.status)
+
+@app.get("/detection/rules")
+async def detection_rules():
+    try:
+        return {"plans": describe_plans(rule_detectors())}
+    except RuleError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.get("/correlation-store")
+async def correlation_store_status(check: bool = False, repair: bool = True):
+    status = occurrence_store.stats()
+    status["attack_chains"] = chain_index.stats()
+    if check:
+        status["consistency"] = await run_in_threadpool(
+            occurrence_store.check_consistency, get_client("detection"), repair
+        )
+    return status
+
+
+@app.get("/llm-cache")
+async def llm_cache_status():
+    return await run_in_threadpool(llm_cache.stats)
+
+
+@app.get("/inference")
+async def inference_status():
+    return inference_client.stats()
 
 
 # New lifecycle endpoint for updating incident stage
 @app.put("/incidents/{incident_id}/update-stage")
-def update_incident_stage(incident_id: str, payload: dict):
+async def update_incident_stage(incident_id: str, payload: dict):
     allowed_stages = ["OPEN", "INVESTIGATING", "CONTAINED", "RESOLVED", "FALSE_POSITIVE"]
 
     new_stage = payload.get("new_stage")
@@ -59,10 +315,14 @@ def update_incident_stage(incident_id: str, payload: dict):
     if new_stage not in allowed_stages:
         raise HTTPException(status_code=400, detail="Invalid stage provided.")
 
+    es = get_async_client("api")
+
     try:
         # Fetch existing incident
-        response = es.get(index="incidents", id=incident_id)
-        incident = response["_source"]
+        hit = await get_incident(es, incident_id)
+        if hit is None:
+            raise HTTPException(status_code=404, detail="Incident not found.")
+        incident = hit["_source"]
 
         current_stage = incident.get("incident_stage", "OPEN")
 
@@ -82,32 +342,6 @@ def update_incident_stage(incident_id: str, payload: dict):
 
         current_time = datetime.now(timezone.utc).isoformat()
 
-        # Update stage
-        incident["incident_stage"] = new_stage
-        incident["updated_at"] = current_time
-
-        # Deep Investigation Logic
-        generated_object = None
-        if new_stage == "INVESTIGATING" and current_stage != "INVESTIGATING":
-            # Only generate deep investigation if it doesn't already exist
-            if "deep_investigation" not in incident:
-                try:
-                    generated_object = generate_deep_investigation(incident)
-                    generated_object["generated_at"] = current_time
-                except Exception as e:
-                    print(f"Error during deep investigation: {e}")
-
-        # Closure Report Logic
-        closure_report = None
-        if new_stage == "RESOLVED" and current_stage != "RESOLVED":
-            if "closure_report" not in incident:
-                try:
-                    closure_report = generate_closure_report(incident)
-                    if "generated_at" not in closure_report:
-                        closure_report["generated_at"] = current_time
-                except Exception as e:
-                    print(f"Error during closure report generation: {e}")
-
         # Append history
         updated_history = incident.get("history", [])
         updated_history.append({
@@ -122,17 +356,39 @@ def update_incident_stage(incident_id: str, payload: dict):
             "updated_at": current_time,
             "history": updated_history
         }
-        
-        if generated_object:
-            update_doc["deep_investigation"] = generated_object
-            
-        if closure_report:
-            update_doc["closure_report"] = closure_report
 
-        # Save back to Elasticsearch using atomic update
-        es.update(index="incidents", id=incident_id, doc=update_doc)
+        # Deep investigation (INVESTIGATING) and closure report (RESOLVED)
+        # are generated in the background; the job is recorded with the
+        # stage change so it survives a restart
+        job_kind = job_for_transition(current_stage, new_stage, incident)
+        if job_kind:
+            update_doc["report_jobs"] = {job_kind: pending_job(current_time)}
+
+        # Save back to Elasticsearch using atomic update on the backing index,
+        # rejecting it if someone else changed the incident in the meantime.
+        # Wait for the refresh so the next cached read sees the new stage.
+        await es.update(
+            index=hit["_index"],
+            id=incident_id,
+            doc=update_doc,
+            if_seq_no=hit["_seq_no"],
+            if_primary_term=hit["_primary_term"],
+            refresh="wait_for"
+        )
+        invalidate_incident_views()
+
+        response = {"message": "Incident stage updated successfully."}
+        if job_kind:
+            try:
+                report_jobs.enqueue(incident_id, job_kind)
+            except Exception as e:
+                # Still pending on the incident; recovered on the next start
+                print(f"⚠️ Report job {job_kind} for {incident_id} not queued: {e}")
+            response["job"] = {"kind": job_kind, "status": "pending"}
 
-        return {"message": "Incident stage updated successfully."}
+        return response
 
     except NotFoundError:
-        raise HTTPException(status_code=404, detail="Incident not found.")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="Incident not found.")
+    except ConflictError:
+        raise HTTPException(status_code=409, detail="Incident was modified concurrently, please retry.")
@@ -0,0 +1,283 @@
+import asyncio
+from datetime import datetime, timezone
+
+from elasticsearch import NotFoundError
+
+from ai_reasoner import closure_report_async, deep_investigation_report_async
+from attack_chains import get_chain_async
+from es_client import get_async_client
+from incident_service import get_incident
+from query_cache import invalidate_incident_views
+
+# ========================
+# BACKGROUND REPORT JOBS
+# ========================
+#
+# Stage changes commit at once; the LLM reports they trigger (deep
+# investigation on INVESTIGATING, closure report on RESOLVED) are queued
+# and generated by a small pool of workers on the API's event loop, so a
+# stage change never waits for a completion.
+#
+# Job state lives on the incident itself, under `report_jobs.<kind>`:
+#
+#   pending -> running -> done | failed
+#
+# The stage update writes `pending` in the same request that changes the
+# stage, so a job is never lost between the two. On startup, incidents
+# with pending or running jobs (a restart or crash interrupted them) are
+# queued again. A job whose report already exists is marked done without
+# calling the model. A failed generation marks the job failed with its
+# error and leaves the report unset, so it can be retried.
+#
+# Deep investigations are generated through the streaming completion API.
+# While a job is queued or running, clients can subscribe to it (the SSE
+# endpoint does) and receive the text produced so far, every new piece as
+# it arrives, and finally the parsed report or the failure.
+
+WORKERS = 2
+QUEUE_SIZE = 1000
+
+# Incidents scanned for unfinished jobs on startup
+RECOVER_LIMIT = 500
+
+# Job status updates retry against concurrent stage changes
+UPDATE_RETRIES = 3
+
+JOB_KINDS = {
+    # kind -> stage that triggers it
+    "deep_investigation": "INVESTIGATING",
+    "closure_report": "RESOLVED"
+}
+
+UNFINISHED = ("pending", "running")
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def job_for_transition(current_stage, new_stage, incident):
+    """The report kind this stage change should generate, or None."""
+    for kind, stage in JOB_KINDS.items():
+        if new_stage == stage and current_stage != stage and kind not in incident:
+            return kind
+    return None
+
+
+def pending_job(queued_at=None):
+    return {"status": "pending", "queued_at": queued_at or utc_now(), "attempts": 0}
+
+
+async def _generate(es, inference_es, incident_id, incident, kind, on_delta):
+    if kind == "deep_investigation":
+        incident["attack_chain"] = await get_chain_async(es, incident_id)
+        return await deep_investigation_report_async(inference_es, incident, on_delta)
+    return await closure_report_async(inference_es, incident)
+
+
+class JobProgress:
+    """Output of one job so far, fanned out to live subscribers."""
+
+    def __init__(self):
+        self.text = []
+        self.subscribers = set()
+        self.finished = False
+
+    def publish(self, event, data):
+        if event == "delta":
+            self.text.append(data)
+        else:
+            self.finished = True
+        for subscriber in self.subscribers:
+            subscriber.put_nowait((event, data))
+
+
+class ReportJobQueue:
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self._queue = None
+        self._workers = []
+        # (incident_id, kind) queued or running in this process -> JobProgress
+        self._active = {}
+
+        self.completed = 0
+        self.failed = 0
+        self.last_error = None
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    async def start(self):
+        if self.running:
+            return
+
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"report-worker-{n}")
+            for n in range(self.worker_count)
+        ]
+
+        try:
+            recovered = await self.recover(get_async_client("api"))
+            if recovered:
+                print(f"♻️ Re-queued {recovered} unfinished report jobs")
+        except Exception as e:
+            print(f"⚠️ Report job recovery failed: {e}")
+
+    async def stop(self):
+        """Cancel the workers; unfinished jobs stay pending/running in ES and recover on start."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._active.clear()
+
+    def enqueue(self, incident_id, kind):
+        """Queue a job without waiting. Returns False if it is already queued here."""
+        if not self.running:
+            raise RuntimeError("Report job queue is not running")
+
+        key = (incident_id, kind)
+        if key in self._active:
+            return False
+
+        # A full queue leaves the job pending in ES; the next start recovers it
+        self._queue.put_nowait(key)
+        self._active[key] = JobProgress()
+        return True
+
+    def subscribe(self, incident_id, kind):
+        """
+        asyncio.Queue of ("delta", text), then ("result", report) or
+        ("failed", error), for a job queued or running here; None otherwise.
+        """
+        progress = self._active.get((incident_id, kind))
+        if progress is None:
+            return None
+
+        subscriber = asyncio.Queue()
+        if progress.text:
+            subscriber.put_nowait(("delta", "".join(progress.text)))
+        progress.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, incident_id, kind, subscriber):
+        progress = self._active.get((incident_id, kind))
+        if progress is not None:
+            progress.subscribers.discard(subscriber)
+
+    async def recover(self, es):
+        clauses = [
+            {"terms": {f"report_jobs.{kind}.status": list(UNFINISHED)}}
+            for kind in JOB_KINDS
+        ]
+        try:
+            response = await es.search(
+                index="incidents",
+                query={"bool": {"should": clauses, "minimum_should_match": 1}},
+                source=["report_jobs"],
+                size=RECOVER_LIMIT
+            )
+        except NotFoundError:
+            return 0
+
+        recovered = 0
+        for hit in response["hits"]["hits"]:
+            jobs = hit["_source"].get("report_jobs", {})
+            for kind, job in jobs.items():
+                if kind in JOB_KINDS and job.get("status") in UNFINISHED:
+                    recovered += self.enqueue(hit["_id"], kind)
+        return recovered
+
+    async def _worker(self):
+        while True:
+            incident_id, kind = await self._queue.get()
+            progress = self._active.get((incident_id, kind)) or JobProgress()
+            try:
+                await self._run(incident_id, kind, progress)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # _run records failures on the incident; this is ES being down
+                self.last_error = str(e)
+                print(f"❌ Report job {kind} for {incident_id} failed: {e}")
+            finally:
+                if not progress.finished:
+                    progress.publish("failed", self.last_error or "Report job did not finish")
+                self._active.pop((incident_id, kind), None)
+                self._queue.task_done()
+
+    async def _update(self, es, hit, doc):
+        # Partial update on the backing index (incidents is a data stream);
+        # job fields never conflict with a stage change, so no seq_no check
+        await es.update(
+            index=hit["_index"],
+            id=hit["_id"],
+            doc=doc,
+            retry_on_conflict=UPDATE_RETRIES,
+            refresh="wait_for"
+        )
+        invalidate_incident_views()
+
+    async def _run(self, incident_id, kind, progress):
+        es = get_async_client("api")
+        inference_es = get_async_client("inference")
+
+        hit = await get_incident(es, incident_id)
+        if hit is None:
+            return
+        incident = hit["_source"]
+        job = dict(incident.get("report_jobs", {}).get(kind) or pending_job())
+
+        if kind in incident:
+            job.update(status="done", finished_at=utc_now())
+            await self._update(es, hit, {"report_jobs": {kind: job}})
+            progress.publish("result", incident[kind])
+            return
+
+        job.update(status="running", started_at=utc_now(), attempts=job.get("attempts", 0) + 1)
+        await self._update(es, hit, {"report_jobs": {kind: job}})
+
+        started = asyncio.get_running_loop().time()
+        try:
+            report = await _generate(
+                es, inference_es, incident_id, incident, kind, lambda text: progress.publish("delta", text)
+            )
+        except Exception as e:
+            self.failed += 1
+            self.last_error = str(e)
+            print(f"❌ Report job {kind} for {incident_id} failed: {e}")
+            job.update(status="failed", finished_at=utc_now(), error=str(e))
+            await self._update(es, hit, {"report_jobs": {kind: job}})
+            progress.publish("failed", str(e))
+            return
+
+        finished_at = utc_now()
+        report.setdefault("generated_at", finished_at)
+        job.update(
+            status="done",
+            finished_at=finished_at,
+            duration_ms=round((asyncio.get_running_loop().time() - started) * 1000, 1),
+            # Partial updates merge objects, so clear an earlier attempt's error
+            error=None
+        )
+        await self._update(es, hit, {kind: report, "report_jobs": {kind: job}})
+        self.completed += 1
+        progress.publish("result", report)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "workers": self.worker_count,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "active": len(self._active),
+            "completed": self.completed,
+            "failed": self.failed,
+            "last_error": self.last_error
+        }
+
+
+report_jobs = ReportJobQueue()
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+
+from inference_client import failure_reason, inference_client, is_retryable, retry_delay
+
+# ========================
+# CONCURRENT, RATE-LIMITED INFERENCE
+# ========================
+#
+# Calling the LLM once per incident in a loop makes a detection run last
+# N x the completion latency. A BatchRunner fans completions out instead:
+#
+#   - at most CONCURRENCY requests in flight (asyncio semaphore),
+#   - at most RATE_PER_SECOND requests started per second, with bursts of
+#     up to BURST (token bucket), so a large batch stays inside the
+#     endpoint's quota instead of collecting 429s,
+#   - retries with full-jitter exponential backoff on 429, 5xx, timeouts
+#     and connection errors (Retry-After is honoured when the endpoint
+#     sends it), drawn from the inference client's shared retry budget.
+#     Deadlines and the circuit breaker apply per attempt in the client.
+#
+# Results come back in input order. Throughput is then bounded by the
+# quota settings, which can be raised to match the endpoint's limits.
+
+CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", 8))
+RATE_PER_SECOND = float(os.getenv("INFERENCE_RATE_PER_SECOND", 4))
+BURST = int(os.getenv("INFERENCE_BURST", 8))
+
+MAX_ATTEMPTS = 4
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate=RATE_PER_SECOND, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BatchRunner:
+    """
+    Runs `call(prompt)` coroutines (single attempts) under the concurrency
+    limit, rate limit and retry policy. One runner per batch (or per event
+    loop).
+    """
+
+    def __init__(self, call, concurrency=CONCURRENCY, rate=RATE_PER_SECOND, burst=BURST,
+                 max_attempts=MAX_ATTEMPTS, retry_budget=None):
+        self.call = call
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget or inference_client.retry_budget
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate, burst)
+
+        # Latency of the successful attempt, per prompt
+        self.latency_ms = {}
+
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    async def complete(self, prompt):
+        """Response body for `prompt`; raises the last error once retries run out."""
+        async with self._semaphore:
+            for attempt in range(1, self.max_attempts + 1):
+                await self._bucket.acquire()
+                self.requests += 1
+
+                started = time.perf_counter()
+                try:
+                    response = await self.call(prompt)
+                    self.latency_ms[prompt] = (time.perf_counter() - started) * 1000
+                    return response
+                except Exception as e:
+                    reason = failure_reason(e)
+                    if reason == "timeout":
+                        self.timeouts += 1
+                    if reason == "rate_limited":
+                        self.rate_limited += 1
+
+                    if attempt == self.max_attempts or not is_retryable(e) or not self.retry_budget.try_spend():
+                        self.failures += 1
+                        raise
+
+                    self.retries += 1
+                    await asyncio.sleep(retry_delay(attempt, e))
+
+    async def complete_all(self, prompts):
+        """
+        Responses in input order; a failed prompt yields its exception
+        instead of a response. Identical prompts are sent once.
+        """
+        unique = list(dict.fromkeys(prompts))
+        outcomes = await asyncio.gather(
+            *(self.complete(prompt) for prompt in unique), return_exceptions=True
+        )
+        by_prompt = dict(zip(unique, outcomes))
+        return [by_prompt[prompt] for prompt in prompts]
+
+    def stats(self):
+        latencies = sorted(self.latency_ms.values())
+        return {
+            "latency_ms_p50": round(latencies[len(latencies) // 2], 1) if latencies else None,
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "timeouts": self.timeouts,
+            "failures": self.failures
+        }
@@ -0,0 +1,269 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone, timedelta
+
+from elasticsearch import NotFoundError
+
+# ========================
+# IN-MEMORY CORRELATION STORE
+# ========================
+#
+# Dedup (10 min) and repeat-offender counting (30 min) used to cost two
+# searches on `incidents` per candidate. The store keeps the timestamps of
+# recent incidents per (source_ip, threat_type) in bounded ring buffers, so
+# both decisions are in-process lookups. It is warmed from ES with one
+# composite aggregation and updated by every incident write in this
+# process; writes from other processes are picked up on the next resync.
+
+INCIDENTS_INDEX = "incidents"
+
+DEDUP_WINDOW_SECONDS = 10 * 60
+OCCURRENCE_WINDOW_SECONDS = 30 * 60
+
+# Timestamps kept per key; occurrence counts saturate at this value
+MAX_OCCURRENCES_PER_KEY = 256
+
+# Re-read ES after this long to pick up incidents written elsewhere
+RESYNC_SECONDS = 5 * 60
+
+WARM_PAGE_SIZE = 1000
+
+
+class OccurrenceStore:
+    """
+    Thread-safe map of (source_ip, threat_type) -> deque of epoch seconds,
+    evicted once older than the occurrence window.
+    """
+
+    def __init__(self, window_seconds=OCCURRENCE_WINDOW_SECONDS,
+                 dedup_seconds=DEDUP_WINDOW_SECONDS, maxlen=MAX_OCCURRENCES_PER_KEY):
+        self.window_seconds = window_seconds
+        self.dedup_seconds = dedup_seconds
+        self.maxlen = maxlen
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self._pending = None
+        self.warmed_at = None
+        self.writes_since_sweep = 0
+
+    # ---------- lookups ----------
+
+    def _evict(self, entries, now):
+        cutoff = now - self.window_seconds
+        while entries and entries[0] < cutoff:
+            entries.popleft()
+
+    def occurrences(self, source_ip, threat_type, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = self._entries.get((source_ip, threat_type))
+            if not entries:
+                return 0
+            self._evict(entries, now)
+            return len(entries)
+
+    def last_seen(self, source_ip, threat_type):
+        with self._lock:
+            entries = self._entries.get((source_ip, threat_type))
+            return entries[-1] if entries else None
+
+    def is_duplicate(self, source_ip, threat_type, now=None):
+        now = time.time() if now is None else now
+        last = self.last_seen(source_ip, threat_type)
+        return last is not None and last >= now - self.dedup_seconds
+
+    # ---------- updates ----------
+
+    def record(self, source_ip, threat_type, timestamp=None, count=1):
+        timestamp = time.time() if timestamp is None else timestamp
+        key = (source_ip, threat_type)
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((source_ip, threat_type, timestamp, count))
+
+            entries = self._entries.get(key)
+            if entries is None:
+                entries = self._entries[key] = deque(maxlen=self.maxlen)
+
+            # Keep each deque sorted; warm-up and late writes can be older
+            if entries and timestamp < entries[-1]:
+                merged = sorted(list(entries) + [timestamp] * count)
+                entries.clear()
+                entries.extend(merged)
+            else:
+                entries.extend([timestamp] * count)
+
+            self.writes_since_sweep += 1
+            if self.writes_since_sweep >= 1000:
+                self._sweep(time.time())
+
+    def record_incident(self, incident):
+        """Record a written incident at its @timestamp, the time ES holds for it."""
+        timestamp = incident.get("@timestamp")
+        self.record(
+            incident.get("source_ip"),
+            incident.get("threat_type"),
+            datetime.fromisoformat(timestamp).timestamp() if timestamp else None
+        )
+
+    def _sweep(self, now):
+        """Drop keys whose occurrences have all expired."""
+        for key in list(self._entries):
+            entries = self._entries[key]
+            self._evict(entries, now)
+            if not entries:
+                del self._entries[key]
+        self.writes_since_sweep = 0
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._sweep(now)
+            return {key: len(entries) for key, entries in self._entries.items()}
+
+    # ---------- ES synchronisation ----------
+
+    def load_from_es(self, es):
+        """
+        Read recent incidents as one paginated composite aggregation with
+        per-second buckets, i.e. {(source_ip, threat_type): [(epoch, n)]}.
+        """
+        since = datetime.now(timezone.utc) - timedelta(seconds=self.window_seconds)
+
+        composite = {
+            "size": WARM_PAGE_SIZE,
+            "sources": [
+                {"source_ip": {"terms": {"field": "source_ip"}}},
+                {"threat_type": {"terms": {"field": "threat_type"}}},
+                {"second": {"date_histogram": {"field": "@timestamp", "fixed_interval": "1s"}}}
+            ]
+        }
+
+        loaded = {}
+
+        try:
+            while True:
+                response = es.search(
+                    index=INCIDENTS_INDEX,
+                    size=0,
+                    query={"range": {"@timestamp": {"gte": since.isoformat()}}},
+                    aggs={"recent": {"composite": composite}}
+                )
+                recent = response["aggregations"]["recent"]
+
+                for bucket in recent["buckets"]:
+                    key = (bucket["key"]["source_ip"], bucket["key"]["threat_type"])
+                    loaded.setdefault(key, []).append(
+                        (bucket["key"]["second"] / 1000, bucket["doc_count"])
+                    )
+
+                after_key = recent.get("after_key")
+                if not after_key or len(recent["buckets"]) < WARM_PAGE_SIZE:
+                    break
+                composite["after"] = after_key
+        except NotFoundError:
+            # No incidents written yet
+            pass
+
+        return loaded
+
+    def warm(self, es):
+        with self._lock:
+            # Writes landing while ES is read are replayed on top of it
+            self._pending = []
+
+        try:
+            loaded = self.load_from_es(es)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        entries = {}
+        for key, seconds in loaded.items():
+            timestamps = deque(maxlen=self.maxlen)
+            for second, count in sorted(seconds):
+                timestamps.extend([second] * count)
+            entries[key] = timestamps
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._entries = entries
+            self.warmed_at = time.time()
+
+        # A pending write may already be in what ES returned (incidents are
+        # written with refresh=wait_for before they are recorded). Writes
+        # carry their incident's @timestamp, so those covered by the warmed
+        # per-second bucket of their key are not counted twice.
+        unclaimed = {
+            (key, int(second)): count
+            for key, seconds in loaded.items()
+            for second, count in seconds
+        }
+        for source_ip, threat_type, timestamp, count in pending:
+            bucket = ((source_ip, threat_type), int(timestamp))
+            covered = min(count, unclaimed.get(bucket, 0))
+            if covered:
+                unclaimed[bucket] -= covered
+            if count > covered:
+                self.record(source_ip, threat_type, timestamp, count - covered)
+
+        print(f"🧠 Correlation store warmed with {len(entries)} (source_ip, threat_type) keys")
+
+    def ensure_warm(self, es):
+        """Warm on first use and again every RESYNC_SECONDS."""
+        if self.warmed_at is not None and time.time() - self.warmed_at < RESYNC_SECONDS:
+            return
+
+        with self._warm_lock:
+            if self.warmed_at is None or time.time() - self.warmed_at >= RESYNC_SECONDS:
+                self.warm(es)
+
+    def check_consistency(self, es, repair=True):
+        """
+        Compare in-memory occurrence counts with what ES holds for the same
+        window. Mismatches come from writes by other processes or from
+        counts saturating at maxlen; with `repair` the store is re-warmed.
+        """
+        now = time.time()
+        expected = {
+            key: sum(count for _, count in seconds)
+            for key, seconds in self.load_from_es(es).items()
+        }
+        actual = self.snapshot(now)
+
+        mismatches = []
+        for key in set(expected) | set(actual):
+            want = min(expected.get(key, 0), self.maxlen)
+            have = actual.get(key, 0)
+            if want != have:
+                mismatches.append({
+                    "source_ip": key[0],
+                    "threat_type": key[1],
+                    "store": have,
+                    "elasticsearch": expected.get(key, 0)
+                })
+
+        if mismatches and repair:
+            self.warm(es)
+
+        return {
+            "keys_checked": len(set(expected) | set(actual)),
+            "consistent": not mismatches,
+            "mismatches": mismatches,
+            "repaired": bool(mismatches and repair)
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._entries),
+                "occurrences": sum(len(entries) for entries in self._entries.values()),
+                "warmed_at": self.warmed_at
+            }
+
+
+occurrence_store = OccurrenceStore()
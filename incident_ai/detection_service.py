@@ -0,0 +1,247 @@
+import os
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+
+from es_client import get_client
+from watermarks import load_watermark, watermark_lag_seconds
+
+# ========================
+# CONTINUOUS DETECTION SERVICE
+# ========================
+#
+# Runs every detector on its own thread and interval (with jitter, so
+# detectors and API replicas do not hit ES in lockstep). A run never
+# overlaps the previous run of the same detector: ticks and manual
+# triggers that arrive while it is busy are coalesced into one follow-up
+# run. The FastAPI backend starts the service from its lifespan; it can
+# also run standalone with `python detection_service.py`.
+#
+# Watermarks make runs incremental and shared, so one scheduler per
+# deployment is enough. Set DETECTION_SCHEDULER=off on extra API workers.
+
+
+def _run_incident_commander():
+    from incident_commander import run_batch_detection
+    return run_batch_detection()
+
+
+def _run_soc_orchestrator():
+    from soc_orchestrator import run_soc_orchestrator
+    return run_soc_orchestrator()
+
+
+def _run_service_health():
+    from service_health import run_service_health
+    return run_service_health()
+
+
+# name -> (callable, interval seconds, jitter seconds, watermark names)
+DETECTORS = {
+    "incident_commander": (_run_incident_commander, 30, 5, ["incident_commander_batch"]),
+    "soc_orchestrator": (_run_soc_orchestrator, 60, 10, ["brute_force", "privilege_escalation"]),
+    "service_health": (_run_service_health, 60, 10, ["service_health"])
+}
+
+STOP_TIMEOUT_SECONDS = 30
+
+
+def scheduler_enabled():
+    return os.getenv("DETECTION_SCHEDULER", "on").lower() not in ("0", "off", "false", "no")
+
+
+def _summarize(result):
+    if not isinstance(result, dict):
+        return result
+    keep = ("status", "events", "groups", "anomalies", "created", "duplicates_skipped", "type", "source_ip")
+    return {key: result[key] for key in keep if key in result}
+
+
+class DetectorJob:
+
+    def __init__(self, name, func, interval, jitter, watermarks=()):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.watermarks = list(watermarks)
+        self.wake = threading.Event()
+        self.thread = None
+        self._running = threading.Lock()
+
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started = None
+        self.last_finished = None
+        self.last_duration_ms = None
+        self.last_result = None
+        self.last_error = None
+
+    def next_delay(self):
+        return max(1.0, self.interval + random.uniform(-self.jitter, self.jitter))
+
+    def run_once(self):
+        """Run the detector unless a run is already in progress (single-flight)."""
+        if not self._running.acquire(blocking=False):
+            self.skipped += 1
+            return False
+
+        try:
+            self.last_started = datetime.now(timezone.utc).isoformat()
+            started = time.perf_counter()
+            try:
+                self.last_result = _summarize(self.func())
+                self.last_error = None
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"❌ Detector '{self.name}' failed: {e}")
+            finally:
+                self.runs += 1
+                self.last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+                self.last_finished = datetime.now(timezone.utc).isoformat()
+        finally:
+            self._running.release()
+
+        return True
+
+    @property
+    def busy(self):
+        return self._running.locked()
+
+    def status(self, es=None):
+        status = {
+            "interval_seconds": self.interval,
+            "jitter_seconds": self.jitter,
+            "running": self.busy,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped_overlapping": self.skipped,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_duration_ms": self.last_duration_ms,
+            "last_result": self.last_result,
+            "last_error": self.last_error
+        }
+
+        if es is not None:
+            lags = {}
+            for name in self.watermarks:
+                try:
+                    lags[name] = watermark_lag_seconds(load_watermark(es, name))
+                except Exception as e:
+                    lags[name] = f"unavailable: {e}"
+            status["watermark_lag_seconds"] = lags
+
+        return status
+
+
+class DetectionService:
+
+    def __init__(self, detectors=None):
+        detectors = DETECTORS if detectors is None else detectors
+        self.jobs = {
+            name: DetectorJob(name, func, interval, jitter, watermarks)
+            for name, (func, interval, jitter, watermarks) in detectors.items()
+        }
+        self._stop = threading.Event()
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self.started_at is not None and not self._stop.is_set()
+
+    def _loop(self, job):
+        # Stagger the first run so detectors do not start together
+        delay = random.uniform(0, job.jitter)
+
+        while not self._stop.is_set():
+            job.wake.wait(timeout=delay)
+            job.wake.clear()
+            if self._stop.is_set():
+                break
+
+            job.run_once()
+            delay = job.next_delay()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._stop.clear()
+        self.started_at = datetime.now(timezone.utc).isoformat()
+
+        for job in self.jobs.values():
+            job.thread = threading.Thread(
+                target=self._loop, args=(job,), name=f"detector-{job.name}", daemon=True
+            )
+            job.thread.start()
+
+        print(f"🛰️ Detection service started: {', '.join(self.jobs)}")
+
+    def stop(self, timeout=STOP_TIMEOUT_SECONDS):
+        """Stop scheduling and wait for in-progress runs to finish."""
+        self._stop.set()
+        for job in self.jobs.values():
+            job.wake.set()
+
+        deadline = time.monotonic() + timeout
+        for job in self.jobs.values():
+            if job.thread is not None:
+                job.thread.join(max(0, deadline - time.monotonic()))
+                if job.thread.is_alive():
+                    print(f"⚠️ Detector '{job.name}' still running after {timeout}s")
+                job.thread = None
+
+        self.started_at = None
+        print("🛑 Detection service stopped")
+
+    def trigger(self, name=None):
+        """
+        Ask for an immediate run without waiting for it. When the scheduler
+        is not running, the run happens on a one-off background thread.
+        """
+        names = [name] if name else list(self.jobs)
+        if any(n not in self.jobs for n in names):
+            raise KeyError(name)
+
+        for n in names:
+            job = self.jobs[n]
+            if self.running:
+                job.wake.set()
+            else:
+                threading.Thread(target=job.run_once, name=f"detector-{n}-once", daemon=True).start()
+
+        return names
+
+    def status(self, include_lag=True):
+        es = get_client("detection") if include_lag else None
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "detectors": {name: job.status(es) for name, job in self.jobs.items()}
+        }
+
+
+detection_service = DetectionService()
+
+
+def main():
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    detection_service.start()
+    stop.wait()
+    detection_service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+from elastic_transport.client_utils import parse_cloud_id
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+load_dotenv()
+
+# ========================
+# SHARED ELASTICSEARCH CLIENTS
+# ========================
+#
+# Every entry point gets its client from here instead of building one at
+# import time. Clients are created on first use, one per workload, and
+# reused afterwards: importing a module never opens a connection pool or
+# requires credentials.
+#
+# Pooled connections are kept alive between requests by the transport
+# (urllib3 for sync, httpx for async), so each workload pays the TLS
+# handshake once per pooled connection, not once per request.
+
+# Transport errors worth retrying right away: proxy/node restarts. 429 is
+# left to callers, which back off first (see ingest_logs.send_chunk).
+RETRY_ON_STATUS = (502, 503, 504)
+
+CLIENT_PROFILES = {
+    # Scripts and the Streamlit dashboard
+    "default": {
+        "connections_per_node": 10,
+        "request_timeout": 30,
+        "max_retries": 3
+    },
+    # FastAPI request handlers: many small concurrent reads, fail fast
+    "api": {
+        "connections_per_node": 32,
+        "request_timeout": 10,
+        "max_retries": 2
+    },
+    # Bulk ingest: large compressed bodies, patient retries
+    "ingest": {
+        "connections_per_node": 16,
+        "request_timeout": 120,
+        "max_retries": 5,
+        "http_compress": True
+    },
+    # Detection queries and incident writes
+    "detection": {
+        "connections_per_node": 8,
+        "request_timeout": 60,
+        "max_retries": 3
+    },
+    # LLM completions are slow and not idempotent in cost: one retry only
+    "inference": {
+        "connections_per_node": 16,
+        "request_timeout": 120,
+        "max_retries": 1,
+        "retry_on_timeout": False
+    }
+}
+
+_clients = {}
+_async_clients = {}
+_lock = threading.Lock()
+
+# Clients must not cross a fork (ingest worker processes)
+_owner_pid = os.getpid()
+
+
+class MissingCredentials(RuntimeError):
+    pass
+
+
+def connection_settings():
+    """
+    Read connection settings from the environment at call time. A plain
+    ELASTICSEARCH_URL (local cluster or test stub) takes precedence over
+    ELASTIC_CLOUD_ID.
+    """
+    url = os.getenv("ELASTICSEARCH_URL")
+    cloud_id = os.getenv("ELASTIC_CLOUD_ID")
+    username = os.getenv("ELASTIC_USERNAME", "elastic")
+    password = os.getenv("ELASTIC_PASSWORD")
+
+    if url:
+        settings = {"hosts": [url]}
+    elif cloud_id:
+        settings = {"cloud_id": cloud_id}
+    else:
+        raise MissingCredentials(
+            "Set ELASTIC_CLOUD_ID (or ELASTICSEARCH_URL) in the environment or .env file."
+        )
+
+    if password:
+        settings["basic_auth"] = (username, password)
+
+    return settings
+
+
+def client_options(workload):
+    options = {
+        "retry_on_status": RETRY_ON_STATUS,
+        "retry_on_timeout": True
+    }
+    options.update(CLIENT_PROFILES.get(workload, CLIENT_PROFILES["default"]))
+
+    # INFERENCE_URL sends completions elsewhere (e.g. the local inference
+    # stub) while every other workload keeps the real cluster
+    inference_url = os.getenv("INFERENCE_URL")
+    if workload == "inference" and inference_url:
+        options["hosts"] = [inference_url]
+    else:
+        options.update(connection_settings())
+    return options
+
+
+def base_url(workload="default"):
+    """
+    (root URL, basic auth) of the cluster for the few calls made over
+    plain httpx, such as streamed responses the transport would buffer.
+    """
+    inference_url = os.getenv("INFERENCE_URL")
+    if workload == "inference" and inference_url:
+        return inference_url.rstrip("/"), None
+
+    settings = connection_settings()
+    if "hosts" in settings:
+        url = settings["hosts"][0]
+    else:
+        host, port = parse_cloud_id(settings["cloud_id"]).es_address
+        url = f"https://{host}:{port}"
+
+    return url.rstrip("/"), settings.get("basic_auth")
+
+
+def _reset_after_fork():
+    global _owner_pid
+
+    if os.getpid() != _owner_pid:
+        _clients.clear()
+        _async_clients.clear()
+        _owner_pid = os.getpid()
+
+
+def get_client(workload="default"):
+    """Return the shared blocking client for a workload, creating it on first use."""
+    with _lock:
+        _reset_after_fork()
+        client = _clients.get(workload)
+        if client is None:
+            client = Elasticsearch(**client_options(workload))
+            _clients[workload] = client
+        return client
+
+
+def get_async_client(workload="api"):
+    """
+    Return the shared AsyncElasticsearch client for a workload. Uses the
+    httpx transport, which is already a dependency (aiohttp is not).
+    """
+    with _lock:
+        _reset_after_fork()
+        client = _async_clients.get(workload)
+        if client is None:
+            client = AsyncElasticsearch(node_class="httpxasync", **client_options(workload))
+            _async_clients[workload] = client
+        return client
+
+
+def open_async_client(workload="inference", **overrides):
+    """
+    A new, unshared AsyncElasticsearch client for code that runs its own
+    event loop (asyncio.run from a script or worker thread); shared async
+    clients are bound to the loop that first used them. Close it when done,
+    e.g. with `async with open_async_client() as es:`.
+    """
+    options = client_options(workload)
+    options.update(overrides)
+    return AsyncElasticsearch(node_class="httpxasync", **options)
+
+
+def close_clients():
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+
+    for client in clients:
+        client.close()
+
+
+async def close_async_clients():
+    with _lock:
+        clients = list(_async_clients.values())
+        _async_clients.clear()
+
+    for client in clients:
+        await client.close()
@@ -47,7 +47,7 @@ function App() {
       const res = await fetch(`${import.meta.env.VITE_API_BASE_URL}/incidents`);
       if (res.ok) {
         const data = await res.json();
-        setIncidents(data);
+        setIncidents(data.incidents);
         setLastRefresh(new Date());
       }
     } catch (e) {
@@ -106,7 +106,9 @@ function App() {
         const data = await res.json();
         setToast({
           type: 'success',
-          message: data.status === 'NO_INCIDENT' || data.status === 'NO_THREAT' || data.status === 'DUPLICATE_SKIPPED'
+          message: data.status === 'TRIGGERED'
+            ? `Engine triggered: ${data.message}`
+            : data.status === 'NO_INCIDENT' || data.status === 'NO_THREAT' || data.status === 'DUPLICATE_SKIPPED'
             ? `Engine executed: ${data.message || 'No new incidents detected at this time.'}`
             : `Engine executed: Threat escalated! (${data.threat_type || 'New'})`
         });
@@ -1,9 +1,17 @@
 import { useState, useEffect } from 'react';
-import { X, Network, BrainCircuit, Activity, ShieldCheck, History, Info, GitCommit, FileText, AlertTriangle, MessageSquare, CheckCircle } from 'lucide-react';
+import { X, Network, BrainCircuit, Activity, ShieldCheck, History, Info, GitCommit, FileText, AlertTriangle, MessageSquare, CheckCircle, Loader2 } from 'lucide-react';
+
+const JOB_POLL_MS = 3000;
+const JOB_LABELS = { deep_investigation: 'Deep investigation', closure_report: 'Closure report' };
+const isUnfinished = (job) => job?.status === 'pending' || job?.status === 'running';
 
 export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
      const [analystNote, setAnalystNote] = useState('');
      const [isUpdating, setIsUpdating] = useState(false);
+     const [chain, setChain] = useState(null);
+     const [jobs, setJobs] = useState({});
+     const [reports, setReports] = useState({});
+     const [liveText, setLiveText] = useState('');
 
      useEffect(() => {
           if (incident) {
@@ -11,8 +19,79 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                setAnalystNote('');
                // eslint-disable-next-line react-hooks/set-state-in-effect
                setIsUpdating(false);
+               // eslint-disable-next-line react-hooks/set-state-in-effect
+               setChain(null);
+               // eslint-disable-next-line react-hooks/set-state-in-effect
+               setJobs(incident.report_jobs || {});
+               // eslint-disable-next-line react-hooks/set-state-in-effect
+               setReports({});
+               // eslint-disable-next-line react-hooks/set-state-in-effect
+               setLiveText('');
           }
      }, [incident]);
+
+     // Reports are generated in the background: poll their jobs, then load
+     // the finished report
+     const jobsPending = Object.values(jobs).some(isUnfinished);
+     useEffect(() => {
+          if (!incident?._id || !jobsPending) return;
+          const base = `${import.meta.env.VITE_API_BASE_URL}/incidents/${incident._id}`;
+          const timer = setInterval(async () => {
+               try {
+                    const res = await fetch(`${base}/jobs`);
+                    if (!res.ok) return;
+                    const data = await res.json();
+                    setJobs(data.jobs);
+                    if (!Object.values(data.jobs).some(isUnfinished)) {
+                         const detail = await fetch(base);
+                         if (detail.ok) setReports(await detail.json());
+                    }
+               } catch (e) {
+                    console.error("Failed to poll report jobs", e);
+               }
+          }, JOB_POLL_MS);
+          return () => clearInterval(timer);
+     }, [incident?._id, jobsPending]);
+
+     // Follow the deep investigation as the model writes it
+     const streamDeep = incident?.incident_stage === 'INVESTIGATING' && !incident?.deep_investigation
+          && jobs.deep_investigation?.status !== 'failed';
+     useEffect(() => {
+          if (!incident?._id || !streamDeep) return;
+          const source = new EventSource(`${import.meta.env.VITE_API_BASE_URL}/incidents/${incident._id}/deep-investigation/stream`);
+          source.addEventListener('delta', (e) => setLiveText((text) => text + JSON.parse(e.data).text));
+          source.addEventListener('result', (e) => {
+               const report = JSON.parse(e.data);
+               setReports((current) => ({ ...current, deep_investigation: report }));
+               setJobs((current) => ({ ...current, deep_investigation: { ...current.deep_investigation, status: 'done' } }));
+               source.close();
+          });
+          source.addEventListener('failed', (e) => {
+               setJobs((current) => ({ ...current, deep_investigation: { ...current.deep_investigation, status: 'failed', error: JSON.parse(e.data) } }));
+               source.close();
+          });
+          // Server errors (409/404) end the stream instead of reconnecting
+          source.onerror = () => source.close();
+          return () => source.close();
+     }, [incident?._id, streamDeep]);
+
+     const retryJob = async (kind) => {
+          const res = await fetch(`${import.meta.env.VITE_API_BASE_URL}/incidents/${incident._id}/jobs/${kind}/retry`, { method: 'POST' });
+          if (res.ok) setJobs((current) => ({ ...current, [kind]: { ...current[kind], status: 'pending' } }));
+     };
+
+     const deepInvestigation = reports.deep_investigation || incident?.deep_investigation;
+     const closureReport = reports.closure_report || incident?.closure_report;
+
+     useEffect(() => {
+          if (!incident?._id) return;
+          let cancelled = false;
+          fetch(`${import.meta.env.VITE_API_BASE_URL}/incidents/${incident._id}/chain`)
+               .then((res) => (res.ok ? res.json() : null))
+               .then((data) => { if (!cancelled) setChain(data); })
+               .catch(() => { if (!cancelled) setChain(null); });
+          return () => { cancelled = true; };
+     }, [incident?._id]);
      const severityColor = (sev) => {
           switch (sev) {
                case 'CRITICAL': return 'bg-red-500/20 text-red-500 border-red-500/30';
@@ -139,6 +218,27 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                         </div>
                                    )}
 
+                                   {/* 3.5 Attack Chain Section */}
+                                   {chain && chain.incident_count > 1 && (
+                                        <div className="bg-slate-900 border border-slate-800 rounded-xl overflow-hidden">
+                                             <div className="bg-slate-800/50 p-3 px-4 flex items-center gap-2 border-b border-slate-800">
+                                                  <GitCommit size={16} className="text-rose-400" />
+                                                  <h3 className="font-bold text-slate-300 text-sm uppercase tracking-wider">Attack Chain</h3>
+                                                  <span className="text-xs text-slate-500">{chain.incident_count} linked incidents</span>
+                                             </div>
+                                             <ol className="p-5 space-y-2 bg-slate-900/50">
+                                                  {chain.steps.map((step) => (
+                                                       <li key={step.incident_id} className={`flex gap-3 text-sm p-3 rounded-lg border ${step.incident_id === incident._id ? 'border-rose-500/40 bg-rose-500/5' : 'border-slate-800 bg-slate-900/80'}`}>
+                                                            <span className="text-slate-500 font-mono shrink-0">{new Date(step.timestamp).toLocaleTimeString()}</span>
+                                                            <span className="text-slate-200 font-semibold">{step.threat_type}</span>
+                                                            <span className="text-slate-400">{step.tactic || ''}</span>
+                                                            <span className="ml-auto text-xs text-slate-500 font-mono truncate">{(step.linked_by || []).join(', ')}</span>
+                                                       </li>
+                                                  ))}
+                                             </ol>
+                                        </div>
+                                   )}
+
                                    {/* 4. AI Investigation Section */}
                                    {incident.ai_analysis && (
                                         <div className="bg-blue-950/10 border border-blue-900/30 rounded-xl overflow-hidden relative">
@@ -185,8 +285,34 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                         </div>
                                    )}
 
+                                   {/* 4.25 Report Generation Status */}
+                                   {Object.entries(jobs).filter(([, job]) => job.status !== 'done').map(([kind, job]) => (
+                                        <div key={kind} className={`flex items-center justify-between gap-3 rounded-xl border p-4 text-sm ${job.status === 'failed' ? 'bg-rose-950/10 border-rose-900/30 text-rose-300' : 'bg-purple-950/10 border-purple-900/30 text-purple-300'}`}>
+                                             <div className="flex items-center gap-2">
+                                                  {job.status === 'failed'
+                                                       ? <AlertTriangle size={16} />
+                                                       : <Loader2 size={16} className="animate-spin" />}
+                                                  <span>
+                                                       {JOB_LABELS[kind] || kind} {job.status === 'failed' ? `failed: ${job.error || 'unknown error'}` : job.status === 'running' ? 'is being generated...' : 'is queued...'}
+                                                  </span>
+                                             </div>
+                                             {job.status === 'failed' && (
+                                                  <button onClick={() => retryJob(kind)} className="shrink-0 text-xs font-bold uppercase px-3 py-1.5 rounded bg-rose-500/10 border border-rose-500/30 hover:bg-rose-500/20">
+                                                       Retry
+                                                  </button>
+                                             )}
+                                        </div>
+                                   ))}
+
+                                   {/* 4.3 Live Deep Investigation Output */}
+                                   {liveText && !deepInvestigation && (
+                                        <pre className="bg-slate-900/80 border border-purple-900/30 rounded-xl p-4 text-xs text-purple-200/80 font-mono whitespace-pre-wrap break-words max-h-64 overflow-y-auto custom-scrollbar">
+                                             {liveText}
+                                        </pre>
+                                   )}
+
                                    {/* 4.5 Deep Investigation Section */}
-                                   {incident.deep_investigation && (
+                                   {deepInvestigation && (
                                         <div className="bg-purple-950/10 border border-purple-900/30 rounded-xl overflow-hidden relative">
                                              <div className="absolute top-0 right-0 p-4 opacity-5 pointer-events-none">
                                                   <FileText size={100} />
@@ -201,7 +327,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-purple-500"></span> Attack Path Analysis
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.deep_investigation.attack_path_analysis || 'N/A'}
+                                                            {deepInvestigation.attack_path_analysis || 'N/A'}
                                                        </p>
                                                   </div>
                                                   <div>
@@ -209,7 +335,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-emerald-500"></span> Containment Strategy
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.deep_investigation.containment_strategy || 'N/A'}
+                                                            {deepInvestigation.containment_strategy || 'N/A'}
                                                        </p>
                                                   </div>
                                                   <div>
@@ -217,7 +343,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-red-500"></span> Risk If Ignored
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.deep_investigation.risk_if_ignored || 'N/A'}
+                                                            {deepInvestigation.risk_if_ignored || 'N/A'}
                                                        </p>
                                                   </div>
                                              </div>
@@ -225,7 +351,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                    )}
 
                                    {/* 4.75 Closure Report Section */}
-                                   {incident.incident_stage === 'RESOLVED' && incident.closure_report && (
+                                   {incident.incident_stage === 'RESOLVED' && closureReport && (
                                         <div className="bg-emerald-950/10 border border-emerald-900/30 rounded-xl overflow-hidden relative">
                                              <div className="absolute top-0 right-0 p-4 opacity-5 pointer-events-none">
                                                   <CheckCircle size={100} />
@@ -240,7 +366,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-emerald-500"></span> Executive Summary
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.closure_report.executive_summary || 'N/A'}
+                                                            {closureReport.executive_summary || 'N/A'}
                                                        </p>
                                                   </div>
                                                   <div>
@@ -248,7 +374,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-emerald-500"></span> Response Actions Taken
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.closure_report.response_actions_taken || 'N/A'}
+                                                            {closureReport.response_actions_taken || 'N/A'}
                                                        </p>
                                                   </div>
                                                   <div>
@@ -256,7 +382,7 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-orange-500"></span> Residual Risk
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.closure_report.residual_risk || 'N/A'}
+                                                            {closureReport.residual_risk || 'N/A'}
                                                        </p>
                                                   </div>
                                                   <div>
@@ -264,11 +390,11 @@ export default function IncidentDrawer({ incident, onClose, onUpdateStage }) {
                                                             <span className="w-2 h-2 rounded-full bg-blue-500"></span> Lessons Learned
                                                        </h4>
                                                        <p className="text-slate-300 text-sm leading-relaxed bg-slate-900/80 p-4 rounded-lg border border-slate-800 shadow-inner">
-                                                            {incident.closure_report.lessons_learned || 'N/A'}
+                                                            {closureReport.lessons_learned || 'N/A'}
                                                        </p>
                                                   </div>
                                                   <div className="text-right text-xs text-emerald-500/50 font-mono">
-                                                       Generated at: {new Date(incident.closure_report.generated_at).toLocaleString()}
+                                                       Generated at: {new Date(closureReport.generated_at).toLocaleString()}
                                                   </div>
                                              </div>
                                         </div>
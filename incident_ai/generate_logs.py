@@ -1,6 +1,9 @@
-import json
-import random
-from datetime import datetime, timedelta
+import argparse
+import gzip
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
 
 EVENT_TYPES = [
     "login_attempt",
@@ -12,63 +15,288 @@ USERS = ["alice", "bob", "charlie", "david", "eve"]
 RESOURCES = ["auth-service", "payment-service", "admin-panel", "database"]
 COUNTRIES = ["India", "US", "Germany", "Russia", "China"]
 
-def random_ip():
-    return ".".join(str(random.randint(1, 255)) for _ in range(4))
-
-logs = []
-now = datetime.utcnow()
-
-# -----------------------------
-# Normal Activity Logs
-# -----------------------------
-for _ in range(300):
-    logs.append({
-        "@timestamp": (now - timedelta(minutes=random.randint(0, 60))).isoformat(),
-        "event_type": random.choice(EVENT_TYPES),
-        "source_ip": random_ip(),
-        "user": random.choice(USERS),
-        "action": "access",
-        "status": "SUCCESS",
-        "resource": random.choice(RESOURCES),
-        "geo_location": random.choice(COUNTRIES),
-        "severity": "LOW"
-    })
-
-# -----------------------------
-# Brute Force Attack Simulation
-# -----------------------------
-attacker_ip = random_ip()
-target_user = random.choice(USERS)
-
-for _ in range(80):
-    logs.append({
-        "@timestamp": (now - timedelta(minutes=random.randint(0, 5))).isoformat(),
-        "event_type": "login_attempt",
-        "source_ip": attacker_ip,
-        "user": target_user,
-        "action": "login",
-        "status": "FAILED",
-        "resource": "auth-service",
-        "geo_location": "Russia",
-        "severity": "HIGH"
-    })
-
-# -----------------------------
-# Privilege Escalation Attempt
-# -----------------------------
-logs.append({
-    "@timestamp": now.isoformat(),
-    "event_type": "privilege_escalation",
-    "source_ip": random_ip(),
-    "user": "bob",
-    "action": "admin_access",
-    "status": "FAILED",
-    "resource": "admin-panel",
-    "geo_location": "China",
-    "severity": "CRITICAL"
-})
-
-with open("security_logs.json", "w") as f:
-    json.dump(logs, f, indent=2)
-
-print("✅ Security attack simulation logs generated successfully.")
\ No newline at end of file
+# Share of all events produced by each attack scenario
+DEFAULT_MIX = {
+    "brute_force": 0.02,
+    "privilege_escalation": 0.0005,
+    "exfiltration": 0.005
+}
+
+# Attack campaigns reuse one attacker per window so their events cluster
+# the way a real burst does (and trip the window-based detectors)
+BRUTE_FORCE_WINDOW_SECONDS = 300
+EXFIL_WINDOW_SECONDS = 600
+
+CHUNK_SIZE = 100_000
+
+# Failure noise on ordinary traffic, so FAILED is not an attack-only value
+NORMAL_FAILURE_RATE = 0.01
+
+NORMAL, BRUTE_FORCE, PRIVILEGE_ESCALATION, EXFILTRATION = range(4)
+
+SCENARIO_KINDS = {
+    "brute_force": BRUTE_FORCE,
+    "privilege_escalation": PRIVILEGE_ESCALATION,
+    "exfiltration": EXFILTRATION
+}
+
+EVENT_TYPE_NAMES = np.array(EVENT_TYPES + ["privilege_escalation"], dtype=object)
+USER_NAMES = np.array(USERS, dtype=object)
+RESOURCE_NAMES = np.array(RESOURCES, dtype=object)
+COUNTRY_NAMES = np.array(COUNTRIES, dtype=object)
+ACTIONS = np.array(["access", "login", "admin_access", "download"], dtype=object)
+STATUSES = np.array(["SUCCESS", "FAILED"], dtype=object)
+SEVERITIES = np.array(["LOW", "HIGH", "CRITICAL"], dtype=object)
+
+# Pre-rendered JSON tail per event kind; only attacks carry a threat_type
+THREAT_TAILS = np.array([
+    "",
+    ', "threat_type": "BRUTE_FORCE"',
+    ', "threat_type": "PRIVILEGE_ESCALATION"',
+    ', "threat_type": "DATA_EXFILTRATION"'
+], dtype=object)
+
+
+# ========================
+# VECTORIZED FIELD GENERATION
+# ========================
+
+def random_ips(rng, size):
+    """Random public-looking IPv4 addresses as an (n, 4) octet array."""
+    octets = rng.integers(0, 256, size=(size, 4), dtype=np.int64)
+    octets[:, 0] = rng.integers(1, 224, size=size)
+    return octets
+
+
+class Campaigns:
+    """Attacker IP and target per time window, drawn once for the whole span."""
+
+    def __init__(self, rng, span_seconds, window_seconds):
+        self.window_seconds = window_seconds
+        windows = int(span_seconds // window_seconds) + 1
+        self.ips = random_ips(rng, windows)
+        self.users = rng.integers(0, len(USERS), size=windows)
+
+    def window_of(self, offsets):
+        return (offsets // self.window_seconds).astype(np.int64)
+
+
+def assign_kinds(rng, size, mix):
+    kinds = np.full(size, NORMAL, dtype=np.int8)
+    draw = rng.random(size)
+
+    lower = 0.0
+    for name, share in mix.items():
+        upper = lower + share
+        kinds[(draw >= lower) & (draw < upper)] = SCENARIO_KINDS[name]
+        lower = upper
+
+    return kinds
+
+
+def generate_chunk(rng, first, size, total, span_seconds, start, mix,
+                   brute_force, exfil):
+    """Draw one chunk of events as column arrays."""
+
+    # Arrivals are spread evenly across the span with jitter, which keeps
+    # the output time-ordered and close to the requested event rate
+    offsets = (np.arange(first, first + size) + rng.random(size)) * (span_seconds / total)
+    timestamps = start + (offsets * 1e6).astype("timedelta64[us]")
+
+    kinds = assign_kinds(rng, size, mix)
+
+    cols = {
+        "timestamp": np.datetime_as_string(timestamps, unit="us"),
+        "event_type": rng.integers(0, len(EVENT_TYPES), size=size),
+        "ip": random_ips(rng, size),
+        "user": rng.integers(0, len(USERS), size=size),
+        "action": np.zeros(size, dtype=np.int64),
+        "status": (rng.random(size) < NORMAL_FAILURE_RATE).astype(np.int64),
+        "resource": rng.integers(0, len(RESOURCES), size=size),
+        "country": rng.integers(0, len(COUNTRIES), size=size),
+        "severity": np.zeros(size, dtype=np.int64),
+        "risk_score": rng.integers(0, 31, size=size),
+        "bytes_out": rng.lognormal(8, 1.5, size=size).astype(np.int64),
+        "kind": kinds
+    }
+
+    # -----------------------------
+    # Brute Force Attack Simulation
+    # -----------------------------
+    mask = kinds == BRUTE_FORCE
+    if mask.any():
+        window = brute_force.window_of(offsets[mask])
+        cols["event_type"][mask] = EVENT_TYPES.index("login_attempt")
+        cols["ip"][mask] = brute_force.ips[window]
+        cols["user"][mask] = brute_force.users[window]
+        cols["action"][mask] = 1
+        cols["status"][mask] = 1
+        cols["resource"][mask] = RESOURCES.index("auth-service")
+        cols["country"][mask] = COUNTRIES.index("Russia")
+        cols["severity"][mask] = 1
+        cols["risk_score"][mask] = rng.integers(60, 101, size=mask.sum())
+
+    # -----------------------------
+    # Privilege Escalation Attempt
+    # -----------------------------
+    mask = kinds == PRIVILEGE_ESCALATION
+    if mask.any():
+        cols["event_type"][mask] = len(EVENT_TYPES)
+        cols["action"][mask] = 2
+        cols["status"][mask] = 1
+        cols["resource"][mask] = RESOURCES.index("admin-panel")
+        cols["country"][mask] = COUNTRIES.index("China")
+        cols["severity"][mask] = 2
+        cols["risk_score"][mask] = 95
+
+    # -----------------------------
+    # Data Exfiltration Burst
+    # -----------------------------
+    mask = kinds == EXFILTRATION
+    if mask.any():
+        window = exfil.window_of(offsets[mask])
+        cols["event_type"][mask] = EVENT_TYPES.index("file_access")
+        cols["ip"][mask] = exfil.ips[window]
+        cols["user"][mask] = exfil.users[window]
+        cols["action"][mask] = 3
+        cols["status"][mask] = 0
+        cols["resource"][mask] = RESOURCES.index("database")
+        cols["severity"][mask] = 1
+        cols["risk_score"][mask] = rng.integers(80, 96, size=mask.sum())
+        cols["bytes_out"][mask] = rng.lognormal(17, 1, size=mask.sum()).astype(np.int64)
+
+    return cols
+
+
+def render_chunk(cols):
+    """Render column arrays as NDJSON text."""
+    ip = cols["ip"]
+
+    rows = zip(
+        cols["timestamp"].tolist(),
+        EVENT_TYPE_NAMES[cols["event_type"]].tolist(),
+        ip[:, 0].tolist(), ip[:, 1].tolist(), ip[:, 2].tolist(), ip[:, 3].tolist(),
+        USER_NAMES[cols["user"]].tolist(),
+        ACTIONS[cols["action"]].tolist(),
+        STATUSES[cols["status"]].tolist(),
+        RESOURCE_NAMES[cols["resource"]].tolist(),
+        COUNTRY_NAMES[cols["country"]].tolist(),
+        SEVERITIES[cols["severity"]].tolist(),
+        cols["risk_score"].tolist(),
+        cols["bytes_out"].tolist(),
+        THREAT_TAILS[cols["kind"]].tolist()
+    )
+
+    return "".join([
+        f'{{"@timestamp": "{ts}", "event_type": "{event_type}", '
+        f'"source_ip": "{a}.{b}.{c}.{d}", "user": "{user}", "action": "{action}", '
+        f'"status": "{status}", "resource": "{resource}", "geo_location": "{country}", '
+        f'"severity": "{severity}", "risk_score": {risk}, "bytes_out": {bytes_out}{tail}}}\n'
+        for ts, event_type, a, b, c, d, user, action, status, resource, country,
+        severity, risk, bytes_out, tail in rows
+    ])
+
+
+# ========================
+# STREAMING WRITER
+# ========================
+
+def generate_logs(output, total, span_seconds, end=None, seed=None, mix=None,
+                  chunk_size=CHUNK_SIZE, compress=False):
+    """
+    Stream `total` synthetic security events covering `span_seconds` that
+    end at `end` into an NDJSON file. Returns the number of bytes written.
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    if sum(mix.values()) >= 1:
+        raise ValueError("Attack scenario shares must sum to less than 1")
+
+    rng = np.random.default_rng(seed)
+    end = end or datetime.utcnow()
+    if end.tzinfo is not None:
+        # NumPy datetimes are naive; timestamps are written as UTC
+        end = end.astimezone(timezone.utc).replace(tzinfo=None)
+    start = np.datetime64(end - timedelta(seconds=span_seconds), "us")
+
+    brute_force = Campaigns(rng, span_seconds, BRUTE_FORCE_WINDOW_SECONDS)
+    exfil = Campaigns(rng, span_seconds, EXFIL_WINDOW_SECONDS)
+
+    if compress:
+        # Fastest level: the generator should not become CPU-bound on gzip
+        f = gzip.open(output, "wt", encoding="utf-8", compresslevel=1)
+    else:
+        f = open(output, "w", encoding="utf-8")
+
+    written = 0
+
+    with f:
+        for first in range(0, total, chunk_size):
+            size = min(chunk_size, total - first)
+            cols = generate_chunk(
+                rng, first, size, total, span_seconds, start, mix, brute_force, exfil
+            )
+            text = render_chunk(cols)
+            f.write(text)
+            written += len(text)
+
+    return written
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, share = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIO_KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown attack scenario: {name}")
+        mix[name] = float(share)
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate synthetic security logs for load testing")
+    parser.add_argument("--output", default="security_logs.ndjson",
+                        help="Destination NDJSON file")
+    parser.add_argument("--gzip", action="store_true", help="Gzip-compress the output")
+    parser.add_argument("--events", type=int,
+                        help="Total events to generate (defaults to rate x span)")
+    parser.add_argument("--rate", type=float, default=50.0,
+                        help="Target event rate in events per second")
+    parser.add_argument("--span", type=float, default=3600.0,
+                        help="Time span covered by the events, in seconds")
+    parser.add_argument("--end", type=datetime.fromisoformat,
+                        help="ISO timestamp of the last event (defaults to now, UTC)")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible output")
+    parser.add_argument("--mix", type=parse_mix,
+                        help="Attack shares, e.g. brute_force=0.02,privilege_escalation=0.0005,exfiltration=0.005")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="Events generated and written per batch")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    total = args.events if args.events is not None else int(args.rate * args.span)
+
+    started = time.perf_counter()
+    written = generate_logs(
+        args.output,
+        total,
+        args.span,
+        end=args.end,
+        seed=args.seed,
+        mix=args.mix,
+        chunk_size=args.chunk_size,
+        compress=args.gzip
+    )
+    elapsed = max(time.perf_counter() - started, 1e-9)
+
+    print(f"✅ Generated {total:,} security events into {args.output}")
+    print(
+        f"📈 {elapsed:.2f}s, {total / elapsed:,.0f} events/s, "
+        f"{written / (1024 * 1024) / elapsed:.1f} MB/s (uncompressed)"
+    )
+
+
+if __name__ == "__main__":
+    main()
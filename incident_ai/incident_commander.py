@@ -1,54 +1,54 @@
-import os
-from dotenv import load_dotenv
-load_dotenv()
-from elasticsearch import Elasticsearch
 import json
-from datetime import datetime, timezone, timedelta
+import time
+from datetime import datetime, timezone
 from backend.mitre_mapper import map_to_mitre 
-from elasticsearch import NotFoundError
+from query_cache import invalidate_incident_views
+from es_client import get_client
+from correlation_store import occurrence_store
+from attack_chains import record_incidents
+from watermarks import load_watermark, new_events_filter, save_watermark, scan_upper_bound
 
-# ========================
-# CONFIGURATION
-# ========================
+# Raw events written by ingest_logs.py
+EVENTS_INDEX = "security-events"
+INCIDENTS_INDEX = "incidents"
 
-ELASTIC_CLOUD_ID = os.getenv("ELASTIC_CLOUD_ID")
-USERNAME = os.getenv("ELASTIC_USERNAME", "elastic")
-PASSWORD = os.getenv("ELASTIC_PASSWORD")
+RISK_THRESHOLD = 70
+REPEAT_OFFENDER_THRESHOLD = 3
 
+# Watermark names (see watermarks.py)
+SINGLE_DETECTOR = "incident_commander"
+BATCH_DETECTOR = "incident_commander_batch"
 
-
-# ========================
-# CONNECT ELASTIC
-# ========================
-
-es = Elasticsearch(
-    cloud_id=ELASTIC_CLOUD_ID,
-    basic_auth=(USERNAME, PASSWORD)
-)
-
+# Batch mode: how far back the first run looks, and groups per composite page
+BATCH_WINDOW_MINUTES = 15
+BATCH_PAGE_SIZE = 1000
 
 # ========================
 # TOOL 1: Detect High-Risk Security Events
 # ========================
 
-def detect_security_threat():
-    query = {
-        "query": {
-            "range": {
-                "risk_score": {"gte": 70}
-            }
-        },
-        "sort": [{"@timestamp": {"order": "desc"}}],
-        "size": 1
-    }
-
-    response = es.search(index="security-logs", body=query)
+def detect_security_threat(watermark=None, upper=None):
+    """
+    Oldest high-risk event after the detector's watermark. Each run consumes
+    one event, so successive runs walk through every event exactly once.
+    """
+    upper = upper or scan_upper_bound()
+    query = new_events_filter(watermark, upper)
+    query["bool"]["filter"].append({"range": {"risk_score": {"gte": RISK_THRESHOLD}}})
+
+    es = get_client("detection")
+    response = es.search(
+        index=EVENTS_INDEX,
+        query=query,
+        sort=[{"@timestamp": {"order": "asc", "format": "strict_date_optional_time_nanos"}}],
+        size=1
+    )
     hits = response["hits"]["hits"]
 
     if not hits:
         return None
 
-    return hits[0]["_source"]
+    return hits[0]
 
 
 # ========================
@@ -70,111 +70,50 @@ def generate_ai_analysis(threat):
 
 
 def is_duplicate_incident(source_ip, threat_type):
-    ten_minutes_ago = datetime.now(timezone.utc) - timedelta(minutes=10)
-
-    query = {
-        "query": {
-            "bool": {
-                "must": [
-                    {"match": {"source_ip": source_ip}},
-                    {"match": {"threat_type": threat_type}},
-                    {
-                        "range": {
-                            "@timestamp": {
-                                "gte": ten_minutes_ago.isoformat()
-                            }
-                        }
-                    }
-                ]
-            }
-        }
-    }
+    occurrence_store.ensure_warm(get_client("detection"))
+    return occurrence_store.is_duplicate(source_ip, threat_type)
 
-    try:
-        response = es.search(index="incidents", body=query)
-        return response["hits"]["total"]["value"] > 0
-    except NotFoundError:
-        # If incidents index does not exist yet, no duplicate
-        return False
 
 def count_recent_occurrences(source_ip, threat_type):
-    thirty_minutes_ago = datetime.now(timezone.utc) - timedelta(minutes=30)
-
-    query = {
-        "query": {
-            "bool": {
-                "must": [
-                    {"match": {"source_ip": source_ip}},
-                    {"match": {"threat_type": threat_type}},
-                    {
-                        "range": {
-                            "@timestamp": {
-                                "gte": thirty_minutes_ago.isoformat()
-                            }
-                        }
-                    }
-                ]
-            }
-        }
-    }
-
-    try:
-        response = es.search(index="incidents", body=query)
-        return response["hits"]["total"]["value"]
-    except NotFoundError:
-        # If incidents index does not exist yet, no previous occurrences
-        return 0
+    occurrence_store.ensure_warm(get_client("detection"))
+    return occurrence_store.occurrences(source_ip, threat_type)
 
 
 # ========================
-# MAIN ORCHESTRATOR (SOC MODE)
+# INCIDENT BUILDING (shared by single and batch mode)
 # ========================
 
-def run_incident_commander():
-
-    print("🚨 Running SOC Threat Detection...\n")
-
-    threat = detect_security_threat()
-
-    if not threat:
-        return {"status": "NO_INCIDENT"}
-
-    risk_score = threat.get("risk_score", 0)
-
+def severity_for(risk_score):
     if risk_score >= 90:
-        severity = "CRITICAL"
-    elif risk_score >= 70:
-        severity = "HIGH"
-    else:
-        severity = "MEDIUM"
+        return "CRITICAL"
+    elif risk_score >= RISK_THRESHOLD:
+        return "HIGH"
+    return "MEDIUM"
+
 
-    ai_analysis = generate_ai_analysis(threat)
-    mitre_info = map_to_mitre(threat.get("threat_type"))
+def resolve_mitre(threat_type):
+    mitre_info = map_to_mitre(threat_type)
 
     if not mitre_info:
         from backend.mitre_mapper import ai_mitre_fallback
-        mitre_info = ai_mitre_fallback(threat.get("threat_type"))
+        mitre_info = ai_mitre_fallback(threat_type)
 
-    source_ip = threat.get("source_ip")
-    threat_type = threat.get("threat_type")
+    return mitre_info
 
-    if is_duplicate_incident(source_ip, threat_type):
-        return {
-            "status": "DUPLICATE_SKIPPED",
-            "message": "Incident already exists within last 10 minutes."
-        }
 
-    occurrence_count = count_recent_occurrences(source_ip, threat_type) + 1
+def build_incident(threat, occurrence_count):
+    risk_score = threat.get("risk_score", 0)
+    severity = severity_for(risk_score)
 
     repeat_offender = False
 
-    if occurrence_count >= 3:
+    if occurrence_count >= REPEAT_OFFENDER_THRESHOLD:
         repeat_offender = True
         severity = "CRITICAL"
 
     current_time = datetime.now(timezone.utc).isoformat()
 
-    incident_data = {
+    return {
         "status": "INCIDENT_FOUND",
         "incident_stage": "OPEN",
         "created_at": current_time,
@@ -193,19 +132,258 @@ def run_incident_commander():
         "severity": severity,
         "repeat_offender": repeat_offender,
         "occurrence_count": occurrence_count,
-        "ai_analysis": ai_analysis,
-        "mitre": mitre_info
+        "ai_analysis": generate_ai_analysis(threat),
+        "mitre": resolve_mitre(threat.get("threat_type"))
     }
 
+
+# ========================
+# MAIN ORCHESTRATOR (SOC MODE)
+# ========================
+
+def run_incident_commander():
+
+    print("🚨 Running SOC Threat Detection...\n")
+
+    es = get_client("detection")
+    watermark = load_watermark(es, SINGLE_DETECTOR)
+
+    hit = detect_security_threat(watermark)
+
+    if not hit:
+        return {"status": "NO_INCIDENT"}
+
+    threat = hit["_source"]
+
+    # The watermark moves past this event once it is handled (skipped as a
+    # duplicate or written as an incident), so a failed write retries it.
+    # Events sharing its timestamp are told apart by id.
+    event_time = hit["sort"][0]
+    seen_ids = watermark["ids"] if watermark and watermark["timestamp"] == event_time else []
+    seen_ids = seen_ids + [hit["_id"]]
+
+    source_ip = threat.get("source_ip")
+    threat_type = threat.get("threat_type")
+
+    if is_duplicate_incident(source_ip, threat_type):
+        save_watermark(es, SINGLE_DETECTOR, event_time, seen_ids)
+        return {
+            "status": "DUPLICATE_SKIPPED",
+            "message": f"Incident already exists within last {occurrence_store.dedup_seconds // 60} minutes."
+        }
+
+    occurrence_count = count_recent_occurrences(source_ip, threat_type) + 1
+
+    incident_data = build_incident(threat, occurrence_count)
+
     save_incident(incident_data)
+    save_watermark(es, SINGLE_DETECTOR, event_time, seen_ids)
     return incident_data
 
 
+# ========================
+# BATCH MODE: every high-risk event in the window
+# ========================
+
+def iter_threat_groups(es, watermark, upper, window_minutes=BATCH_WINDOW_MINUTES,
+                       page_size=BATCH_PAGE_SIZE):
+    """
+    Page through all events with risk_score >= RISK_THRESHOLD between the
+    watermark and `upper` (the last `window_minutes` on a first run), grouped
+    by (source_ip, threat_type, user) with a composite aggregation.
+    Yields one summary dict per group; the events themselves never leave ES.
+    """
+    query = new_events_filter(watermark, upper, lookback_minutes=window_minutes)
+    query["bool"]["filter"].append({"range": {"risk_score": {"gte": RISK_THRESHOLD}}})
+
+    composite = {
+        "size": page_size,
+        "sources": [
+            {"source_ip": {"terms": {"field": "source_ip"}}},
+            {"threat_type": {"terms": {"field": "threat_type"}}},
+            {"user": {"terms": {"field": "user", "missing_bucket": True}}}
+        ]
+    }
+
+    while True:
+        response = es.search(
+            index=EVENTS_INDEX,
+            query=query,
+            size=0,
+            aggs={
+                "groups": {
+                    "composite": composite,
+                    "aggs": {
+                        "max_risk": {"max": {"field": "risk_score"}},
+                        "first_seen": {"min": {"field": "@timestamp"}},
+                        "last_seen": {"max": {"field": "@timestamp"}}
+                    }
+                }
+            }
+        )
+
+        groups = response["aggregations"]["groups"]
+
+        for bucket in groups["buckets"]:
+            yield {
+                "source_ip": bucket["key"]["source_ip"],
+                "threat_type": bucket["key"]["threat_type"],
+                "user": bucket["key"]["user"],
+                "risk_score": int(bucket["max_risk"]["value"]),
+                "event_count": bucket["doc_count"],
+                "first_seen": bucket["first_seen"]["value_as_string"],
+                "last_seen": bucket["last_seen"]["value_as_string"]
+            }
+
+        after_key = groups.get("after_key")
+        if not after_key or len(groups["buckets"]) < page_size:
+            return
+        composite["after"] = after_key
+
+
+def merge_user_groups(groups):
+    """
+    Fold the per-user groups of each (source_ip, threat_type) pair into one
+    summary: events are summed, the time span widened to cover them all and
+    the users collected. The highest-risk named user leads the incident.
+    """
+    pairs = {}
+    for group in groups:
+        key = (group["source_ip"], group["threat_type"])
+        pair = pairs.get(key)
+
+        if pair is None:
+            pairs[key] = dict(group, users=[group["user"]] if group["user"] else [])
+            continue
+
+        if group["risk_score"] > pair["risk_score"]:
+            pair["risk_score"] = group["risk_score"]
+            pair["user"] = group["user"] or pair["user"]
+        elif not pair["user"]:
+            pair["user"] = group["user"]
+        pair["event_count"] += group["event_count"]
+        pair["first_seen"] = min(pair["first_seen"], group["first_seen"])
+        pair["last_seen"] = max(pair["last_seen"], group["last_seen"])
+        if group["user"] and group["user"] not in pair["users"]:
+            pair["users"].append(group["user"])
+
+    return list(pairs.values())
+
+
+def save_incidents_bulk(es, incidents):
+    """Write all incidents in one `_bulk` request; returns (created, failed)."""
+    operations = []
+    for incident_data in incidents:
+        stamp_incident(incident_data)
+        operations.append({"create": {"_index": INCIDENTS_INDEX}})
+        operations.append(incident_data)
+
+    response = es.bulk(operations=operations, refresh="wait_for")
+
+    failed = []
+    for incident_data, item in zip(incidents, response["items"]):
+        outcome = item["create"]
+        if outcome.get("status", 500) >= 300:
+            failed.append({
+                "source_ip": incident_data["source_ip"],
+                "threat_type": incident_data["threat_type"],
+                "error": outcome.get("error")
+            })
+        else:
+            incident_data["incident_id"] = outcome["_id"]
+            occurrence_store.record_incident(incident_data)
+
+    # Invalidate once the chains are updated, so no view is reloaded
+    # in between and cached with the old chain
+    record_incidents(es, incidents)
+    invalidate_incident_views()
+    return len(incidents) - len(failed), failed
+
+
+def run_batch_detection(window_minutes=BATCH_WINDOW_MINUTES):
+
+    es = get_client("detection")
+    started = time.perf_counter()
+
+    watermark = load_watermark(es, BATCH_DETECTOR)
+    upper = scan_upper_bound()
+    scanned_from = watermark["timestamp"] if watermark else f"now-{window_minutes}m"
+
+    print(f"🚨 Running SOC Threat Detection (batch, {scanned_from} → {upper})...\n")
+
+    groups = list(iter_threat_groups(es, watermark, upper, window_minutes))
+
+    if not groups:
+        save_watermark(es, BATCH_DETECTOR, upper, stats={"events": 0, "groups": 0})
+        return {"status": "NO_INCIDENT", "scanned_from": scanned_from, "scanned_to": upper}
+
+    occurrence_store.ensure_warm(es)
+
+    incidents = []
+    duplicates = 0
+
+    # Users of one (IP, threat) pair share an incident, and the pair
+    # follows the same dedup rule as single mode
+    for pair in merge_user_groups(groups):
+        key = (pair["source_ip"], pair["threat_type"])
+
+        if occurrence_store.is_duplicate(*key):
+            duplicates += 1
+            continue
+
+        incident_data = build_incident(pair, occurrence_store.occurrences(*key) + 1)
+        incident_data["users"] = pair["users"]
+        incident_data["event_count"] = pair["event_count"]
+        incident_data["first_seen"] = pair["first_seen"]
+        incident_data["last_seen"] = pair["last_seen"]
+        incidents.append(incident_data)
+
+    created, failed = save_incidents_bulk(es, incidents) if incidents else (0, [])
+
+    by_severity = {}
+    for incident_data in incidents:
+        if "incident_id" in incident_data:
+            by_severity[incident_data["severity"]] = by_severity.get(incident_data["severity"], 0) + 1
+
+    summary = {
+        "status": "BATCH_COMPLETE",
+        "scanned_from": scanned_from,
+        "scanned_to": upper,
+        "events": sum(group["event_count"] for group in groups),
+        "groups": len(groups),
+        "created": created,
+        "duplicates_skipped": duplicates,
+        "failed": failed,
+        "by_severity": by_severity,
+        "incident_ids": [i["incident_id"] for i in incidents if "incident_id" in i],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+    # Only advance once every incident is written; a run with failed
+    # writes rescans the same range and the correlation store drops the
+    # incidents that did make it as duplicates
+    if failed:
+        print(f"⚠️ {len(failed)} incidents not written; watermark stays at {scanned_from}")
+    else:
+        save_watermark(es, BATCH_DETECTOR, upper, stats={
+            "events": summary["events"],
+            "groups": summary["groups"],
+            "created": created,
+            "elapsed_ms": summary["elapsed_ms"]
+        })
+
+    print(
+        f"✅ {summary['events']} events in {summary['groups']} groups → "
+        f"{created} incidents, {duplicates} duplicates skipped, {len(failed)} failed"
+    )
+    return summary
+
+
 # ========================
 # SAVE INCIDENT TO ELASTIC
 # ========================
 
-def save_incident(incident_data):
+def stamp_incident(incident_data):
     # Preserve created_at if exists, otherwise initialize
     if "created_at" not in incident_data:
         incident_data["created_at"] = datetime.now(timezone.utc).isoformat()
@@ -216,11 +394,29 @@ def save_incident(incident_data):
     # Elasticsearch primary timestamp
     incident_data["@timestamp"] = incident_data["updated_at"]
 
-    es.index(
-        index="incidents",
-        document=incident_data
+
+def save_incident(incident_data):
+    stamp_incident(incident_data)
+
+    # `incidents` is a data stream, which only accepts op_type=create.
+    # Wait for the refresh so cached views reloaded after invalidation see it.
+    es = get_client("detection")
+    response = es.index(
+        index=INCIDENTS_INDEX,
+        document=incident_data,
+        op_type="create",
+        refresh="wait_for"
     )
+    incident_data["incident_id"] = response["_id"]
+    occurrence_store.record_incident(incident_data)
+    record_incidents(es, [incident_data])
+    invalidate_incident_views()
 
 
 if __name__ == "__main__":
-    run_incident_commander()
\ No newline at end of file
+    import sys
+
+    if "--batch" in sys.argv:
+        run_batch_detection()
+    else:
+        run_incident_commander()
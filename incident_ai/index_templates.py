@@ -0,0 +1,286 @@
+import argparse
+
+from elasticsearch import ApiError, NotFoundError
+
+from es_client import get_client
+
+# ========================
+# INDEX TEMPLATES & DATA STREAMS
+# ========================
+#
+# `security-events`, `service-logs` and `incidents` are time-based data streams. Every
+# detection and dedup query is bounded on @timestamp, so Elasticsearch's
+# can-match phase skips backing indices whose time range cannot match and
+# only the newest one is actually searched.
+#
+# Explicit mappings make the hot fields `keyword` / `ip` so detectors can
+# use cheap `term` filters and aggregations. Narrative payloads written by
+# the AI stages are kept in `_source` only (`enabled: false`): they are
+# returned to the UI but never searched, so indexing them is wasted work.
+
+SECURITY_EVENTS = "security-events"
+SERVICE_LOGS = "service-logs"
+INCIDENTS = "incidents"
+
+REPORT_JOB_FIELDS = {
+    "status": {"type": "keyword"},
+    "queued_at": {"type": "date"},
+    "started_at": {"type": "date"},
+    "finished_at": {"type": "date"},
+    "attempts": {"type": "short"},
+    "duration_ms": {"type": "float", "index": False},
+    "error": {"type": "keyword", "index": False, "ignore_above": 1024}
+}
+
+STRINGS_AS_KEYWORDS = {
+    "strings_as_keywords": {
+        "match_mapping_type": "string",
+        "mapping": {"type": "keyword", "ignore_above": 1024}
+    }
+}
+
+LIFECYCLE_POLICIES = {
+    # High-volume raw telemetry: roll daily, keep 30 days
+    "security-events-policy": {
+        "phases": {
+            "hot": {
+                "actions": {
+                    "rollover": {"max_age": "1d", "max_primary_shard_size": "50gb"}
+                }
+            },
+            "delete": {
+                "min_age": "30d",
+                "actions": {"delete": {}}
+            }
+        }
+    },
+    # Application logs feed the service health baselines: keep 7 days
+    "service-logs-policy": {
+        "phases": {
+            "hot": {
+                "actions": {
+                    "rollover": {"max_age": "1d", "max_primary_shard_size": "50gb"}
+                }
+            },
+            "delete": {
+                "min_age": "7d",
+                "actions": {"delete": {}}
+            }
+        }
+    },
+    # Incidents are the audit trail: roll weekly, never delete automatically
+    "incidents-policy": {
+        "phases": {
+            "hot": {
+                "actions": {
+                    "rollover": {"max_age": "7d", "max_primary_shard_size": "50gb"}
+                }
+            }
+        }
+    }
+}
+
+INDEX_TEMPLATES = {
+    SECURITY_EVENTS: {
+        "index_patterns": [f"{SECURITY_EVENTS}*"],
+        "data_stream": {},
+        "priority": 200,
+        "template": {
+            "settings": {
+                "index.lifecycle.name": "security-events-policy",
+                "index.refresh_interval": "5s"
+            },
+            "mappings": {
+                "dynamic_templates": [STRINGS_AS_KEYWORDS],
+                "properties": {
+                    "@timestamp": {"type": "date"},
+                    "ingested_at": {"type": "date"},
+                    "event_type": {"type": "keyword"},
+                    "source_ip": {"type": "ip"},
+                    "user": {"type": "keyword"},
+                    "status": {"type": "keyword"},
+                    "resource": {"type": "keyword"},
+                    "geo_location": {"type": "keyword"},
+                    "severity": {"type": "keyword"},
+                    "threat_type": {"type": "keyword"},
+                    "risk_score": {"type": "short"},
+                    "bytes_out": {"type": "long"},
+                    # Filtered on occasionally, never sorted or aggregated
+                    "action": {"type": "keyword", "doc_values": False},
+                    "message": {"type": "text"}
+                }
+            }
+        }
+    },
+    SERVICE_LOGS: {
+        "index_patterns": [f"{SERVICE_LOGS}*"],
+        "data_stream": {},
+        "priority": 200,
+        "template": {
+            "settings": {
+                "index.lifecycle.name": "service-logs-policy",
+                "index.refresh_interval": "5s"
+            },
+            "mappings": {
+                "dynamic_templates": [STRINGS_AS_KEYWORDS],
+                "properties": {
+                    "@timestamp": {"type": "date"},
+                    "ingested_at": {"type": "date"},
+                    "service_name": {"type": "keyword"},
+                    "log_level": {"type": "keyword"},
+                    "error_code": {"type": "keyword"},
+                    "host": {"type": "keyword"},
+                    "response_time_ms": {"type": "integer"},
+                    "message": {"type": "keyword", "ignore_above": 1024}
+                }
+            }
+        }
+    },
+    INCIDENTS: {
+        "index_patterns": [f"{INCIDENTS}*"],
+        "data_stream": {},
+        "priority": 200,
+        "template": {
+            "settings": {
+                "index.lifecycle.name": "incidents-policy"
+            },
+            "mappings": {
+                "dynamic_templates": [STRINGS_AS_KEYWORDS],
+                "properties": {
+                    "@timestamp": {"type": "date"},
+                    "created_at": {"type": "date"},
+                    "updated_at": {"type": "date"},
+                    "status": {"type": "keyword"},
+                    "incident_stage": {"type": "keyword"},
+                    "threat_type": {"type": "keyword"},
+                    "source_ip": {"type": "ip"},
+                    "user": {"type": "keyword"},
+                    "users": {"type": "keyword"},
+                    "severity": {"type": "keyword"},
+                    "risk_score": {"type": "short"},
+                    "repeat_offender": {"type": "boolean"},
+                    "occurrence_count": {"type": "integer"},
+                    # Batch detection: events folded into the incident
+                    "event_count": {"type": "integer"},
+                    "first_seen": {"type": "date"},
+                    "last_seen": {"type": "date"},
+                    # Service health incidents
+                    "service": {"type": "keyword"},
+                    "error_count": {"type": "integer"},
+                    "root_cause": {"type": "keyword", "ignore_above": 1024},
+                    "mitre": {
+                        "properties": {
+                            "tactic": {"type": "keyword"},
+                            "technique": {"type": "keyword"},
+                            "confidence": {"type": "float", "index": False}
+                        }
+                    },
+                    # Background report generation, one job per report kind
+                    "report_jobs": {
+                        "properties": {
+                            kind: {"properties": REPORT_JOB_FIELDS}
+                            for kind in ("deep_investigation", "closure_report")
+                        }
+                    },
+                    # Stored for display only
+                    "ai_analysis": {"type": "object", "enabled": False},
+                    "deep_investigation": {"type": "object", "enabled": False},
+                    "closure_report": {"type": "object", "enabled": False},
+                    "history": {"type": "object", "enabled": False}
+                }
+            }
+        }
+    }
+}
+
+
+# Mutable documents (merged and rewritten as chains grow), so a plain
+# index rather than a data stream; created on first write
+PLAIN_INDEX_TEMPLATES = {
+    "attack-chains": {
+        "index_patterns": ["attack-chains"],
+        "priority": 200,
+        "template": {
+            "mappings": {
+                "dynamic_templates": [STRINGS_AS_KEYWORDS],
+                "properties": {
+                    "chain_id": {"type": "keyword"},
+                    "incident_ids": {"type": "keyword"},
+                    "incident_count": {"type": "integer"},
+                    "source_ips": {"type": "ip"},
+                    "users": {"type": "keyword"},
+                    "resources": {"type": "keyword"},
+                    "threat_types": {"type": "keyword"},
+                    "tactics": {"type": "keyword"},
+                    "first_seen": {"type": "date"},
+                    "last_seen": {"type": "date"},
+                    "updated_at": {"type": "date"},
+                    "max_risk_score": {"type": "short"},
+                    "severity": {"type": "keyword"},
+                    "steps": {"type": "object", "enabled": False}
+                }
+            }
+        }
+    }
+}
+
+
+def install_templates(es):
+    for name, policy in LIFECYCLE_POLICIES.items():
+        es.ilm.put_lifecycle(name=name, policy=policy)
+        print(f"📜 Lifecycle policy '{name}' installed")
+
+    for name, template in {**INDEX_TEMPLATES, **PLAIN_INDEX_TEMPLATES}.items():
+        es.indices.put_index_template(name=name, **template)
+        print(f"🧩 Index template '{name}' installed")
+
+
+def ensure_data_stream(es, name):
+    """Create the data stream unless it (or a legacy plain index) exists."""
+    if es.indices.exists(index=name):
+        try:
+            es.indices.get_data_stream(name=name)
+        except NotFoundError:
+            print(
+                f"⚠️ '{name}' is a plain index with dynamic mappings. Reindex it into "
+                f"the data stream (e.g. rename it, then _reindex with op_type=create) "
+                f"to get the new mappings."
+            )
+        return
+
+    try:
+        es.indices.create_data_stream(name=name)
+        print(f"🌊 Data stream '{name}' created")
+    except ApiError as e:
+        if e.meta.status != 400:
+            raise
+        print(f"ℹ️ Data stream '{name}' already exists")
+
+
+def bootstrap(es):
+    install_templates(es)
+    for name in INDEX_TEMPLATES:
+        ensure_data_stream(es, name)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Install index templates and data streams")
+    parser.add_argument("--templates-only", action="store_true",
+                        help="Install policies and templates without creating data streams")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    es = get_client()
+
+    if args.templates_only:
+        install_templates(es)
+    else:
+        bootstrap(es)
+
+    print("✅ Elasticsearch bootstrap complete")
+
+
+if __name__ == "__main__":
+    main()
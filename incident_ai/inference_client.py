@@ -0,0 +1,615 @@
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from elastic_transport import ConnectionError as TransportConnectionError, ConnectionTimeout
+from elasticsearch import ApiError
+
+from es_client import base_url, get_client
+
+# ========================
+# INFERENCE CLIENT
+# ========================
+#
+# Every LLM call goes through this one client:
+#
+#   - a deadline per call, by kind of report (an analysis should not wait
+#     as long as a deep investigation), instead of the transport default,
+#   - a circuit breaker: after BREAKER_FAILURES consecutive endpoint
+#     failures (timeouts, 429, 5xx, connection errors) calls fail at once
+#     with CircuitOpen for BREAKER_RESET_SECONDS, so generators fall back
+#     to their fallback payloads instead of queueing on a dead endpoint;
+#     then a single trial call decides whether to close it again,
+#   - one retry budget shared by every caller in the process: retries may
+#     add at most RETRY_RATIO of the recent request volume (plus a small
+#     floor), so retries cannot multiply the load of an endpoint that is
+#     already struggling,
+#   - metrics: latency histograms per kind, request/response sizes with
+#     estimated token counts, and failures by reason (GET /inference).
+#
+# `stream_async` calls the streaming completion API and yields the output
+# as it arrives. The Elasticsearch transport reads whole bodies, so
+# streams go over a plain httpx client with the same credentials.
+#
+# INFERENCE_URL points the inference workload at another endpoint, e.g.
+# the local stub started with `python inference_client.py --stub`.
+
+# We will use Elastic's built-in Gemini model endpoint
+INFERENCE_ID = ".google-gemini-2.5-flash-completion"
+
+INFERENCE_HEADERS = {
+    "Content-Type": "application/vnd.elasticsearch+json; compatible-with=9",
+    "Accept": "application/vnd.elasticsearch+json; compatible-with=9"
+}
+
+# Seconds per call, by kind
+DEADLINES = {
+    "analysis": 30,
+    "packed_analysis": 60,
+    "deep_investigation": 90,
+    "closure_report": 60
+}
+DEFAULT_DEADLINE = 60
+
+MAX_ATTEMPTS = 2
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECONDS = 30
+
+RETRY_RATIO = 0.1
+RETRY_MIN_PER_WINDOW = 3
+RETRY_WINDOW_SECONDS = 10
+
+LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000]
+
+# Rough size of a token for the estimates below
+CHARS_PER_TOKEN = 4
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+# ========================
+# FAILURE CLASSIFICATION
+# ========================
+
+def status_of(error):
+    if isinstance(error, ApiError):
+        return error.meta.status
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return None
+
+
+def failure_reason(error):
+    if isinstance(error, CircuitOpen):
+        return "circuit_open"
+    if isinstance(error, (asyncio.TimeoutError, ConnectionTimeout, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(error, (TransportConnectionError, httpx.TransportError)):
+        return "connection"
+
+    status = status_of(error)
+    if status == 429:
+        return "rate_limited"
+    if status is not None and status >= 500:
+        return "server_error"
+    if status is not None:
+        return "client_error"
+    return "other"
+
+
+def is_retryable(error):
+    return failure_reason(error) in ("timeout", "connection", "rate_limited", "server_error")
+
+
+def retry_delay(attempt, error=None):
+    """Seconds to wait before retry number `attempt` (1-based)."""
+    if isinstance(error, (ApiError, httpx.HTTPStatusError)):
+        headers = error.meta.headers if isinstance(error, ApiError) else error.response.headers
+        retry_after = headers.get("retry-after")
+        if retry_after and retry_after.isdigit():
+            return min(BACKOFF_MAX_SECONDS, float(retry_after))
+
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def stream_deltas(line):
+    """
+    Text carried by one line of a streaming completion: a string, "" for
+    lines without text, or None once the stream is done.
+    """
+    if not line.startswith("data:"):
+        return ""
+
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+
+    event = json.loads(data)
+    if "error" in event:
+        raise RuntimeError(f"Inference stream failed: {event['error']}")
+    return "".join(chunk.get("delta", "") for chunk in event.get("completion", []))
+
+
+def extract_completion(response):
+    """Return the model output without ```json fences, or None if empty."""
+    # Extract model output safely (Elastic completion format)
+    if "completion" in response and len(response["completion"]) > 0:
+        result_text = response["completion"][0].get("result", "")
+
+        # Remove ```json markdown formatting if present
+        cleaned = result_text.strip()
+        if cleaned.startswith("```"):
+            cleaned = cleaned.replace("```json", "").replace("```", "").strip()
+
+        return cleaned
+
+    return None
+
+
+# ========================
+# CIRCUIT BREAKER & RETRY BUDGET
+# ========================
+
+class CircuitBreaker:
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.max_failures = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go through now."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return
+        raise CircuitOpen(f"Inference endpoint unavailable, circuit open for up to {self.reset_seconds}s")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def abandon(self):
+        """The call ended without an outcome (caller gave up): free the trial slot."""
+        with self._lock:
+            self.trial_running = False
+
+    def record_failure(self, error):
+        # A rejected prompt still means the endpoint answered
+        if not is_retryable(error):
+            self.record_success()
+            return
+
+        with self._lock:
+            trial, self.trial_running = self.trial_running, False
+            self.failures += 1
+            if trial or (self.opened_at is None and self.failures >= self.max_failures):
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                print(f"🔌 Inference circuit opened after {self.failures} consecutive failures")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened
+        }
+
+
+class RetryBudget:
+    """Retries allowed: RETRY_RATIO of requests in the last window, at least RETRY_MIN_PER_WINDOW."""
+
+    def __init__(self, ratio=RETRY_RATIO, min_per_window=RETRY_MIN_PER_WINDOW, window=RETRY_WINDOW_SECONDS):
+        self.ratio = ratio
+        self.min_per_window = min_per_window
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _trim(self, now):
+        for times in (self._requests, self._retries):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_spend(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._retries) < max(self.min_per_window, self.ratio * len(self._requests)):
+                self._retries.append(now)
+                return True
+            self.exhausted += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                "recent_requests": len(self._requests),
+                "recent_retries": len(self._retries),
+                "exhausted": self.exhausted
+            }
+
+
+# ========================
+# METRICS
+# ========================
+
+class InferenceMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = {}
+            self.first_token = {}
+            self.calls = {}
+            self.failures = {}
+            self.prompt_chars = 0
+            self.completion_chars = 0
+
+    def record(self, kind, latency_ms, prompt, response=None, error=None):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+            if error is not None:
+                reason = failure_reason(error)
+                self.failures[reason] = self.failures.get(reason, 0) + 1
+                if reason == "circuit_open":
+                    return
+
+            histogram = self.latency.setdefault(kind, [0] * (len(LATENCY_BUCKETS_MS) + 1))
+            histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+
+            self.prompt_chars += len(prompt)
+            if response is not None:
+                self.completion_chars += len(extract_completion(response) or "")
+
+    def record_first_token(self, kind, latency_ms):
+        with self._lock:
+            histogram = self.first_token.setdefault(kind, [0] * (len(LATENCY_BUCKETS_MS) + 1))
+            histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+
+    def stats(self):
+        with self._lock:
+            labels = [f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"]
+            return {
+                "calls": dict(self.calls),
+                "failures": dict(self.failures),
+                "latency_ms_histogram": {
+                    kind: dict(zip(labels, counts)) for kind, counts in self.latency.items()
+                },
+                "first_token_ms_histogram": {
+                    kind: dict(zip(labels, counts)) for kind, counts in self.first_token.items()
+                },
+                "prompt_chars": self.prompt_chars,
+                "completion_chars": self.completion_chars,
+                "prompt_tokens_estimate": self.prompt_chars // CHARS_PER_TOKEN,
+                "completion_tokens_estimate": self.completion_chars // CHARS_PER_TOKEN
+            }
+
+
+# ========================
+# CLIENT
+# ========================
+
+class InferenceClient:
+
+    def __init__(self, inference_id=INFERENCE_ID, max_attempts=MAX_ATTEMPTS):
+        self.inference_id = inference_id
+        self.max_attempts = max_attempts
+        self.breaker = CircuitBreaker()
+        self.retry_budget = RetryBudget()
+        self.metrics = InferenceMetrics()
+        # httpx client for streams, per event loop
+        self._http = None
+        self._http_loop = None
+
+    def _options(self, es, kind):
+        # Retries are ours (budgeted), never the transport's
+        return es.options(request_timeout=DEADLINES.get(kind, DEFAULT_DEADLINE), max_retries=0)
+
+    def _finish(self, kind, started, prompt, response=None, error=None):
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.metrics.record(kind, latency_ms, prompt, response, error)
+        if error is None:
+            self.breaker.record_success()
+        elif not isinstance(error, CircuitOpen):
+            self.breaker.record_failure(error)
+
+    def _should_retry(self, attempt, max_attempts, error):
+        return attempt < max_attempts and is_retryable(error) and self.retry_budget.try_spend()
+
+    def request(self, prompt, kind="analysis", es=None, max_attempts=None):
+        """Response body for `prompt`. Raises CircuitOpen or the endpoint's error."""
+        es = self._options(es or get_client("inference"), kind)
+        max_attempts = max_attempts or self.max_attempts
+
+        for attempt in range(1, max_attempts + 1):
+            started = time.perf_counter()
+            try:
+                self.breaker.allow()
+                self.retry_budget.record_request()
+                response = es.perform_request(
+                    "POST", f"/_inference/{self.inference_id}", headers=INFERENCE_HEADERS, body={"input": prompt}
+                ).body
+            except Exception as e:
+                self._finish(kind, started, prompt, error=e)
+                if not self._should_retry(attempt, max_attempts, e):
+                    raise
+                time.sleep(retry_delay(attempt, e))
+                continue
+            except BaseException:
+                # Cancelled mid-call: free the half-open trial slot
+                self.breaker.abandon()
+                raise
+
+            self._finish(kind, started, prompt, response)
+            return response
+
+    async def request_async(self, async_es, prompt, kind="analysis", max_attempts=None):
+        es = self._options(async_es, kind)
+        deadline = DEADLINES.get(kind, DEFAULT_DEADLINE)
+        max_attempts = max_attempts or self.max_attempts
+
+        for attempt in range(1, max_attempts + 1):
+            started = time.perf_counter()
+            try:
+                self.breaker.allow()
+                self.retry_budget.record_request()
+                try:
+                    response = (await asyncio.wait_for(
+                        es.perform_request(
+                            "POST", f"/_inference/{self.inference_id}", headers=INFERENCE_HEADERS, body={"input": prompt}
+                        ),
+                        deadline
+                    )).body
+                except asyncio.TimeoutError:
+                    raise asyncio.TimeoutError(f"Inference call exceeded its {deadline}s deadline")
+            except Exception as e:
+                self._finish(kind, started, prompt, error=e)
+                if not self._should_retry(attempt, max_attempts, e):
+                    raise
+                await asyncio.sleep(retry_delay(attempt, e))
+                continue
+            except BaseException:
+                # Cancelled mid-call: free the half-open trial slot
+                self.breaker.abandon()
+                raise
+
+            self._finish(kind, started, prompt, response)
+            return response
+
+    def _stream_client(self):
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._http_loop is not loop:
+            url, auth = base_url("inference")
+            self._http = httpx.AsyncClient(base_url=url, auth=auth)
+            self._http_loop = loop
+        return self._http
+
+    async def stream_async(self, prompt, kind="analysis"):
+        """
+        Yield the completion for `prompt` in pieces as the model produces
+        them. Single attempt: a stream cannot be retried once text went out.
+        """
+        self.breaker.allow()
+        self.retry_budget.record_request()
+
+        deadline = DEADLINES.get(kind, DEFAULT_DEADLINE)
+        started = time.perf_counter()
+        received = []
+
+        try:
+            async with self._stream_client().stream(
+                "POST",
+                f"/_inference/completion/{self.inference_id}/_stream",
+                headers={"Accept": "text/event-stream"},
+                json={"input": prompt},
+                timeout=httpx.Timeout(deadline, connect=10)
+            ) as response:
+                if response.is_error:
+                    await response.aread()
+                    response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if time.perf_counter() - started > deadline:
+                        raise asyncio.TimeoutError(f"Inference stream exceeded its {deadline}s deadline")
+
+                    text = stream_deltas(line)
+                    if text is None:
+                        break
+                    if text:
+                        if not received:
+                            self.metrics.record_first_token(kind, (time.perf_counter() - started) * 1000)
+                        received.append(text)
+                        yield text
+        except Exception as e:
+            self._finish(kind, started, prompt, error=e)
+            raise
+        except BaseException:
+            # Cancelled, or the consumer stopped reading
+            self.breaker.abandon()
+            raise
+
+        self._finish(kind, started, prompt, {"completion": [{"result": "".join(received)}]})
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def stats(self):
+        stats = self.metrics.stats()
+        stats["circuit"] = self.breaker.stats()
+        stats["retry_budget"] = self.retry_budget.stats()
+        stats["deadlines_seconds"] = dict(DEADLINES)
+        return stats
+
+
+inference_client = InferenceClient()
+
+
+# ========================
+# LOCAL STUB ENDPOINT
+# ========================
+#
+# Answers `POST /_inference/<id>` with canned completions in the shape
+# each prompt asks for, optionally slow or failing, so generators, the
+# breaker and the batch runner can be exercised without a model:
+#
+#   python inference_client.py --stub --port 9299 --latency 0.5 --fail-rate 0.2
+#   INFERENCE_URL=http://localhost:9299 uvicorn main:app
+
+STUB_CHUNK_CHARS = 16
+
+
+def stub_completion(prompt):
+    packed = re.search(r"JSON array of exactly (\d+) objects", prompt)
+    analysis = {"summary": "Stub analysis", "impact": "N/A", "remediation": ["N/A"], "severity": "High"}
+
+    if packed:
+        return json.dumps([analysis] * int(packed.group(1)))
+    if "attack_path_analysis" in prompt:
+        return json.dumps({
+            "summary": "Stub deep investigation",
+            "attack_path_analysis": "N/A",
+            "containment_strategy": "N/A",
+            "risk_if_ignored": "N/A"
+        })
+    if "executive_summary" in prompt:
+        return json.dumps({
+            "executive_summary": "Stub closure report",
+            "response_actions_taken": "N/A",
+            "residual_risk": "N/A",
+            "lessons_learned": "N/A"
+        })
+    return json.dumps(analysis)
+
+
+def make_stub_handler(latency=0.0, fail_rate=0.0):
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            # The Python client refuses servers that do not identify as Elasticsearch
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self._send(200, {"version": {"number": "9.0.0"}, "tagline": "You Know, for Search"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if not self.path.startswith("/_inference/"):
+                self._send(404, {"error": "stub only serves /_inference"})
+                return
+
+            if random.random() < fail_rate:
+                time.sleep(latency)
+                self._send(503, {"error": "stub failure"})
+                return
+
+            result = stub_completion(body.get("input", ""))
+            if self.path.endswith("/_stream"):
+                self._stream(result)
+                return
+
+            time.sleep(latency)
+            self._send(200, {"completion": [{"result": result}]})
+
+        def _stream(self, result):
+            # Server-sent events, `latency` spread over the chunks
+            chunks = [result[i:i + STUB_CHUNK_CHARS] for i in range(0, len(result), STUB_CHUNK_CHARS)]
+            self.send_response(200)
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            for chunk in chunks:
+                time.sleep(latency / len(chunks))
+                event = json.dumps({"completion": [{"delta": chunk}]})
+                self.wfile.write(f"event: message\ndata: {event}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"event: message\ndata: [DONE]\n\n")
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def serve_stub(port=9299, latency=0.0, fail_rate=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_stub_handler(latency, fail_rate))
+    print(f"🧪 Inference stub listening on http://127.0.0.1:{server.server_port}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inference client stub endpoint")
+    parser.add_argument("--stub", action="store_true", help="Serve the local stub endpoint")
+    parser.add_argument("--port", type=int, default=9299)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per completion")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    args = parser.parse_args()
+
+    if not args.stub:
+        parser.error("nothing to do; pass --stub")
+
+    server = serve_stub(args.port, args.latency, args.fail_rate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,436 @@
+import argparse
 import json
 import os
-from elasticsearch import Elasticsearch
-from dotenv import load_dotenv
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timezone
 
-load_dotenv()
+from elasticsearch import ApiError
 
-ELASTIC_CLOUD_ID = os.getenv("ELASTIC_CLOUD_ID")
-USERNAME = os.getenv("ELASTIC_USERNAME")
-PASSWORD = os.getenv("ELASTIC_PASSWORD")
-
-es = Elasticsearch(
-    cloud_id=ELASTIC_CLOUD_ID,
-    basic_auth=(USERNAME, PASSWORD)
-)
+from es_client import get_client
+from log_reader import NDJSON, Checkpoint, detect_format, is_gzip, read_documents, split_ndjson
+from streaming_detector import BruteForceStream, detect_while_reading, open_incident
 
 INDEX_NAME = "security-events"
+SOURCE_FILE = "security_logs.json"
+
+# Bulk defaults: 500 docs or 5 MB per request, whichever is hit first
+CHUNK_SIZE = 500
+MAX_CHUNK_BYTES = 5 * 1024 * 1024
+MAX_IN_FLIGHT = 4
+
+# Retries for requests or items rejected with 429 (exponential backoff)
+MAX_RETRIES = 6
+RETRY_BACKOFF_SECONDS = 0.5
+
+
+def is_retryable_status(status):
+    """Item statuses a later run may still get through (throttling, shard unavailable...)."""
+    return status == 429 or status >= 500
+
+
+# ========================
+# BULK INGESTION
+# ========================
+
+def iter_chunks(records, index, chunk_size=CHUNK_SIZE, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Group `(document, offset)` records into `_bulk` bodies bounded by
+    document count and payload size. Each chunk is a list of pre-encoded
+    NDJSON lines plus the source offset just after its last document.
+    """
+    action = json.dumps({"create": {"_index": index}}).encode("utf-8")
+
+    lines = []
+    count = 0
+    size = 0
+    end_offset = 0
+
+    for doc, offset in records:
+        source = json.dumps(doc).encode("utf-8")
+        doc_bytes = len(action) + len(source) + 2
+
+        if count and (count >= chunk_size or size + doc_bytes > max_chunk_bytes):
+            yield lines, count, size, end_offset
+            lines, count, size = [], 0, 0
+
+        lines.append(action)
+        lines.append(source)
+        count += 1
+        size += doc_bytes
+        end_offset = offset
+
+    if count:
+        yield lines, count, size, end_offset
+
+
+def send_chunk(es, seq, lines, count, size, end_offset):
+    result = {
+        "seq": seq,
+        "docs": count,
+        "bytes": size,
+        "end_offset": end_offset,
+        "request_failed": False,
+        "indexed": 0,
+        "failed": 0,
+        "retryable_failed": 0,
+        "throttled": 0,
+        "errors": []
+    }
+
+    attempt = 0
+
+    while True:
+        try:
+            response = es.bulk(operations=lines)
+        except ApiError as e:
+            if e.meta.status == 429 and attempt < MAX_RETRIES:
+                # Cluster is pushing back: hold this sender (and with it the
+                # bounded in-flight window) until it recovers
+                result["throttled"] += len(lines) // 2
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                attempt += 1
+                continue
+            result["failed"] += len(lines) // 2
+            result["request_failed"] = True
+            result["errors"].append(str(e))
+            return result
+        except Exception as e:
+            # Whole request failed (transport error, auth...)
+            result["failed"] += len(lines) // 2
+            result["request_failed"] = True
+            result["errors"].append(str(e))
+            return result
+
+        if not response["errors"]:
+            result["indexed"] += len(lines) // 2
+            return result
+
+        retry_lines = []
+
+        for i, item in enumerate(response["items"]):
+            outcome = next(iter(item.values()))
+            status = outcome.get("status", 500)
+
+            if status < 300:
+                result["indexed"] += 1
+            elif status == 429 and attempt < MAX_RETRIES:
+                retry_lines.extend(lines[2 * i:2 * i + 2])
+            else:
+                result["failed"] += 1
+                if is_retryable_status(status):
+                    result["retryable_failed"] += 1
+                error = outcome.get("error", {})
+                reason = f"{error.get('type', 'unknown')}: {error.get('reason', '')}"
+                if reason not in result["errors"]:
+                    result["errors"].append(reason)
+
+        if not retry_lines:
+            return result
+
+        # Resend only the documents rejected with 429
+        result["throttled"] += len(retry_lines) // 2
+        time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+        attempt += 1
+        lines = retry_lines
+
+
+def report_chunk(result):
+    if not result["failed"]:
+        return
+
+    print(
+        f"⚠️ Chunk {result['seq']}: {result['failed']}/{result['docs']} documents rejected"
+    )
+    for reason in result["errors"][:5]:
+        print(f"   - {reason}")
+
+
+def bulk_ingest(es, records, index=INDEX_NAME, chunk_size=CHUNK_SIZE,
+                max_chunk_bytes=MAX_CHUNK_BYTES, max_in_flight=MAX_IN_FLIGHT,
+                checkpoint=None, resumed_docs=0):
+    """
+    Stream `(document, offset)` records into Elasticsearch through the
+    `_bulk` API, keeping up to `max_in_flight` requests outstanding at once.
+
+    When a checkpoint is given it only advances over chunks that were
+    acknowledged in order, so a crash never skips unsent documents. A chunk
+    whose whole request failed, or with documents still rejected by 429 or
+    5xx after the retries, stops the checkpoint from moving past it; a
+    resumed ingest sends it again. Documents rejected for good (mapping
+    errors and other 4xx) do not hold the checkpoint back.
+    """
+    stats = {"docs": 0, "indexed": 0, "failed": 0, "throttled": 0, "bytes": 0, "chunks": 0}
+    started = time.perf_counter()
+
+    # Out-of-order completions waiting for earlier chunks to finish
+    completed = {}
+    progress = {"next_seq": 1, "docs": resumed_docs, "blocked": False}
+
+    def advance_checkpoint():
+        while progress["next_seq"] in completed and not progress["blocked"]:
+            result = completed.pop(progress["next_seq"])
+            if result["request_failed"] or result["retryable_failed"]:
+                progress["blocked"] = True
+                print(
+                    f"⏸️ Checkpoint held before chunk {result['seq']}: "
+                    f"rerun with the same checkpoint to resend it"
+                )
+                break
+            progress["docs"] += result["docs"]
+            progress["next_seq"] += 1
+            checkpoint.save(result["end_offset"], progress["docs"])
+
+    def collect(done):
+        for future in done:
+            result = future.result()
+            report_chunk(result)
+            stats["indexed"] += result["indexed"]
+            stats["failed"] += result["failed"]
+            stats["throttled"] += result["throttled"]
+            if checkpoint:
+                completed[result["seq"]] = result
+                advance_checkpoint()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = set()
+
+        for seq, (lines, count, size, end_offset) in enumerate(
+            iter_chunks(records, index, chunk_size, max_chunk_bytes), start=1
+        ):
+            # Bound the number of outstanding requests so reading never
+            # runs far ahead of the cluster. Senders stuck retrying 429s keep
+            # their slot, which stalls the reader: this is the backpressure.
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(pool.submit(send_chunk, es, seq, lines, count, size, end_offset))
+            stats["docs"] += count
+            stats["bytes"] += size
+            stats["chunks"] += 1
+
+        done, _ = wait(pending)
+        collect(done)
+
+    stats["elapsed"] = time.perf_counter() - started
+    return stats
+
+
+def print_throughput(stats, index):
+    elapsed = max(stats["elapsed"], 1e-9)
+    docs_per_sec = stats["indexed"] / elapsed
+    mb_per_sec = stats["bytes"] / (1024 * 1024) / elapsed
+
+    print(
+        f"✅ Successfully ingested {stats['indexed']} security events into "
+        f"'{index}' in {stats['elapsed']:.2f}s "
+        f"({stats['chunks']} bulk requests)"
+    )
+    print(f"📈 Throughput: {docs_per_sec:,.0f} docs/s, {mb_per_sec:.2f} MB/s")
+
+    if stats["throttled"]:
+        print(f"🐢 {stats['throttled']} events were retried after 429 responses")
+
+    if stats["failed"]:
+        print(f"❌ {stats['failed']} events failed to ingest")
+
+
+def print_worker_throughput(stats):
+    elapsed = max(stats["elapsed"], 1e-9)
+    span = f"bytes {stats['start']}-{stats['end']}" if stats["end"] is not None else "whole file"
+
+    print(
+        f"👷 Worker {stats['shard']} ({os.path.basename(stats['path'])}, {span}): "
+        f"{stats['indexed']} events in {stats['elapsed']:.2f}s, "
+        f"{stats['indexed'] / elapsed:,.0f} docs/s, "
+        f"{stats['bytes'] / (1024 * 1024) / elapsed:.2f} MB/s"
+        + (f", {stats['failed']} failed" if stats["failed"] else "")
+    )
+
+
+def single_ingest(es, records, index=INDEX_NAME):
+    """Original one-request-per-event path, kept for comparison."""
+    count = 0
+    for doc, _ in records:
+        es.index(index=index, document=doc)
+        count += 1
+    return count
+
+
+# ========================
+# ENRICHMENT
+# ========================
+
+def enrich_records(records):
+    """Stamp each event with its ingest time before it is encoded."""
+    for doc, offset in records:
+        ingested_at = datetime.now(timezone.utc).isoformat()
+        doc.setdefault("@timestamp", ingested_at)
+        doc["ingested_at"] = ingested_at
+        yield doc, offset
+
+
+# ========================
+# SHARDED MULTI-PROCESS INGEST
+# ========================
+
+def plan_shards(paths, workers):
+    """
+    Split the input into independently readable shards: byte ranges of a
+    single plain NDJSON file, or one shard per file otherwise (JSON arrays
+    and gzip streams cannot be entered mid-way).
+    """
+    if len(paths) == 1 and workers > 1:
+        path = paths[0]
+        if not is_gzip(path) and detect_format(path) == NDJSON:
+            return [(path, start, end) for start, end in split_ndjson(path, workers)]
+
+    return [(path, 0, None) for path in paths]
+
+
+def shard_checkpoint_path(base, shard, shard_count):
+    return base if shard_count == 1 else f"{base}.{shard}"
+
+
+def ingest_shard(shard, path, start, end, options):
+    """
+    Read, enrich and bulk-send one shard. Runs inside a worker process, so
+    it gets its own client (es_client drops clients inherited across a
+    fork) and returns plain stats.
+    """
+    es = get_client("ingest")
+
+    checkpoint = None
+    offset, resumed_docs = start, 0
+
+    if options["checkpoint"]:
+        checkpoint = Checkpoint(options["checkpoint"], path)
+        saved, docs = checkpoint.load()
+        # Only trust offsets inside this shard (the plan may have changed)
+        if start < saved and (end is None or saved <= end):
+            offset, resumed_docs = saved, docs
+            print(f"⏩ Worker {shard} resuming {path} at byte {offset} ({docs} events already ingested)")
+
+    records = enrich_records(read_documents(path, offset, end=end))
+    if options.get("detect"):
+        records = detect_while_reading(records, options["detect"])
+
+    stats = bulk_ingest(
+        es,
+        records,
+        index=options["index"],
+        chunk_size=options["chunk_size"],
+        max_chunk_bytes=options["max_chunk_bytes"],
+        max_in_flight=options["in_flight"],
+        checkpoint=checkpoint,
+        resumed_docs=resumed_docs
+    )
+    stats.update({"shard": shard, "path": path, "start": start, "end": end})
+    return stats
+
+
+def run_shards(shards, workers, options):
+    """Run shards on a process pool and aggregate their stats."""
+    started = time.perf_counter()
+    totals = {"docs": 0, "indexed": 0, "failed": 0, "throttled": 0, "bytes": 0, "chunks": 0}
+
+    def shard_options(shard):
+        opts = dict(options)
+        if options["checkpoint"]:
+            opts["checkpoint"] = shard_checkpoint_path(options["checkpoint"], shard, len(shards))
+        return opts
+
+    if workers == 1:
+        results = (
+            ingest_shard(shard, path, start, end, shard_options(shard))
+            for shard, (path, start, end) in enumerate(shards)
+        )
+        for stats in results:
+            for key in totals:
+                totals[key] += stats[key]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+            futures = [
+                pool.submit(ingest_shard, shard, path, start, end, shard_options(shard))
+                for shard, (path, start, end) in enumerate(shards)
+            ]
+            for future in as_completed(futures):
+                stats = future.result()
+                print_worker_throughput(stats)
+                for key in totals:
+                    totals[key] += stats[key]
+
+    totals["elapsed"] = time.perf_counter() - started
+    return totals
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingest security logs into Elasticsearch")
+    parser.add_argument("--file", nargs="+", default=[SOURCE_FILE],
+                        help="NDJSON or JSON array files of events, optionally gzipped")
+    parser.add_argument("--index", default=INDEX_NAME, help="Target index or data stream")
+    parser.add_argument("--mode", choices=["bulk", "single"], default="bulk")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes; a single NDJSON file is split into byte ranges")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="Maximum documents per bulk request")
+    parser.add_argument("--max-chunk-bytes", type=int, default=MAX_CHUNK_BYTES,
+                        help="Maximum payload bytes per bulk request")
+    parser.add_argument("--in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help="Number of bulk requests sent concurrently (per worker)")
+    parser.add_argument("--checkpoint", help="Byte-offset checkpoint file used to resume an interrupted ingest")
+    parser.add_argument("--restart", action="store_true",
+                        help="Discard existing checkpoints and ingest from the start")
+    parser.add_argument("--detect", action="store_true",
+                        help="Run streaming brute-force detection on events as they are read")
+    args = parser.parse_args()
+
+    if args.detect and args.workers > 1:
+        # Per-IP windows must see every event; shards would each see a slice
+        parser.error("--detect needs a single worker")
+
+    return args
+
+
+def main():
+    args = parse_args()
+    stream = BruteForceStream(on_threat=open_incident) if args.detect else None
+
+    if args.mode == "single":
+        es = get_client("ingest")
+        count = 0
+        for path in args.file:
+            records = enrich_records(read_documents(path))
+            if stream:
+                records = detect_while_reading(records, stream)
+            count += single_ingest(es, records, args.index)
+        print(f"✅ Successfully ingested {count} security events into Elasticsearch!")
+        if stream:
+            print(f"🔎 Streaming detection: {stream.stats()}")
+        return
+
+    workers = max(1, args.workers)
+    shards = plan_shards(args.file, workers)
+
+    if args.checkpoint and args.restart:
+        for shard in range(max(len(shards), workers)):
+            Checkpoint(shard_checkpoint_path(args.checkpoint, shard, len(shards)), "").clear()
+
+    options = {
+        "index": args.index,
+        "chunk_size": args.chunk_size,
+        "max_chunk_bytes": args.max_chunk_bytes,
+        "in_flight": args.in_flight,
+        "checkpoint": args.checkpoint,
+        "detect": stream
+    }
 
-with open("security_logs.json", "r") as f:
-    logs = json.load(f)
+    stats = run_shards(shards, workers, options)
+    print_throughput(stats, args.index)
+    if stream:
+        print(f"🔎 Streaming detection: {stream.stats()}")
 
-for log in logs:
-    es.index(index=INDEX_NAME, document=log)
 
-print(f"✅ Successfully ingested {len(logs)} security events into Elasticsearch!")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from cachetools import TLRUCache
+
+# ========================
+# LLM RESPONSE CACHE
+# ========================
+#
+# Prompts built from the same threat fields are byte-identical (every
+# brute force with risk 100 asks the same question), so completions are
+# cached by content: the key is a hash of the inference ID and the prompt
+# with whitespace normalised. Two tiers:
+#
+#   - an in-process LRU with TTL for the hot keys (no I/O at all),
+#   - a SQLite file shared by every process on the host (API workers,
+#     detection service, CLI) that survives restarts, with the same TTL
+#     and a cap on entries; least recently used rows are evicted first.
+#
+# The memory tier and the counters have their own lock, which is never
+# held across I/O; the SQLite connection is serialised by a second one.
+# Async callers check memory on the event loop and do only the disk step
+# in a worker thread, so a slow disk or a busy WAL never stalls the loop.
+#
+# Only usable completions are stored, never errors. Parsing (and stamping
+# generated_at) happens after the cache, so cached answers still get fresh
+# timestamps. Set LLM_CACHE=off to bypass both tiers.
+
+CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache.sqlite3")
+)
+
+TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", 24 * 60 * 60))
+MEMORY_ENTRIES = 512
+MAX_DISK_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 20_000))
+
+# Disk eviction runs once per this many stores, not on every write
+EVICT_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    inference_id TEXT NOT NULL,
+    response TEXT NOT NULL,
+    latency_ms REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+)
+"""
+
+
+def cache_enabled():
+    return os.getenv("LLM_CACHE", "on").lower() not in ("0", "off", "false", "no")
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace so indentation or trailing spaces never split keys."""
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def cache_key(inference_id, prompt):
+    digest = hashlib.sha256()
+    digest.update(inference_id.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_prompt(prompt).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_cacheable(response):
+    completion = response.get("completion") if isinstance(response, dict) else None
+    return bool(completion) and bool(completion[0].get("result", "").strip())
+
+
+class LLMCache:
+
+    def __init__(self, path=CACHE_PATH, ttl=TTL_SECONDS, memory_entries=MEMORY_ENTRIES,
+                 max_disk_entries=MAX_DISK_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        # Entries expire `ttl` after the completion was generated, also when
+        # promoted from disk later
+        self._memory = TLRUCache(
+            maxsize=memory_entries, ttu=lambda key, entry, now: entry[2] + ttl, timer=time.time
+        )
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._disk_failed = False
+        self.stores_since_evict = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.saved_ms = 0.0
+
+    # ---------- persistent tier ----------
+
+    def _connection(self):
+        """
+        SQLite connection of this process (opened lazily, reopened after
+        fork). Callers hold _disk_lock.
+        """
+        if self._disk_failed:
+            return None
+        if self._db is not None and self._db_pid == os.getpid():
+            return self._db
+
+        try:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(SCHEMA)
+            db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ LLM cache file unavailable, using memory only: {e}")
+            self._disk_failed = True
+            return None
+
+        self._db, self._db_pid = db, os.getpid()
+        return db
+
+    def _disk_get(self, key, now):
+        db = self._connection()
+        if db is None:
+            return None
+
+        row = db.execute(
+            "SELECT response, latency_ms, created_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[2] < now - self.ttl:
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            db.commit()
+            return None
+
+        db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        db.commit()
+        return json.loads(row[0]), row[1], row[2]
+
+    def _disk_put(self, key, inference_id, response, latency_ms, now):
+        db = self._connection()
+        if db is None:
+            return
+
+        db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (key, inference_id, json.dumps(response), latency_ms, now, now)
+        )
+        self.stores_since_evict += 1
+        if self.stores_since_evict >= EVICT_EVERY:
+            self._disk_evict(db, now)
+        db.commit()
+
+    def _disk_evict(self, db, now):
+        expired = db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        overflow = db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "  SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?"
+            ")",
+            (self.max_disk_entries,)
+        ).rowcount
+        self.evictions += expired + overflow
+        self.stores_since_evict = 0
+
+    def _disk_lookup(self, key, now):
+        with self._disk_lock:
+            try:
+                return self._disk_get(key, now)
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache read failed: {e}")
+                return None
+
+    def _disk_store(self, key, inference_id, response, latency_ms, now):
+        with self._disk_lock:
+            try:
+                self._disk_put(key, inference_id, response, latency_ms, now)
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache write failed: {e}")
+
+    def _disk_discard(self, key):
+        with self._disk_lock:
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ LLM cache write failed: {e}")
+
+    # ---------- memory tier ----------
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            self.memory_hits += 1
+            self.saved_ms += entry[1]
+            return entry[0]
+
+    def _promote(self, key, found):
+        """Count a disk lookup and keep a hit in memory."""
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.saved_ms += found[1]
+            self._memory[key] = found
+            return found[0]
+
+    def _remember(self, key, response, latency_ms, now):
+        with self._lock:
+            self._memory[key] = (response, latency_ms, now)
+            self.stores += 1
+
+    # ---------- lookups ----------
+
+    def get(self, inference_id, prompt):
+        """Cached response body for this prompt, or None."""
+        key = cache_key(inference_id, prompt)
+        cached = self._memory_get(key)
+        if cached is not None:
+            return cached
+        return self._promote(key, self._disk_lookup(key, time.time()))
+
+    async def get_async(self, inference_id, prompt):
+        key = cache_key(inference_id, prompt)
+        cached = self._memory_get(key)
+        if cached is not None:
+            return cached
+        return self._promote(key, await asyncio.to_thread(self._disk_lookup, key, time.time()))
+
+    def put(self, inference_id, prompt, response, latency_ms):
+        if not is_cacheable(response):
+            return False
+
+        key = cache_key(inference_id, prompt)
+        now = time.time()
+        self._remember(key, response, latency_ms, now)
+        self._disk_store(key, inference_id, response, latency_ms, now)
+        return True
+
+    async def put_async(self, inference_id, prompt, response, latency_ms):
+        if not is_cacheable(response):
+            return False
+
+        key = cache_key(inference_id, prompt)
+        now = time.time()
+        self._remember(key, response, latency_ms, now)
+        await asyncio.to_thread(self._disk_store, key, inference_id, response, latency_ms, now)
+        return True
+
+    def discard(self, inference_id, prompt):
+        """Forget one response, e.g. a completion that turned out unusable."""
+        key = cache_key(inference_id, prompt)
+        with self._lock:
+            self._memory.pop(key, None)
+        self._disk_discard(key)
+
+    async def discard_async(self, inference_id, prompt):
+        key = cache_key(inference_id, prompt)
+        with self._lock:
+            self._memory.pop(key, None)
+        await asyncio.to_thread(self._disk_discard, key)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        with self._disk_lock:
+            db = self._connection()
+            if db is not None:
+                db.execute("DELETE FROM responses")
+                db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            stats = {
+                "enabled": cache_enabled(),
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else None,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "saved_latency_ms": round(self.saved_ms, 1),
+                "ttl_seconds": self.ttl
+            }
+
+        with self._disk_lock:
+            db = self._connection()
+            if db is not None:
+                try:
+                    stats["disk_entries"] = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+        return stats
+
+
+llm_cache = LLMCache()
+
+
+# ========================
+# CACHED CALLS
+# ========================
+
+def cached_completion(inference_id, prompt, call):
+    """Return the cached response for `prompt`, or `call()` it and cache the result."""
+    if not cache_enabled():
+        return call()
+
+    cached = llm_cache.get(inference_id, prompt)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    response = call()
+    llm_cache.put(inference_id, prompt, response, (time.perf_counter() - started) * 1000)
+    return response
+
+
+async def cached_completion_async(inference_id, prompt, call):
+    """Async variant: `call` is a coroutine function."""
+    if not cache_enabled():
+        return await call()
+
+    cached = await llm_cache.get_async(inference_id, prompt)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    response = await call()
+    await llm_cache.put_async(inference_id, prompt, response, (time.perf_counter() - started) * 1000)
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the LLM response cache")
+    parser.add_argument("--clear", action="store_true", help="Delete every cached response")
+    args = parser.parse_args()
+
+    if args.clear:
+        llm_cache.clear()
+        print(f"🧹 LLM cache cleared ({llm_cache.path})")
+    print(llm_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
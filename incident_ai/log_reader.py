@@ -0,0 +1,208 @@
+import codecs
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+
+# ========================
+# STREAMING LOG READERS
+# ========================
+#
+# Both on-disk formats used by the project are supported:
+#   - NDJSON (one event per line), e.g. logs.json
+#   - a single top-level JSON array, e.g. security_logs.json
+#
+# Either can be gzip-compressed. Readers hold at most one block plus one
+# partially parsed event in memory and yield `(document, offset)` pairs,
+# where `offset` is the byte position in the uncompressed stream just
+# after the document. Passing that offset back in resumes the read.
+
+READ_BLOCK_SIZE = 64 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+NDJSON = "ndjson"
+JSON_ARRAY = "array"
+
+
+def is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_source(path):
+    """Open a log file for binary reading, decompressing gzip transparently."""
+    if is_gzip(path):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def detect_format(path):
+    """Return JSON_ARRAY if the first non-blank byte is '[', else NDJSON."""
+    with open_source(path) as f:
+        while True:
+            block = f.read(1024)
+            if not block:
+                return NDJSON
+            stripped = block.lstrip()
+            if stripped:
+                return JSON_ARRAY if stripped[:1] == b"[" else NDJSON
+
+
+def iter_ndjson(f, offset=0, end=None):
+    """Yield the lines starting in [offset, end); `offset` must be a line start."""
+    f.seek(offset)
+
+    for line in f:
+        if end is not None and offset >= end:
+            return
+        offset += len(line)
+        line = line.strip()
+        if not line:
+            continue
+        yield json.loads(line), offset
+
+
+def iter_json_array(f, offset=0):
+    """
+    Incrementally parse the elements of a top-level JSON array.
+    A non-zero `offset` must be one previously yielded by this reader.
+    """
+    f.seek(offset)
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = offset > 0
+
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        buffer += utf8.decode(block, final=not block)
+        pos = 0
+
+        while True:
+            start = pos
+
+            # Skip whitespace and separators between elements
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if not started:
+                if pos >= len(buffer):
+                    break
+                if buffer[pos] != "[":
+                    raise ValueError("Source is not a JSON array")
+                started = True
+                pos += 1
+                offset += len(buffer[start:pos].encode("utf-8"))
+                continue
+
+            if pos >= len(buffer) or buffer[pos] == "]":
+                pos = start
+                break
+
+            try:
+                doc, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element is split across blocks, wait for more data
+                if not block:
+                    raise
+                pos = start
+                break
+
+            offset += len(buffer[start:end].encode("utf-8"))
+            pos = end
+            yield doc, offset
+
+        buffer = buffer[pos:]
+
+        if not block:
+            return
+
+
+def read_documents(path, offset=0, fmt=None, end=None):
+    """
+    Yield `(document, offset)` pairs from an NDJSON or JSON array file.
+    `end` limits an NDJSON read to a byte range (see `split_ndjson`).
+    """
+    fmt = fmt or detect_format(path)
+
+    with open_source(path) as f:
+        if fmt == JSON_ARRAY:
+            yield from iter_json_array(f, offset)
+        else:
+            yield from iter_ndjson(f, offset, end)
+
+
+def split_ndjson(path, parts):
+    """
+    Split an uncompressed NDJSON file into up to `parts` byte ranges whose
+    boundaries fall on line starts, so each range can be read independently.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+
+    with open(path, "rb") as f:
+        for i in range(1, parts):
+            target = size * i // parts
+            if target <= bounds[-1]:
+                continue
+
+            # Finish the line containing byte target-1; we land on a line start
+            f.seek(target - 1)
+            f.readline()
+            position = f.tell()
+
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+# ========================
+# RESUME CHECKPOINTS
+# ========================
+
+class Checkpoint:
+    """
+    Byte-offset checkpoint for one source file, stored as a small JSON
+    document next to the data. Writes are atomic so a crash mid-save
+    never leaves a truncated checkpoint behind.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+
+    def load(self):
+        """Return `(offset, docs)` to resume from, or `(0, 0)`."""
+        if not os.path.exists(self.path):
+            return 0, 0
+
+        with open(self.path, "r") as f:
+            state = json.load(f)
+
+        if state.get("source") != self.source:
+            print(f"⚠️ Checkpoint {self.path} belongs to {state.get('source')}, ignoring it")
+            return 0, 0
+
+        return state.get("offset", 0), state.get("docs", 0)
+
+    def save(self, offset, docs):
+        state = {
+            "source": self.source,
+            "offset": offset,
+            "docs": docs,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
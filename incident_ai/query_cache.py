@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+from cachetools import TTLCache
+
+# ========================
+# IN-PROCESS QUERY CACHE
+# ========================
+#
+# Shared by the FastAPI backend and the Streamlit dashboard so that many
+# clients polling the same view cost one Elasticsearch query per TTL.
+
+
+class QueryCache:
+    """
+    Thread-safe, size-bounded LRU cache with TTL and single-flight loading:
+    concurrent misses on the same key wait for one loader call instead of
+    each querying ES.
+
+    Entries are stored under the cache's current version. `invalidate()`
+    bumps the version, which makes every existing entry unreachable in O(1)
+    and also discards results of loads that were already in flight when the
+    write happened (they land under the old version and are never served).
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._loading_async = {}
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            key = (self.version, key)
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another caller may have filled the entry while we waited
+            with self._lock:
+                if key in self._cache:
+                    return self._cache[key]
+
+            try:
+                value = loader()
+                with self._lock:
+                    self._cache[key] = value
+            finally:
+                # Also on failure: later callers must not reuse a dead marker
+                with self._lock:
+                    self._loading.pop(key, None)
+
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """
+        Async counterpart of get_or_load for the FastAPI backend. `loader` is
+        a coroutine function; concurrent misses await the same task.
+        """
+        with self._lock:
+            key = (self.version, key)
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+
+            task = self._loading_async.get(key)
+            if task is None:
+                task = asyncio.ensure_future(loader())
+                self._loading_async[key] = task
+                task.add_done_callback(lambda done: self._store_async(key, done))
+
+        # A cancelled waiter must not cancel the load for everyone else
+        return await asyncio.shield(task)
+
+    def _store_async(self, key, task):
+        with self._lock:
+            self._loading_async.pop(key, None)
+            if not task.cancelled() and task.exception() is None:
+                self._cache[key] = task.result()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._cache),
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
+
+
+# Severity/stage counters behind /metrics and the Streamlit overview
+METRICS_TTL_SECONDS = 5
+metrics_cache = QueryCache(maxsize=4, ttl=METRICS_TTL_SECONDS)
+
+# Incident list pages and detail documents behind /incidents
+INCIDENTS_TTL_SECONDS = 30
+INCIDENTS_CACHE_SIZE = 512
+incidents_cache = QueryCache(maxsize=INCIDENTS_CACHE_SIZE, ttl=INCIDENTS_TTL_SECONDS)
+
+
+def invalidate_incident_views():
+    """Call after every write to `incidents`."""
+    incidents_cache.invalidate()
+    metrics_cache.invalidate()
@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import re
+
+from soc_orchestrator import INDEX_NAME, Detector
+from watermarks import new_events_filter, scan_start
+
+try:
+    import yaml
+except ImportError:  # PyYAML is in requirements.txt; without it only JSON rules load
+    yaml = None
+
+# ========================
+# DECLARATIVE DETECTION RULES
+# ========================
+#
+# A rule is a dict (or a YAML/JSON file in rules/):
+#
+#   name: data_exfiltration
+#   match: {event_type: file_access, status: SUCCESS}   # term / terms
+#   range: {risk_score: {gte: 70}}                      # optional
+#   group_by: [source_ip, user]
+#   window: 10m
+#   threshold: {metric: sum, field: bytes_out, gt: 1000000000}
+#   max_groups: 100
+#   threat_type: DATA_EXFILTRATION
+#   severity: CRITICAL
+#   risk_score: 90
+#   mitre: {tactic: Exfiltration, technique: T1041}
+#
+# Rules are compiled into aggregations. All rules on the same index and
+# window become one search (one `_msearch` entry), rules with identical
+# filters share one `filter` aggregation, and the threshold is applied by
+# a `bucket_selector`, so only matching groups come back. Compiled plans
+# are cached by the rules' content.
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules")
+
+DEFAULT_MAX_GROUPS = 100
+DEFAULT_RISK_SCORE = 70
+METRICS = ("count", "sum", "max", "avg", "cardinality")
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+_plan_cache = {}
+_file_cache = {}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def parse_window(window):
+    if isinstance(window, (int, float)):
+        return int(window)
+
+    found = re.fullmatch(r"\s*(\d+)\s*([smhd])\s*", str(window))
+    if not found:
+        raise RuleError(f"Invalid window '{window}' (use e.g. 300s, 5m, 1h)")
+    return int(found.group(1)) * _UNITS[found.group(2)]
+
+
+def normalize_rule(rule):
+    """Validate a rule and fill in defaults."""
+    if not rule.get("name"):
+        raise RuleError("Rule needs a name")
+
+    name = rule["name"]
+    if not rule.get("match") and not rule.get("range"):
+        raise RuleError(f"Rule '{name}' needs 'match' or 'range'")
+
+    group_by = rule.get("group_by") or ["source_ip"]
+    if isinstance(group_by, str):
+        group_by = [group_by]
+
+    threshold = dict(rule.get("threshold") or {})
+    metric = threshold.get("metric", "count")
+    if metric not in METRICS:
+        raise RuleError(f"Rule '{name}': metric must be one of {', '.join(METRICS)}")
+    if metric != "count" and not threshold.get("field"):
+        raise RuleError(f"Rule '{name}': metric '{metric}' needs a field")
+    if not isinstance(threshold.get("gt", 0), (int, float)):
+        raise RuleError(f"Rule '{name}': threshold 'gt' must be a number")
+
+    return {
+        "name": name,
+        "description": rule.get("description", ""),
+        "index": rule.get("index", INDEX_NAME),
+        "match": rule.get("match") or {},
+        "range": rule.get("range") or {},
+        "group_by": list(group_by),
+        "window_seconds": parse_window(rule.get("window", "5m")),
+        "metric": metric,
+        "field": threshold.get("field"),
+        "gt": threshold.get("gt", 0),
+        "max_groups": int(rule.get("max_groups", DEFAULT_MAX_GROUPS)),
+        "threat_type": rule.get("threat_type", name.upper()),
+        "severity": rule.get("severity"),
+        "risk_score": int(rule.get("risk_score", DEFAULT_RISK_SCORE)),
+        "mitre": rule.get("mitre")
+    }
+
+
+def rule_filters(rule):
+    filters = []
+    for field, value in sorted(rule["match"].items()):
+        if isinstance(value, list):
+            filters.append({"terms": {field: value}})
+        else:
+            filters.append({"term": {field: value}})
+    for field, bounds in sorted(rule["range"].items()):
+        filters.append({"range": {field: bounds}})
+    return filters
+
+
+# ========================
+# COMPILATION
+# ========================
+
+def compile_group_aggregation(rule, new_since):
+    if len(rule["group_by"]) == 1:
+        grouping = {"terms": {"field": rule["group_by"][0], "size": rule["max_groups"]}}
+    else:
+        grouping = {
+            "multi_terms": {
+                "terms": [{"field": field} for field in rule["group_by"]],
+                "size": rule["max_groups"]
+            }
+        }
+
+    aggs = {"new_events": {"filter": {"range": {"@timestamp": {"gt": new_since}}}}}
+
+    if rule["metric"] == "count":
+        value_path = "_count"
+    else:
+        aggs["value"] = {rule["metric"]: {"field": rule["field"]}}
+        value_path = "value"
+        # Keep the groups with the largest values when truncating
+        next(iter(grouping.values()))["order"] = {"value": "desc"}
+
+    # Only groups over the threshold that also saw new events come back
+    aggs["over_threshold"] = {
+        "bucket_selector": {
+            "buckets_path": {"value": value_path, "new": "new_events._count"},
+            "script": f"params.value > {rule['gt']} && params.new > 0"
+        }
+    }
+
+    grouping["aggs"] = aggs
+    return grouping
+
+
+class RulePlan(Detector):
+    """All rules of one index and window, evaluated by a single search."""
+
+    def __init__(self, index, window_seconds, rules):
+        self.index = index
+        self.window_seconds = window_seconds
+        self.rules = rules
+        self.name = f"rules:{index}:{window_seconds}s"
+
+        # Rules with identical filters share one `filter` aggregation
+        self.filter_groups = {}
+        for rule in rules:
+            key = json.dumps(rule_filters(rule), sort_keys=True)
+            self.filter_groups.setdefault(key, []).append(rule)
+
+    def build_search(self, watermark, upper):
+        query = new_events_filter(watermark, upper, overlap_seconds=self.window_seconds)
+        new_since = scan_start(watermark)
+
+        aggs = {}
+        should = []
+        for position, (key, rules) in enumerate(sorted(self.filter_groups.items())):
+            filters = json.loads(key)
+            should.append({"bool": {"filter": filters}})
+            aggs[f"filter_{position}"] = {
+                "filter": {"bool": {"filter": filters}},
+                "aggs": {rule["name"]: compile_group_aggregation(rule, new_since) for rule in rules}
+            }
+
+        query["bool"]["should"] = should
+        query["bool"]["minimum_should_match"] = 1
+
+        return {"size": 0, "query": query, "aggs": aggs}
+
+    def evaluate(self, response, watermark, upper):
+        threats = []
+
+        for position, (key, rules) in enumerate(sorted(self.filter_groups.items())):
+            node = response["aggregations"][f"filter_{position}"]
+            for rule in rules:
+                for bucket in node[rule["name"]]["buckets"]:
+                    threats.append(self.to_threat(rule, bucket))
+
+        return threats or None
+
+    def to_threat(self, rule, bucket):
+        keys = bucket["key"] if isinstance(bucket["key"], list) else [bucket["key"]]
+        group = dict(zip(rule["group_by"], keys))
+        value = bucket["doc_count"] if rule["metric"] == "count" else bucket["value"]["value"]
+
+        threat = {
+            "type": rule["threat_type"],
+            "threat_type": rule["threat_type"],
+            "rule": rule["name"],
+            "group": group,
+            "events": bucket["doc_count"],
+            "metric": rule["metric"],
+            "value": value,
+            "window_seconds": rule["window_seconds"],
+            "risk_score": rule["risk_score"]
+        }
+        for field in ("source_ip", "user"):
+            if field in group:
+                threat[field] = group[field]
+        if rule["severity"]:
+            threat["severity"] = rule["severity"]
+        if rule["mitre"]:
+            threat["mitre"] = rule["mitre"]
+
+        return threat
+
+
+def compile_rules(rules):
+    """Compile rules into one RulePlan per (index, window); cached by content."""
+    normalized = sorted((normalize_rule(rule) for rule in rules), key=lambda r: r["name"])
+    digest = hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+    plans = _plan_cache.get(digest)
+    if plans is None:
+        names = [rule["name"] for rule in normalized]
+        if len(names) != len(set(names)):
+            raise RuleError("Rule names must be unique")
+
+        by_window = {}
+        for rule in normalized:
+            by_window.setdefault((rule["index"], rule["window_seconds"]), []).append(rule)
+
+        plans = [RulePlan(index, window, grouped) for (index, window), grouped in sorted(by_window.items())]
+        _plan_cache[digest] = plans
+
+    return plans
+
+
+# ========================
+# LOADING
+# ========================
+
+def read_rule_file(path):
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            content = json.load(f)
+        elif yaml is None:
+            print(f"⚠️ Skipping {os.path.basename(path)}: install PyYAML to load YAML rules")
+            return []
+        else:
+            content = yaml.safe_load(f)
+
+    if content is None:
+        return []
+    return content if isinstance(content, list) else [content]
+
+
+def load_rules(directory=RULES_DIR):
+    """Read every .yaml/.yml/.json rule file; files are re-read only when changed."""
+    if not os.path.isdir(directory):
+        return []
+
+    rules = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith((".yaml", ".yml", ".json")):
+            continue
+
+        path = os.path.join(directory, filename)
+        mtime = os.path.getmtime(path)
+        cached = _file_cache.get(path)
+
+        if cached is None or cached[0] != mtime:
+            try:
+                loaded = read_rule_file(path)
+                for rule in loaded:
+                    normalize_rule(rule)
+            except (RuleError, ValueError, OSError) as e:
+                print(f"❌ Ignoring rule file {filename}: {e}")
+                loaded = []
+            cached = _file_cache[path] = (mtime, loaded)
+
+        rules.extend(cached[1])
+
+    return rules
+
+
+def rule_detectors(directory=RULES_DIR):
+    return compile_rules(load_rules(directory))
+
+
+def describe_plans(plans):
+    return [
+        {
+            "plan": plan.name,
+            "index": plan.index,
+            "window_seconds": plan.window_seconds,
+            "filter_groups": len(plan.filter_groups),
+            "rules": [rule["name"] for rule in plan.rules]
+        }
+        for plan in plans
+    ]
@@ -0,0 +1,499 @@
+import argparse
+import time
+from datetime import datetime
+
+import pandas as pd
+from elasticsearch import NotFoundError
+
+from es_client import get_client
+from log_reader import JSON_ARRAY, detect_format, open_source
+from watermarks import load_watermark, new_events_filter, save_watermark, scan_start, scan_upper_bound
+
+try:
+    import pyarrow as pa
+    import pyarrow.json as pa_json
+except ImportError:  # optional: pandas parses NDJSON too, about 3x slower
+    pa = None
+
+# ========================
+# SERVICE HEALTH ANOMALY DETECTION
+# ========================
+#
+# Application logs (see logs.json: service_name, log_level, error_code,
+# response_time_ms, host) are rolled up per service into fixed buckets of
+# request count, error count and p95 latency of the successful requests
+# (failures already show in the error rate, and a couple of slow errors
+# would otherwise swing the p95 of a quiet bucket). Each bucket is compared with
+# the service's own rolling baseline over the previous BASELINE_BUCKETS
+# buckets (median and interquartile spread, so a spike does not drag its
+# own baseline up until it covers a quarter of the window). Buckets whose
+# error rate or p95 latency sit far above it are anomalous, and runs of
+# anomalous buckets become one incident carrying `service`, `error_count`
+# and `root_cause` (the dominant error code).
+#
+# Everything runs on pandas/NumPy column operations: one groupby for the
+# rollup, rolling windows on a (bucket x service) matrix for the baselines,
+# and no Python loop per row or per bucket, so millions of rows take
+# seconds. Input is a DataFrame built from an NDJSON / JSON array file or
+# from batches of documents pulled from the `service-logs` index.
+
+LOGS_INDEX = "service-logs"
+DETECTOR_NAME = "service_health"
+THREAT_TYPE = "SERVICE_DEGRADATION"
+
+COLUMNS = ["@timestamp", "service_name", "log_level", "error_code", "message", "response_time_ms", "host"]
+
+BUCKET = "1min"
+BASELINE_BUCKETS = 60
+MIN_BASELINE_BUCKETS = 10
+
+# A bucket is anomalous when it sits this many (IQR-estimated) standard
+# deviations above its baseline; the floors keep a perfectly flat baseline
+# from turning every blip into a spike
+Z_THRESHOLD = 3.0
+ERROR_RATE_STD_FLOOR = 0.02
+LATENCY_STD_FLOOR_MS = 25.0
+LATENCY_FACTOR = 2.0
+MIN_ERRORS = 5
+MIN_REQUESTS = 10
+
+# Anomalous buckets separated by at most this many quiet ones are one
+# episode; shorter episodes are noise (with thousands of service-buckets a
+# day, some single bucket always looks extreme)
+MERGE_GAP_BUCKETS = 2
+MIN_EPISODE_BUCKETS = 2
+
+READ_CHUNK_ROWS = 500_000
+ES_BATCH_SIZE = 10_000
+
+
+# ========================
+# LOADING
+# ========================
+
+def prepare_frame(frame):
+    """Keep the columns the detector uses, with compact dtypes."""
+    frame = frame.reindex(columns=COLUMNS)
+    frame["@timestamp"] = pd.to_datetime(frame["@timestamp"], utc=True, format="ISO8601")
+    for column in ("service_name", "log_level", "error_code", "message", "host"):
+        frame[column] = frame[column].astype("category")
+    frame["response_time_ms"] = pd.to_numeric(frame["response_time_ms"], errors="coerce").astype("float32")
+    return frame.dropna(subset=["@timestamp", "service_name"])
+
+
+def read_ndjson_arrow(f):
+    schema = pa.schema([
+        (column, pa.float64() if column == "response_time_ms" else pa.string())
+        for column in COLUMNS
+    ])
+    options = pa_json.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore")
+    table = pa_json.read_json(f, parse_options=options)
+    return prepare_frame(table.to_pandas(strings_to_categorical=True))
+
+
+def load_file(path, chunk_rows=READ_CHUNK_ROWS):
+    """Read an NDJSON or JSON array log file (optionally gzipped) into a frame."""
+    with open_source(path) as f:
+        if detect_format(path) == JSON_ARRAY:
+            return prepare_frame(pd.read_json(f, orient="records", dtype=False))
+
+        if pa is not None:
+            return read_ndjson_arrow(f)
+
+        # NDJSON is parsed in chunks so only one raw chunk is held at a time
+        chunks = [
+            prepare_frame(chunk)
+            for chunk in pd.read_json(f, lines=True, chunksize=chunk_rows, dtype=False)
+        ]
+
+    if not chunks:
+        return prepare_frame(pd.DataFrame(columns=COLUMNS))
+    return prepare_frame(pd.concat(chunks, ignore_index=True))
+
+
+def fetch_batches(es, query, index=LOGS_INDEX, batch_size=ES_BATCH_SIZE):
+    """Yield frames of `batch_size` log documents matching `query`, oldest first."""
+    pit = es.open_point_in_time(index=index, keep_alive="2m")["id"]
+    search_after = None
+
+    try:
+        while True:
+            response = es.search(
+                pit={"id": pit, "keep_alive": "2m"},
+                query=query,
+                size=batch_size,
+                source=COLUMNS,
+                sort=[{"@timestamp": "asc"}, {"_shard_doc": "asc"}],
+                search_after=search_after
+            )
+            pit = response.get("pit_id", pit)
+            hits = response["hits"]["hits"]
+            if not hits:
+                return
+
+            yield prepare_frame(pd.DataFrame.from_records([hit["_source"] for hit in hits]))
+
+            if len(hits) < batch_size:
+                return
+            search_after = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit)
+
+
+# ========================
+# ROLLUP & BASELINES
+# ========================
+
+def bucket_metrics(frame, bucket=BUCKET):
+    """
+    Wide (bucket x service) matrices of requests, errors and p95 latency
+    of successful requests, covering every bucket between the first and
+    last event.
+    """
+    is_error = frame["log_level"].eq("ERROR")
+    keys = [frame["@timestamp"].dt.floor(bucket).rename("bucket"), frame["service_name"]]
+    grouped = frame.assign(is_error=is_error).groupby(keys, observed=True)
+
+    requests = grouped.size().unstack(fill_value=0)
+    errors = grouped["is_error"].sum().unstack(fill_value=0)
+    latency = frame["response_time_ms"].where(~is_error)
+    p95 = latency.groupby(keys, observed=True).quantile(0.95).unstack()
+
+    timeline = pd.date_range(requests.index.min(), requests.index.max(), freq=bucket)
+    return (
+        requests.reindex(timeline, fill_value=0),
+        errors.reindex(timeline, fill_value=0),
+        p95.reindex(timeline)
+    )
+
+
+def rolling_baseline(values, window=BASELINE_BUCKETS, min_periods=MIN_BASELINE_BUCKETS):
+    """
+    Median and spread (IQR / 1.349, a std estimate) of the previous
+    `window` buckets, the current one excluded.
+    """
+    history = values.shift(1).rolling(window, min_periods=min_periods)
+    spread = (history.quantile(0.75) - history.quantile(0.25)) / 1.349
+    return history.median(), spread
+
+
+def bridge_gaps(flags, gap=MERGE_GAP_BUCKETS):
+    """Also flag quiet runs of at most `gap` buckets between two flagged ones."""
+    if not gap:
+        return flags
+    before = flags.rolling(gap + 1, min_periods=1).max().astype(bool)
+    after = flags[::-1].rolling(gap + 1, min_periods=1).max().astype(bool)[::-1]
+    return flags | (before & after)
+
+
+def score_buckets(frame, bucket=BUCKET, window=BASELINE_BUCKETS, z_threshold=Z_THRESHOLD,
+                  min_errors=MIN_ERRORS):
+    """Long frame with one row per (bucket, service): metrics, baselines and flags."""
+    requests, errors, p95 = bucket_metrics(frame, bucket)
+    error_rate = errors / requests.where(requests > 0)
+    # Too few requests for a meaningful p95
+    p95 = p95.where(requests - errors >= MIN_REQUESTS)
+
+    rate_base, rate_spread = rolling_baseline(error_rate, window)
+    p95_base, p95_spread = rolling_baseline(p95, window)
+
+    rate_z = (error_rate - rate_base) / rate_spread.clip(lower=ERROR_RATE_STD_FLOOR)
+    p95_z = (p95 - p95_base) / p95_spread.clip(lower=LATENCY_STD_FLOOR_MS)
+
+    error_spike = (rate_z >= z_threshold) & (errors >= min_errors)
+    latency_spike = (p95_z >= z_threshold) & (p95 >= p95_base * LATENCY_FACTOR)
+    anomalous = bridge_gaps(error_spike | latency_spike)
+
+    # Number the episodes: a new one starts where a flagged run begins
+    starts = anomalous & ~anomalous.shift(1, fill_value=False)
+    episode = starts.cumsum().where(anomalous)
+
+    scored = pd.concat(
+        {
+            "requests": requests,
+            "errors": errors,
+            "error_rate": error_rate,
+            "baseline_error_rate": rate_base,
+            "p95_latency_ms": p95,
+            "baseline_p95_latency_ms": p95_base,
+            "error_spike": error_spike,
+            "latency_spike": latency_spike,
+            "episode": episode
+        },
+        axis=1
+    )
+    scored = scored.stack(level=1, future_stack=True)
+    scored.index.names = ["bucket", "service"]
+    return scored.reset_index()
+
+
+# ========================
+# EPISODES → THREATS
+# ========================
+
+def dominant_errors(frame, episodes, bucket=BUCKET):
+    """Most frequent (error_code, message) and host per episode, plus code counts."""
+    failed = frame.loc[frame["log_level"].eq("ERROR"), ["@timestamp", "service_name", "error_code", "message", "host"]]
+    failed = failed.assign(
+        bucket=failed["@timestamp"].dt.floor(bucket),
+        service=failed["service_name"].astype(str),
+        # Errors without a code or message still count towards the cause
+        error_code=failed["error_code"].astype(object).fillna("UNKNOWN"),
+        message=failed["message"].astype(object).fillna("")
+    )
+    failed = failed.merge(episodes[["bucket", "service", "episode"]], on=["bucket", "service"])
+
+    if failed.empty:
+        return {}
+
+    keys = ["service", "episode"]
+    codes = failed.groupby(keys + ["error_code", "message"], observed=True).size().rename("count").reset_index()
+    codes = codes.sort_values("count", ascending=False)
+    hosts = failed.groupby(keys + ["host"], observed=True).size().rename("count").reset_index()
+    top_hosts = hosts.sort_values("count", ascending=False).drop_duplicates(keys).set_index(keys)["host"]
+
+    causes = {}
+    for key, group in codes.groupby(keys, sort=False):
+        top = group.iloc[0]
+        causes[key] = {
+            "root_cause": f"{top['error_code']}: {top['message']}",
+            "error_code": top["error_code"],
+            "error_codes": group.groupby("error_code", observed=True)["count"].sum().nlargest(3).to_dict(),
+            "host": top_hosts.get(key)
+        }
+    return causes
+
+
+def _number(value, digits):
+    return None if pd.isna(value) else round(float(value), digits)
+
+
+def _format(value, spec):
+    return "n/a" if value is None else format(value, spec)
+
+
+def risk_for(error_spike, latency_spike, error_rate):
+    risk = 50
+    if error_spike:
+        risk += 25
+    if latency_spike:
+        risk += 10
+    if error_rate >= 0.5:
+        risk += 15
+    return min(100, risk)
+
+
+def detect_anomalies(frame, new_since=None, bucket=BUCKET, window=BASELINE_BUCKETS,
+                     z_threshold=Z_THRESHOLD, min_errors=MIN_ERRORS):
+    """
+    Service degradation threats found in `frame`, worst first. With
+    `new_since`, only episodes starting after it are reported, so the
+    baseline history can overlap a previous run without re-firing.
+    """
+    if frame.empty:
+        return []
+
+    scored = score_buckets(frame, bucket, window, z_threshold, min_errors)
+    episodes = scored.dropna(subset=["episode"])
+    if episodes.empty:
+        return []
+
+    summary = episodes.groupby(["service", "episode"]).agg(
+        buckets=("bucket", "size"),
+        first_bucket=("bucket", "min"),
+        last_bucket=("bucket", "max"),
+        requests=("requests", "sum"),
+        error_count=("errors", "sum"),
+        p95_latency_ms=("p95_latency_ms", "max"),
+        error_spike=("error_spike", "any"),
+        latency_spike=("latency_spike", "any")
+    )
+    # Baselines as they stood when the episode began
+    opening = episodes.sort_values("bucket").drop_duplicates(["service", "episode"]).set_index(["service", "episode"])
+    summary = summary.join(opening[["baseline_error_rate", "baseline_p95_latency_ms"]])
+    summary = summary[summary["buckets"] >= MIN_EPISODE_BUCKETS]
+    summary = summary.assign(error_rate=summary["error_count"] / summary["requests"].where(summary["requests"] > 0))
+
+    if new_since is not None:
+        summary = summary[summary["first_bucket"] >= pd.Timestamp(new_since).floor(bucket)]
+
+    causes = dominant_errors(frame, episodes, bucket)
+    width = pd.Timedelta(bucket)
+
+    threats = []
+    for (service, episode), row in summary.iterrows():
+        error_rate = _number(row["error_rate"], 4) or 0.0
+        cause = causes.get((service, episode), {})
+
+        threat = {
+            "type": THREAT_TYPE,
+            "threat_type": THREAT_TYPE,
+            "service": service,
+            "error_count": int(row["error_count"]),
+            "event_count": int(row["requests"]),
+            "error_rate": error_rate,
+            "baseline_error_rate": _number(row["baseline_error_rate"], 4),
+            "p95_latency_ms": _number(row["p95_latency_ms"], 1),
+            "baseline_p95_latency_ms": _number(row["baseline_p95_latency_ms"], 1),
+            "signals": [
+                name for name, fired in (("error_rate", row["error_spike"]), ("latency", row["latency_spike"]))
+                if fired
+            ],
+            "first_seen": row["first_bucket"].isoformat(),
+            "last_seen": (row["last_bucket"] + width).isoformat(),
+            "risk_score": risk_for(row["error_spike"], row["latency_spike"], error_rate)
+        }
+
+        if row["error_spike"] and cause:
+            threat["root_cause"] = cause["root_cause"]
+        elif row["latency_spike"]:
+            threat["root_cause"] = (
+                f"p95 latency {_format(threat['p95_latency_ms'], '.0f')} ms vs "
+                f"{_format(threat['baseline_p95_latency_ms'], '.0f')} ms baseline"
+            )
+        else:
+            threat["root_cause"] = (
+                f"error rate {_format(error_rate, '.1%')} vs "
+                f"{_format(threat['baseline_error_rate'], '.1%')} baseline"
+            )
+        if cause:
+            threat["error_code"] = cause["error_code"]
+            threat["error_codes"] = {str(code): int(count) for code, count in cause["error_codes"].items()}
+            threat["host"] = cause["host"]
+
+        threats.append(threat)
+
+    threats.sort(key=lambda threat: (threat["risk_score"], threat["error_count"]), reverse=True)
+    return threats
+
+
+# ========================
+# INCIDENTS
+# ========================
+
+def build_service_incident(threat):
+    from incident_commander import build_incident
+
+    incident_data = build_incident(threat, 1)
+    for field in ("service", "error_count", "root_cause", "error_code", "error_codes", "host",
+                  "error_rate", "baseline_error_rate", "p95_latency_ms", "baseline_p95_latency_ms",
+                  "signals", "event_count", "first_seen", "last_seen"):
+        if field in threat:
+            incident_data[field] = threat[field]
+    return incident_data
+
+
+def open_incidents(es, threats):
+    """Write one incident per threat in a single `_bulk`; returns (created, failed)."""
+    from incident_commander import save_incidents_bulk
+
+    if not threats:
+        return 0, []
+    return save_incidents_bulk(es, [build_service_incident(threat) for threat in threats])
+
+
+def run_service_health(window=BASELINE_BUCKETS, bucket=BUCKET):
+    """
+    Scan new application logs in `service-logs` since the watermark, with
+    `window` buckets of history before it for the baselines.
+    """
+    es = get_client("detection")
+    started = time.perf_counter()
+
+    watermark = load_watermark(es, DETECTOR_NAME)
+    upper = scan_upper_bound()
+    new_since = scan_start(watermark)
+    history_seconds = int(window * pd.Timedelta(bucket).total_seconds())
+
+    query = new_events_filter(watermark, upper, overlap_seconds=history_seconds)
+
+    try:
+        batches = list(fetch_batches(es, query))
+    except NotFoundError:
+        return {"status": "NO_INCIDENT", "reason": f"index '{LOGS_INDEX}' not found"}
+
+    frame = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+    threats = detect_anomalies(frame, new_since=datetime.fromisoformat(new_since), bucket=bucket, window=window)
+    created, failed = open_incidents(es, threats)
+
+    summary = {
+        "status": "SERVICE_HEALTH_COMPLETE" if threats else "NO_INCIDENT",
+        "scanned_from": new_since,
+        "scanned_to": upper,
+        "events": len(frame),
+        "anomalies": len(threats),
+        "created": created,
+        "failed": failed,
+        "services": sorted({threat["service"] for threat in threats}),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+    save_watermark(es, DETECTOR_NAME, upper, stats={
+        "events": summary["events"],
+        "anomalies": summary["anomalies"],
+        "created": created,
+        "elapsed_ms": summary["elapsed_ms"]
+    })
+    return summary
+
+
+# ========================
+# CLI
+# ========================
+
+def analyze_file(path, bucket=BUCKET, window=BASELINE_BUCKETS, z_threshold=Z_THRESHOLD,
+                 min_errors=MIN_ERRORS, create_incidents=False):
+    started = time.perf_counter()
+    frame = load_file(path)
+    loaded = time.perf_counter()
+    threats = detect_anomalies(frame, bucket=bucket, window=window, z_threshold=z_threshold, min_errors=min_errors)
+    finished = time.perf_counter()
+
+    print(
+        f"📊 {len(frame):,} log lines from {frame['service_name'].nunique()} services: "
+        f"loaded in {loaded - started:.2f}s, analyzed in {finished - loaded:.2f}s"
+    )
+
+    if not threats:
+        print("✅ No service degradation detected")
+
+    for threat in threats:
+        print(
+            f"🚨 {threat['service']} ({', '.join(threat['signals'])}): {threat['error_count']} errors "
+            f"in {threat['event_count']} requests, {threat['first_seen']} → {threat['last_seen']}\n"
+            f"   Root cause: {threat['root_cause']}"
+        )
+
+    if create_incidents and threats:
+        created, failed = open_incidents(get_client("detection"), threats)
+        print(f"📝 {created} incidents created, {len(failed)} failed")
+
+    return threats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Detect error-rate and latency spikes in application logs")
+    parser.add_argument("--file", help="NDJSON or JSON array log file, optionally gzipped (default: scan ES)")
+    parser.add_argument("--bucket", default=BUCKET, help="Bucket width, e.g. 1min, 30s")
+    parser.add_argument("--window", type=int, default=BASELINE_BUCKETS,
+                        help="Buckets of history in the rolling baseline")
+    parser.add_argument("--z", type=float, default=Z_THRESHOLD,
+                        help="Standard deviations above baseline that count as a spike")
+    parser.add_argument("--min-errors", type=int, default=MIN_ERRORS,
+                        help="Errors a bucket needs before its error rate can spike")
+    parser.add_argument("--create-incidents", action="store_true",
+                        help="Write incidents for anomalies found in --file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.file:
+        analyze_file(args.file, args.bucket, args.window, args.z, args.min_errors, args.create_incidents)
+    else:
+        print(run_service_health(args.window, args.bucket))
+
+
+if __name__ == "__main__":
+    main()
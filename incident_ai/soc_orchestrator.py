@@ -1,97 +1,326 @@
-import os
-from elasticsearch import Elasticsearch
-from dotenv import load_dotenv
-from ai_reasoner import generate_ai_analysis
+import copy
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-load_dotenv()
-
-ELASTIC_CLOUD_ID = os.getenv("ELASTIC_CLOUD_ID")
-USERNAME = os.getenv("ELASTIC_USERNAME")
-PASSWORD = os.getenv("ELASTIC_PASSWORD")
-
-es = Elasticsearch(
-    cloud_id=ELASTIC_CLOUD_ID,
-    basic_auth=(USERNAME, PASSWORD)
+from ai_reasoner import generate_ai_analysis_batch
+from es_client import get_client
+from watermarks import (
+    load_watermarks,
+    new_events_filter,
+    save_watermarks,
+    scan_start,
+    scan_upper_bound
 )
 
 INDEX_NAME = "security-events"
 
+# Failed logins from one IP within this window count as brute force
+BRUTE_FORCE_WINDOW_SECONDS = 300
+BRUTE_FORCE_THRESHOLD = 50
+# IPs per composite page (before server-side thresholding)
+BRUTE_FORCE_PAGE_SIZE = 1000
 
-def detect_brute_force():
-    query = {
-        "size": 0,
-        "query": {
-            "bool": {
-                "must": [
-                    {"term": {"event_type": "login_attempt"}},
-                    {"term": {"status": "FAILED"}}
-                ]
-            }
-        },
-        "aggs": {
-            "by_ip": {
-                "terms": {"field": "source_ip", "size": 5},
-                "aggs": {
-                    "failed_count": {
-                        "value_count": {"field": "status"}
+# Searches per _msearch request, and how many requests run at once
+MSEARCH_BATCH_SIZE = 20
+MSEARCH_CONCURRENCY = 4
+
+
+# ========================
+# DETECTOR INTERFACE
+# ========================
+
+class Detector:
+    """
+    A detector contributes one search body and turns that search's
+    response into a threat (or None). It never talks to ES itself, so the
+    orchestrator can run any number of detectors in a single `_msearch`.
+
+    Paginated detectors return the next page's body from `next_search`;
+    the orchestrator fetches all pending pages together, one `_msearch`
+    per round, and hands every page to `evaluate_pages`.
+    """
+
+    name = None
+    index = INDEX_NAME
+
+    def build_search(self, watermark, upper):
+        raise NotImplementedError
+
+    def next_search(self, body, response):
+        return None
+
+    def evaluate(self, response, watermark, upper):
+        raise NotImplementedError
+
+    def evaluate_pages(self, responses, watermark, upper):
+        return self.evaluate(responses[0], watermark, upper)
+
+
+class BruteForceDetector(Detector):
+    """
+    Every IP with more than BRUTE_FORCE_THRESHOLD failed logins in the
+    window, however many IPs there are: a composite aggregation pages
+    through all of them and a bucket_selector drops the rest server-side,
+    so responses only carry offending IPs.
+
+    Only events after the watermark are new, but a burst can straddle two
+    runs, so the scan reaches one window further back. An IP is reported
+    only if it also has new failures, which keeps a burst from re-firing
+    on every run.
+    """
+
+    name = "brute_force"
+
+    def build_search(self, watermark, upper):
+        query = new_events_filter(watermark, upper, overlap_seconds=BRUTE_FORCE_WINDOW_SECONDS)
+        query["bool"]["filter"] += [
+            {"term": {"event_type": "login_attempt"}},
+            {"term": {"status": "FAILED"}}
+        ]
+
+        return {
+            "size": 0,
+            "query": query,
+            "aggs": {
+                "by_ip": {
+                    "composite": {
+                        "size": BRUTE_FORCE_PAGE_SIZE,
+                        "sources": [{"source_ip": {"terms": {"field": "source_ip"}}}]
+                    },
+                    "aggs": {
+                        "new_failures": {
+                            "filter": {"range": {"@timestamp": {"gt": scan_start(watermark)}}}
+                        },
+                        "over_threshold": {
+                            "bucket_selector": {
+                                "buckets_path": {"attempts": "_count", "new": "new_failures._count"},
+                                "script": f"params.attempts > {BRUTE_FORCE_THRESHOLD} && params.new > 0"
+                            }
+                        }
                     }
                 }
             }
         }
-    }
 
-    response = es.search(index=INDEX_NAME, body=query)
-    buckets = response["aggregations"]["by_ip"]["buckets"]
+    def next_search(self, body, response):
+        # after_key points past the last bucket of the page even when the
+        # selector removed it; no after_key means every IP has been seen
+        after_key = response["aggregations"]["by_ip"].get("after_key")
+        if not after_key:
+            return None
 
-    for bucket in buckets:
-        if bucket["doc_count"] > 50:
-            return {
+        page = copy.deepcopy(body)
+        page["aggs"]["by_ip"]["composite"]["after"] = after_key
+        return page
+
+    def evaluate(self, response, watermark, upper):
+        return self.evaluate_pages([response], watermark, upper)
+
+    def evaluate_pages(self, responses, watermark, upper):
+        threats = [
+            {
                 "type": "BRUTE_FORCE",
-                "source_ip": bucket["key"],
+                "source_ip": bucket["key"]["source_ip"],
                 "attempts": bucket["doc_count"],
                 "risk_score": min(100, bucket["doc_count"])
             }
+            for response in responses
+            for bucket in response["aggregations"]["by_ip"]["buckets"]
+        ]
 
-    return None
+        threats.sort(key=lambda threat: threat["attempts"], reverse=True)
+        return threats or None
 
 
-def detect_privilege_escalation():
-    query = {
-        "query": {
-            "term": {"event_type": "privilege_escalation"}
-        }
-    }
+class PrivilegeEscalationDetector(Detector):
 
-    response = es.search(index=INDEX_NAME, body=query)
+    name = "privilege_escalation"
 
-    if response["hits"]["total"]["value"] > 0:
-        return {
-            "type": "PRIVILEGE_ESCALATION",
-            "risk_score": 95
-        }
+    def build_search(self, watermark, upper):
+        query = new_events_filter(watermark, upper)
+        query["bool"]["filter"].append({"term": {"event_type": "privilege_escalation"}})
+        return {"size": 0, "track_total_hits": True, "query": query}
+
+    def evaluate(self, response, watermark, upper):
+        count = response["hits"]["total"]["value"]
+
+        if count > 0:
+            return {
+                "type": "PRIVILEGE_ESCALATION",
+                "events": count,
+                "risk_score": 95
+            }
+
+        return None
+
+
+# Highest priority first: the orchestrator escalates the first threat found
+DETECTORS = [PrivilegeEscalationDetector(), BruteForceDetector()]
+
+
+def active_detectors():
+    """Built-in detectors followed by the compiled rules in rules/."""
+    from rule_engine import rule_detectors
 
+    try:
+        return DETECTORS + rule_detectors()
+    except Exception as e:
+        print(f"❌ Detection rules not loaded: {e}")
+        return list(DETECTORS)
+
+
+# ========================
+# MULTI-SEARCH EXECUTION
+# ========================
+
+def _msearch(es, batch):
+    searches = []
+    for detector, body in batch:
+        searches.append({"index": detector.index})
+        searches.append(body)
+    return es.msearch(searches=searches)["responses"]
+
+
+def _msearch_all(es, planned):
+    """One response per (detector, body), in order; batches fan out concurrently."""
+    batches = [
+        planned[i:i + MSEARCH_BATCH_SIZE]
+        for i in range(0, len(planned), MSEARCH_BATCH_SIZE)
+    ]
+
+    if len(batches) == 1:
+        return _msearch(es, batches[0])
+
+    with ThreadPoolExecutor(max_workers=min(MSEARCH_CONCURRENCY, len(batches))) as pool:
+        return [
+            response
+            for batch_responses in pool.map(lambda batch: _msearch(es, batch), batches)
+            for response in batch_responses
+        ]
+
+
+def run_detectors(detectors=None, es=None):
+    """
+    Run detectors with a fixed number of round trips however many there
+    are: one `_mget` for the watermarks, one `_msearch` per batch of
+    MSEARCH_BATCH_SIZE searches (batches fan out concurrently), and one
+    `_bulk` to advance the watermarks of detectors whose search succeeded.
+    Paginated detectors add one `_msearch` round per extra page, shared by
+    all detectors still paging.
+
+    Returns {detector name: {"threat": ..., "error": ...}}; a detector
+    evaluating many groups returns a list of threats.
+    """
+    detectors = active_detectors() if detectors is None else detectors
+    es = es or get_client("detection")
+
+    watermarks = load_watermarks(es, [detector.name for detector in detectors])
+    upper = scan_upper_bound()
+
+    pages = {detector.name: [] for detector in detectors}
+    errors = {}
+
+    pending = [
+        (detector, detector.build_search(watermarks.get(detector.name), upper))
+        for detector in detectors
+    ]
+
+    while pending:
+        follow_ups = []
+
+        for (detector, body), response in zip(pending, _msearch_all(es, pending)):
+            if "error" in response:
+                error = response["error"]
+                errors[detector.name] = error.get("reason", error)
+                continue
+
+            pages[detector.name].append(response)
+
+            next_body = detector.next_search(body, response)
+            if next_body is not None:
+                follow_ups.append((detector, next_body))
+
+        pending = follow_ups
+
+    results = {}
+    advanced = {}
+
+    for detector in detectors:
+        if detector.name in errors:
+            # Leave the watermark alone so the next run retries this range
+            results[detector.name] = {"threat": None, "error": errors[detector.name]}
+            continue
+
+        try:
+            threat = detector.evaluate_pages(pages[detector.name], watermarks.get(detector.name), upper)
+        except Exception as e:
+            results[detector.name] = {"threat": None, "error": str(e)}
+            continue
+
+        results[detector.name] = {"threat": threat, "error": None}
+        advanced[detector.name] = (upper, None, None)
+
+    for name, error in save_watermarks(es, advanced).items():
+        results[name]["watermark_error"] = error
+    return results
+
+
+def detect_brute_force():
+    """Every offending IP as a list of threats (most attempts first), or None."""
+    return run_detectors([BruteForceDetector()])["brute_force"]["threat"]
+
+
+def detect_privilege_escalation():
+    return run_detectors([PrivilegeEscalationDetector()])["privilege_escalation"]["threat"]
+
+
+def _analysis_error(ai_analysis):
+    """The error a batch reported for this threat, or None."""
+    try:
+        parsed = json.loads(ai_analysis)
+    except ValueError:
+        return None
+    if isinstance(parsed, dict) and set(parsed) == {"error"}:
+        return parsed["error"]
     return None
 
 
 def run_soc_orchestrator():
-    brute_force = detect_brute_force()
-    privilege = detect_privilege_escalation()
+    detectors = active_detectors()
+    results = run_detectors(detectors)
 
-    threat = None
+    threats = []
+    for detector in detectors:
+        found = results[detector.name]["threat"]
+        if isinstance(found, list):
+            threats.extend(found)
+        elif found:
+            threats.append(found)
 
-    if privilege:
-        threat = privilege
-    elif brute_force:
-        threat = brute_force
-    else:
+    threat = threats[0] if threats else None
+
+    if not threat:
+        errors = {name: r["error"] for name, r in results.items() if r["error"]}
+        if errors:
+            return {"status": "NO_THREAT", "errors": errors}
         return {"status": "NO_THREAT"}
 
-    # Trigger AI reasoning only for high-risk threats
-    if threat.get("risk_score", 0) > 80:
-        try:
-            ai_analysis = generate_ai_analysis(threat)
-            threat["ai_analysis"] = ai_analysis
-        except Exception as e:
-            threat["ai_analysis_error"] = str(e)
+    # Watermarks already moved past the rest, so report them with it
+    if len(threats) > 1:
+        threat["other_threats"] = threats[1:]
+
+    # Trigger AI reasoning only for high-risk threats, all of them in one
+    # concurrent, rate-limited batch
+    high_risk = [t for t in threats if t.get("risk_score", 0) > 80]
+    try:
+        for t, ai_analysis in zip(high_risk, generate_ai_analysis_batch(high_risk)):
+            error = _analysis_error(ai_analysis)
+            if error:
+                t["ai_analysis_error"] = error
+            else:
+                t["ai_analysis"] = ai_analysis
+    except Exception as e:
+        for t in high_risk:
+            t["ai_analysis_error"] = str(e)
 
-    return threat
\ No newline at end of file
+    return threat
@@ -0,0 +1,314 @@
+import argparse
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from log_reader import read_documents
+
+# ========================
+# STREAMING BRUTE-FORCE DETECTION
+# ========================
+#
+# Same rule as soc_orchestrator.detect_brute_force (more than 50 failed
+# logins from one IP within 300 s) evaluated on events as they are read,
+# before they are indexed. Each IP keeps a ring of per-second buckets
+# covering the window, so memory per IP is bounded by the window length,
+# and the IP table itself is an LRU capped at MAX_TRACKED_IPS with idle
+# IPs evicted as the stream advances.
+
+WINDOW_SECONDS = 300
+BUCKET_SECONDS = 1
+THRESHOLD = 50
+MAX_TRACKED_IPS = 100_000
+
+# Idle IPs inspected for eviction per observed event (amortized sweep)
+EVICTIONS_PER_EVENT = 2
+
+
+def event_time(doc):
+    """Epoch seconds of the event; naive timestamps are UTC like in ES."""
+    timestamp = doc.get("@timestamp")
+    if not timestamp:
+        return time.time()
+    parsed = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def is_failed_login(doc):
+    return doc.get("event_type") == "login_attempt" and doc.get("status") == "FAILED"
+
+
+class IpWindow:
+    __slots__ = ("buckets", "total", "latest", "alerted")
+
+    def __init__(self):
+        self.buckets = deque()  # [bucket_index, count], oldest first
+        self.total = 0
+        self.latest = None
+        self.alerted = False
+
+
+class BruteForceStream:
+    """
+    Sliding-window failed-login counter per source IP. `observe` returns a
+    threat dict (same shape as detect_brute_force) the moment an IP's count
+    in the current window goes above the threshold; the IP re-arms once its
+    window drops back to the threshold.
+
+    A window of 0 disables sliding: counts are cumulative over the stream,
+    matching an aggregation without a time range.
+    """
+
+    def __init__(self, window_seconds=WINDOW_SECONDS, bucket_seconds=BUCKET_SECONDS,
+                 threshold=THRESHOLD, max_ips=MAX_TRACKED_IPS, on_threat=None):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = max(1, int(window_seconds // bucket_seconds)) if window_seconds else None
+        self.threshold = threshold
+        self.max_ips = max_ips
+        self.on_threat = on_threat
+
+        self._ips = OrderedDict()
+        self.latest_bucket = None
+
+        self.events = 0
+        self.failed_logins = 0
+        self.late_dropped = 0
+        self.evicted = 0
+        self.threats = 0
+        self.latencies_ms = deque(maxlen=10_000)
+
+    def _slide(self, window, now_bucket):
+        if self.window_buckets is None:
+            return
+        oldest = now_bucket - self.window_buckets
+        buckets = window.buckets
+        while buckets and buckets[0][0] <= oldest:
+            window.total -= buckets.popleft()[1]
+
+    def _evict_idle(self):
+        for _ in range(EVICTIONS_PER_EVENT):
+            if not self._ips:
+                return
+            ip, window = next(iter(self._ips.items()))
+            idle = (
+                self.window_buckets is not None
+                and window.latest <= self.latest_bucket - self.window_buckets
+            )
+            if not idle and len(self._ips) <= self.max_ips:
+                return
+            del self._ips[ip]
+            self.evicted += 1
+
+    def observe(self, doc, arrived=None):
+        arrived = time.perf_counter() if arrived is None else arrived
+        self.events += 1
+
+        if not is_failed_login(doc):
+            return None
+
+        self.failed_logins += 1
+        source_ip = doc.get("source_ip")
+        bucket = int(event_time(doc) // self.bucket_seconds)
+
+        if self.latest_bucket is None or bucket > self.latest_bucket:
+            self.latest_bucket = bucket
+
+        window = self._ips.get(source_ip)
+        if window is None:
+            window = self._ips[source_ip] = IpWindow()
+        else:
+            self._ips.move_to_end(source_ip)
+
+        now_bucket = bucket if window.latest is None or bucket > window.latest else window.latest
+        window.latest = now_bucket
+
+        if self.window_buckets is not None and bucket <= now_bucket - self.window_buckets:
+            # Out-of-order event already outside this IP's window
+            self.late_dropped += 1
+            self._evict_idle()
+            return None
+
+        buckets = window.buckets
+        if buckets and buckets[-1][0] == bucket:
+            buckets[-1][1] += 1
+        elif not buckets or buckets[-1][0] < bucket:
+            buckets.append([bucket, 1])
+        else:
+            # Late but inside the window: find or insert its bucket
+            for entry in buckets:
+                if entry[0] == bucket:
+                    entry[1] += 1
+                    break
+            else:
+                buckets.append([bucket, 1])
+                window.buckets = deque(sorted(buckets))
+        window.total += 1
+
+        self._slide(window, now_bucket)
+        self._evict_idle()
+
+        if window.total <= self.threshold:
+            window.alerted = False
+            return None
+
+        if window.alerted:
+            return None
+        window.alerted = True
+
+        threat = {
+            "type": "BRUTE_FORCE",
+            "threat_type": "BRUTE_FORCE",
+            "source_ip": source_ip,
+            "user": doc.get("user"),
+            "attempts": window.total,
+            "risk_score": min(100, window.total),
+            "window_seconds": self.window_seconds,
+            "event_timestamp": doc.get("@timestamp"),
+            "detected_at": datetime.now(timezone.utc).isoformat()
+        }
+        latency_ms = (time.perf_counter() - arrived) * 1000
+        threat["detection_latency_ms"] = round(latency_ms, 3)
+        self.latencies_ms.append(latency_ms)
+        self.threats += 1
+
+        if self.on_threat:
+            self.on_threat(threat)
+        return threat
+
+    def stats(self):
+        latencies = sorted(self.latencies_ms)
+        stats = {
+            "events": self.events,
+            "failed_logins": self.failed_logins,
+            "tracked_ips": len(self._ips),
+            "evicted_ips": self.evicted,
+            "late_dropped": self.late_dropped,
+            "threats": self.threats
+        }
+        if latencies:
+            stats["latency_ms_p50"] = round(latencies[len(latencies) // 2], 3)
+            stats["latency_ms_max"] = round(latencies[-1], 3)
+        return stats
+
+
+# ========================
+# INGEST HOOK
+# ========================
+
+def open_incident(threat):
+    """Turn a streamed threat into an incident (with the usual dedup)."""
+    from incident_commander import build_incident, count_recent_occurrences, is_duplicate_incident, save_incident
+
+    print(
+        f"🚨 Brute force from {threat['source_ip']}: {threat['attempts']} failed logins "
+        f"in {threat['window_seconds']}s (detected in {threat['detection_latency_ms']} ms)"
+    )
+
+    if is_duplicate_incident(threat["source_ip"], threat["threat_type"]):
+        return
+
+    occurrences = count_recent_occurrences(threat["source_ip"], threat["threat_type"]) + 1
+    save_incident(build_incident(threat, occurrences))
+
+
+def detect_while_reading(records, stream):
+    """Pass `(document, offset)` records through, feeding each to the stream."""
+    for doc, offset in records:
+        stream.observe(doc)
+        yield doc, offset
+
+
+# ========================
+# REPLAY & VERIFICATION
+# ========================
+
+def aggregation_verdicts(docs, window_seconds=WINDOW_SECONDS, threshold=THRESHOLD):
+    """
+    IPs the aggregation query flags when run over these events: more than
+    `threshold` failed logins within some (t - window, t] range, or in total
+    when window is 0. Exact, on raw timestamps.
+    """
+    per_ip = {}
+    for doc in docs:
+        if is_failed_login(doc):
+            per_ip.setdefault(doc.get("source_ip"), []).append(event_time(doc))
+
+    flagged = set()
+    for ip, times in per_ip.items():
+        if not window_seconds:
+            if len(times) > threshold:
+                flagged.add(ip)
+            continue
+
+        times.sort()
+        start = 0
+        for end, t in enumerate(times):
+            while times[start] <= t - window_seconds:
+                start += 1
+            if end - start + 1 > threshold:
+                flagged.add(ip)
+                break
+
+    return flagged
+
+
+def replay(path, window_seconds=WINDOW_SECONDS, bucket_seconds=BUCKET_SECONDS,
+           threshold=THRESHOLD, order="time"):
+    docs = [doc for doc, _ in read_documents(path)]
+    if order == "time":
+        # Arrival order of a live feed; "file" keeps the file's order
+        docs.sort(key=event_time)
+
+    stream = BruteForceStream(window_seconds, bucket_seconds, threshold)
+    started = time.perf_counter()
+    threats = [threat for threat in map(stream.observe, docs) if threat]
+    elapsed = time.perf_counter() - started
+
+    streamed = {threat["source_ip"] for threat in threats}
+    expected = aggregation_verdicts(docs, window_seconds, threshold)
+
+    for threat in threats:
+        print(
+            f"🚨 {threat['source_ip']}: {threat['attempts']} failed logins at "
+            f"{threat['event_timestamp']} (detected in {threat['detection_latency_ms']} ms)"
+        )
+
+    stats = stream.stats()
+    print(f"📊 {stats['events']} events replayed in {elapsed:.3f}s, {stats}")
+
+    if streamed == expected:
+        print(f"✅ Verdicts match the aggregation query: {sorted(expected) or 'none'}")
+    else:
+        print(
+            f"❌ Verdicts differ: streaming only {sorted(streamed - expected)}, "
+            f"aggregation only {sorted(expected - streamed)}"
+        )
+
+    return streamed, expected
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay logs through the streaming brute-force detector")
+    parser.add_argument("--file", default="security_logs.json",
+                        help="JSON array or NDJSON file, optionally gzipped")
+    parser.add_argument("--window", type=int, default=WINDOW_SECONDS,
+                        help="Sliding window in seconds (0 = whole stream)")
+    parser.add_argument("--bucket", type=int, default=BUCKET_SECONDS,
+                        help="Bucket width in seconds")
+    parser.add_argument("--threshold", type=int, default=THRESHOLD,
+                        help="Failed logins per window that count as brute force")
+    parser.add_argument("--order", choices=("time", "file"), default="time",
+                        help="Replay in event-time order or in file order")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    replay(args.file, args.window, args.bucket, args.threshold, args.order)
+
+
+if __name__ == "__main__":
+    main()
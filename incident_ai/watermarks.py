@@ -0,0 +1,140 @@
+from datetime import datetime, timezone, timedelta
+
+from elasticsearch import NotFoundError
+
+# ========================
+# DETECTOR WATERMARKS
+# ========================
+#
+# Each detector remembers how far it has scanned, so a run only looks at
+# events newer than its watermark and its cost follows the new event rate
+# instead of the index size. Watermarks live in their own small index (one
+# document per detector) so they survive restarts and are shared by the
+# API, the CLI and any scheduler.
+#
+# A watermark is the last processed @timestamp plus a tiebreaker: the ids
+# of events already processed at exactly that timestamp. Detectors that
+# scan a time range advance it to the end of the range (no ids); detectors
+# that consume one event at a time advance it to that event.
+
+WATERMARKS_INDEX = "detector-watermarks"
+
+# First run of a detector (no watermark yet) looks back this far
+INITIAL_LOOKBACK_MINUTES = 15
+
+# Events newer than this are not scanned yet: they may still be in flight
+# (bulk retries, refresh interval) and would land behind the watermark
+SETTLE_SECONDS = 10
+
+
+def load_watermark(es, detector):
+    try:
+        return es.get(index=WATERMARKS_INDEX, id=detector)["_source"]
+    except NotFoundError:
+        return None
+
+
+def save_watermark(es, detector, timestamp, ids=None, stats=None):
+    document = {
+        "detector": detector,
+        "timestamp": timestamp,
+        "ids": ids or [],
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    if stats:
+        document["last_run"] = stats
+
+    es.index(index=WATERMARKS_INDEX, id=detector, document=document)
+    return document
+
+
+def load_watermarks(es, detectors):
+    """Watermarks of several detectors in one `_mget`; missing ones are None."""
+    try:
+        response = es.mget(index=WATERMARKS_INDEX, ids=list(detectors))
+    except NotFoundError:
+        return {detector: None for detector in detectors}
+
+    return {
+        doc["_id"]: doc["_source"] if doc.get("found") else None
+        for doc in response["docs"]
+    }
+
+
+def save_watermarks(es, updates):
+    """
+    Advance several watermarks in one `_bulk`.
+    `updates` maps detector -> (timestamp, ids, stats).
+    Returns {detector: error} for the watermarks that did not advance.
+    """
+    if not updates:
+        return {}
+
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for detector, (timestamp, ids, stats) in updates.items():
+        document = {"detector": detector, "timestamp": timestamp, "ids": ids or [], "updated_at": now}
+        if stats:
+            document["last_run"] = stats
+        operations.append({"index": {"_index": WATERMARKS_INDEX, "_id": detector}})
+        operations.append(document)
+
+    response = es.bulk(operations=operations)
+    if not response["errors"]:
+        return {}
+
+    # A watermark left behind means its range is rescanned (and re-alerted)
+    failed = {}
+    for detector, item in zip(updates, response["items"]):
+        outcome = item["index"]
+        if outcome.get("status", 500) >= 300:
+            failed[detector] = outcome.get("error")
+            print(f"⚠️ Watermark of '{detector}' did not advance: {outcome.get('error')}")
+    return failed
+
+
+def scan_upper_bound():
+    """Upper end (inclusive) of the range a run may scan."""
+    return (datetime.now(timezone.utc) - timedelta(seconds=SETTLE_SECONDS)).isoformat()
+
+
+def scan_start(watermark, lookback_minutes=INITIAL_LOOKBACK_MINUTES):
+    if watermark:
+        return watermark["timestamp"]
+    return (datetime.now(timezone.utc) - timedelta(minutes=lookback_minutes)).isoformat()
+
+
+def new_events_filter(watermark, upper, field="@timestamp",
+                      lookback_minutes=INITIAL_LOOKBACK_MINUTES, overlap_seconds=0):
+    """
+    Bool query selecting events after the watermark and up to `upper`.
+
+    With `overlap_seconds` the range also reaches that far back before the
+    watermark, for windowed detectors that need recent context; callers
+    then tell new from old events with a `filter` sub-aggregation.
+    """
+    start = scan_start(watermark, lookback_minutes)
+    ids = watermark.get("ids") if watermark else None
+
+    if overlap_seconds:
+        start = (datetime.fromisoformat(start) - timedelta(seconds=overlap_seconds)).isoformat()
+        return {"bool": {"filter": [{"range": {field: {"gt": start, "lte": upper}}}]}}
+
+    if ids:
+        # Resume at the same timestamp, skipping events already processed
+        return {
+            "bool": {
+                "filter": [{"range": {field: {"gte": start, "lte": upper}}}],
+                "must_not": [{"ids": {"values": ids}}]
+            }
+        }
+
+    return {"bool": {"filter": [{"range": {field: {"gt": start, "lte": upper}}}]}}
+
+
+def watermark_lag_seconds(watermark):
+    """How far the detector's scan position trails the wall clock."""
+    if not watermark:
+        return None
+    scanned_to = datetime.fromisoformat(watermark["timestamp"])
+    return round((datetime.now(timezone.utc) - scanned_to).total_seconds(), 1)